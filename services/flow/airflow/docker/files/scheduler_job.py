@@ -962,6 +962,12 @@ class SchedulerJob(BaseJob):
         num_tasks_in_executor = 0
         num_starving_tasks_total = 0
 
+        NodeUtil.start_scheduling_loop()
+        util_snapshot = NodeUtil.snapshot
+        if util_snapshot is not None:
+            Stats.gauge('scheduler.kaapana.utilization_snapshot_age', NodeUtil.get_snapshot_age())
+            Stats.gauge('scheduler.kaapana.utilization_refresh_duration', util_snapshot["refresh_duration"])
+
         # Go through each pool, and queue up a task for execution if there are
         # any open slots in the pool.
         for pool, task_instances in pool_to_task_instances.items():
@@ -1047,7 +1053,10 @@ class SchedulerJob(BaseJob):
                     # Though we can execute tasks with lower priority if there's enough room
                     continue
 
-                if not NodeUtil.check_ti_scheduling(ti=task_instance, logger=self.log):
+                check_start = time.time()
+                ti_fits = NodeUtil.check_ti_scheduling(ti=task_instance, logger=self.log)
+                Stats.timing('scheduler.kaapana.check_ti_scheduling', (time.time() - check_start) * 1000)
+                if not ti_fits:
                     continue
 
                 executable_tis.append(task_instance)
@@ -0,0 +1,110 @@
+"""
+Script to measure the import and parse cost of every DAG file, like the scheduler's DAG file processor does.
+
+Every DAG file is loaded in a fresh interpreter (-X importtime) through an Airflow DagBag:
+    - airflow:  time to import airflow itself (paid once per processor, reported for reference)
+    - parse:    time to load the DAG file including all imports it triggers
+    - imports:  slowest modules imported by the DAG file (cumulative import time)
+
+Example:
+    python3 dag_parse_benchmark.py --dags-dir workflows/airflow-components/dags --plugins-dir workflows/airflow-components/plugins
+"""
+
+import os
+import sys
+import json
+import glob
+import subprocess
+from argparse import ArgumentParser
+
+MARKER = "### dag-parse-benchmark ###"
+
+CHILD_CODE = """
+import sys, time, json
+t0 = time.perf_counter()
+import airflow
+from airflow.models import DagBag
+t1 = time.perf_counter()
+print("{marker}", file=sys.stderr, flush=True)
+dagbag = DagBag(dag_folder=sys.argv[1], include_examples=False)
+t2 = time.perf_counter()
+print(json.dumps({{
+    "airflow": t1 - t0,
+    "parse": t2 - t1,
+    "dags": len(dagbag.dags),
+    "errors": {{k: str(v) for k, v in dagbag.import_errors.items()}}
+}}))
+""".format(marker=MARKER)
+
+
+def get_slowest_imports(stderr, count):
+    # "import time: self [us] | cumulative | imported package" -> only lines after the marker belong to the DAG file
+    imports = []
+    if MARKER not in stderr:
+        return imports
+    for line in stderr.split(MARKER, 1)[1].splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            # top level imports only, nested ones are part of the cumulative time
+            if name.startswith("  "):
+                continue
+            imports.append((int(cumulative) / 1e6, name.strip()))
+        except ValueError:
+            continue
+    return sorted(imports, reverse=True)[:count]
+
+
+def benchmark_dag_file(dag_file, plugins_dir, dags_dir, import_count):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in [plugins_dir, dags_dir, env.get("PYTHONPATH")] if p)
+    env["AIRFLOW__CORE__LOAD_EXAMPLES"] = "False"
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD_CODE, dag_file],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, env=env)
+    result = {"file": os.path.relpath(dag_file, dags_dir)}
+    try:
+        result.update(json.loads(output.stdout.strip().splitlines()[-1]))
+    except (IndexError, ValueError):
+        result["errors"] = {dag_file: output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "no output"}
+        return result
+    result["imports"] = get_slowest_imports(output.stderr, import_count)
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument("--dags-dir", dest="dags_dir", default=os.path.join("workflows", "airflow-components", "dags"), help="Directory with the DAG files")
+    parser.add_argument("--plugins-dir", dest="plugins_dir", default=os.path.join("workflows", "airflow-components", "plugins"), help="Airflow plugins directory")
+    parser.add_argument("--imports", dest="import_count", type=int, default=3, help="Slowest imports listed per DAG file")
+    parser.add_argument("--json", dest="json_file", default=None, help="Write the results to this json file")
+    args = parser.parse_args()
+
+    dags_dir = os.path.abspath(args.dags_dir)
+    plugins_dir = os.path.abspath(args.plugins_dir)
+    dag_files = sorted(glob.glob(os.path.join(dags_dir, "*.py")))
+    if len(dag_files) == 0:
+        print(f"No DAG files found in {dags_dir}!")
+        exit(1)
+
+    results = []
+    for dag_file in dag_files:
+        result = benchmark_dag_file(dag_file, plugins_dir, dags_dir, args.import_count)
+        results.append(result)
+        print(f"{result['file']}: {result.get('parse', 0):.3f}s", flush=True)
+
+    results.sort(key=lambda r: r.get("parse", 0), reverse=True)
+    print("")
+    print(f"{'DAG file':<60} {'parse [s]':>10} {'airflow [s]':>12} {'dags':>5}  slowest imports")
+    for result in results:
+        imports = ", ".join(f"{name} {seconds:.3f}s" for seconds, name in result.get("imports", []))
+        print(f"{result['file']:<60} {result.get('parse', 0):>10.3f} {result.get('airflow', 0):>12.3f} {result.get('dags', 0):>5}  {imports}")
+        for file, error in result.get("errors", {}).items():
+            print(f"    ERROR {file}: {error}")
+    print("")
+    print(f"Total parse time: {sum(r.get('parse', 0) for r in results):.3f}s for {len(results)} files")
+
+    if args.json_file:
+        with open(args.json_file, "w") as f:
+            json.dump(results, f, indent=4)
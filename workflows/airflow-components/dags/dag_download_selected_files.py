@@ -18,6 +18,13 @@ ui_forms = {
                 "type": "boolean",
                 "default": True,
             },
+            "zip_compression": {
+                "title": "Zip compression",
+                "description": "'stored' only archives the files, 'deflated' compresses them (smaller archive, takes longer).",
+                "type": "string",
+                "enum": ["stored", "deflated"],
+                "default": "stored",
+            },
             "single_execution": {
                 "title": "single execution",
                 "description": "Should each series be processed separately?",
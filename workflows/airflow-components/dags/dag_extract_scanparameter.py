@@ -49,7 +49,7 @@ dag = DAG(
 
 get_input = LocalGetInputDataOperator(dag=dag)
 extract_scanparameter = ExtractScanparameterOperator(dag=dag)
-put_to_minio = LocalMinioOperator(dag=dag, action='put', action_operators=[extract_scanparameter], file_white_tuples=('.json', '*'))
+put_to_minio = LocalMinioOperator(dag=dag, action='put', action_operators=[extract_scanparameter], file_white_tuples=('.jsonl', '.csv'))
 clean = LocalWorkflowCleanerOperator(dag=dag, clean_workflow_dir=True)
 
 get_input >> extract_scanparameter >> put_to_minio >> clean
\ No newline at end of file
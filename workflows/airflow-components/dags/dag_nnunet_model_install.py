@@ -9,6 +9,7 @@ from kaapana.operators.LocalWorkflowCleanerOperator import LocalWorkflowCleanerO
 from kaapana.operators.Bin2DcmOperator import Bin2DcmOperator
 
 from nnunet.GetTaskModelOperator import GetTaskModelOperator
+from nnunet.LocalUpdateTaskIndexOperator import LocalUpdateTaskIndexOperator
 
 
 ui_forms = {
@@ -68,9 +69,11 @@ extract_model = GetTaskModelOperator(
     input_operator=dcm2bin,
     mode="install_zip"
 )
+update_task_index = LocalUpdateTaskIndexOperator(dag=dag, force=True)
+
 clean = LocalWorkflowCleanerOperator(
     dag=dag,
     clean_workflow_dir=True
 )
 
-get_input >> dcm2bin >> extract_model >> clean
+get_input >> dcm2bin >> extract_model >> update_task_index >> clean
@@ -3,6 +3,7 @@ from datetime import timedelta
 from airflow.models import DAG
 from nnunet.GetTaskModelOperator import GetTaskModelOperator
 from nnunet.getTasks import get_tasks
+from nnunet.LocalUpdateTaskIndexOperator import LocalUpdateTaskIndexOperator
 
 available_pretrained_task_names, installed_tasks, all_selectable_tasks = get_tasks()
 
@@ -43,4 +44,6 @@ delete_model = GetTaskModelOperator(
     mode="uninstall"
 )
 
-delete_model
+update_task_index = LocalUpdateTaskIndexOperator(dag=dag, force=True)
+
+delete_model >> update_task_index
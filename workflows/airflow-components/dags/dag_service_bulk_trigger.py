@@ -0,0 +1,26 @@
+from airflow.utils.log.logging_mixin import LoggingMixin
+from airflow.utils.dates import days_ago
+from datetime import timedelta
+from airflow.models import DAG
+from kaapana.operators.LocalBulkTriggerOperator import LocalBulkTriggerOperator
+
+log = LoggingMixin().log
+
+args = {
+    'ui_visible': False,
+    'owner': 'kaapana',
+    'start_date': days_ago(0),
+    'retries': 2,
+    'retry_delay': timedelta(seconds=30)
+}
+
+# triggered by the meta-trigger api with single_execution -> creates one DagRun per series of the cohort
+dag = DAG(
+    dag_id='service-bulk-trigger',
+    default_args=args,
+    schedule_interval=None,
+    concurrency=5,
+    max_active_runs=5
+)
+
+bulk_trigger = LocalBulkTriggerOperator(dag=dag)
@@ -1,4 +1,9 @@
+import os
+import json
+import time
+from contextlib import contextmanager
 from airflow.operators.python_operator import PythonOperator
+from airflow.contrib.sensors.python_sensor import PythonSensor
 from airflow.models import DAG
 from datetime import timedelta
 from airflow.utils.dates import days_ago
@@ -23,19 +28,120 @@ dag = DAG(
 )
 
 
+# Incoming series are collected in a staging window and one service-extract-metadata run is triggered per window.
+# A window is closed as soon as it contains incoming_dcm_batch_size series or incoming_dcm_max_latency seconds passed.
+# incoming_dcm_batch_size = 1 triggers one run per series.
+# The run which opened a window flushes it after max_latency with a reschedule sensor (no executor slot while waiting).
+# Overdue windows are also flushed by the next incoming series, in case the run owning the window failed.
+STAGING_DIR = "/data/incoming-staging"
+CURRENT_WINDOW_FILE = os.path.join(STAGING_DIR, "current-window.json")
+TRIGGER_DAG_ID = "service-extract-metadata"
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_LATENCY = 30
+# closed windows still in the staging dir this long after max_latency were not triggered (e.g. the task was killed in between)
+ORPHANED_WINDOW_AGE = 600
+
+
+@contextmanager
+def staging_lock():
+    # all incoming tasks run on the same /data volume -> flock serializes the window handling
+    import fcntl
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    with open(os.path.join(STAGING_DIR, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_current_window():
+    try:
+        with open(CURRENT_WINDOW_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def open_window():
+    window = {"run_id": generate_run_id(TRIGGER_DAG_ID), "opened": time.time()}
+    os.makedirs(os.path.join(STAGING_DIR, window["run_id"], "batch"))
+    with open(CURRENT_WINDOW_FILE, "w") as f:
+        json.dump(window, f)
+    return window
+
+
+def close_window(window):
+    # only called with the staging lock -> a closed window is never written again
+    os.remove(CURRENT_WINDOW_FILE)
+    return window
+
+
+def stage_series(window, dcm_path, series_uid):
+    import shutil
+    target = os.path.join(STAGING_DIR, window["run_id"], "batch", series_uid, 'extract-metadata-input')
+    print("MOVE!")
+    print("SRC: {}".format(dcm_path))
+    print("TARGET: {}".format(target))
+    if os.path.isdir(target):
+        # the same series was sent twice within one window
+        for file_name in os.listdir(dcm_path):
+            shutil.move(os.path.join(dcm_path, file_name), os.path.join(target, file_name))
+    else:
+        shutil.move(dcm_path, target)
+    return len(os.listdir(os.path.join(STAGING_DIR, window["run_id"], "batch")))
+
+
+def trigger_it(window):
+    import shutil
+    from airflow.api.common.experimental.trigger_dag import trigger_dag as trigger
+    dag_run_id = window["run_id"]
+    shutil.move(os.path.join(STAGING_DIR, dag_run_id), os.path.join("/data", dag_run_id))
+    series_count = len(os.listdir(os.path.join("/data", dag_run_id, "batch")))
+    print(("TRIGGERING! DAG-ID: %s RUN_ID: %s SERIES: %d" % (TRIGGER_DAG_ID, dag_run_id, series_count)))
+    trigger(dag_id=TRIGGER_DAG_ID, run_id=dag_run_id, replace_microseconds=False)
+
+
+def get_max_latency():
+    from airflow.models import Variable
+    return float(Variable.get("incoming_dcm_max_latency", default_var=DEFAULT_MAX_LATENCY))
+
+
+def flush_overdue_windows(max_latency):
+    """
+    Triggers the current window once it is overdue and closed windows which were never triggered,
+    so the last series of an import is processed even if the run that opened its window failed.
+    Has to be called with the staging lock.
+    :returns: closed windows, which have to be triggered
+    """
+    closed_windows = []
+    window = get_current_window()
+    if window is not None and time.time() - window["opened"] >= max_latency:
+        print("Flushing overdue window {}".format(window["run_id"]))
+        closed_windows.append(close_window(window))
+        window = None
+    for run_id in sorted(os.listdir(STAGING_DIR)):
+        window_dir = os.path.join(STAGING_DIR, run_id)
+        if not os.path.isdir(window_dir) or (window is not None and run_id == window["run_id"]):
+            continue
+        if run_id in [closed_window["run_id"] for closed_window in closed_windows]:
+            continue
+        if time.time() - os.path.getmtime(window_dir) >= max_latency + ORPHANED_WINDOW_AGE:
+            print("Flushing orphaned window {}".format(run_id))
+            closed_windows.append({"run_id": run_id})
+    return closed_windows
+
+
 def process_incoming(ds, **kwargs):
+    """
+    :returns: run_id of the window opened by this run (-> xcom for flush_owned_window) or None
+    """
     import shutil
-    import errno
-    import pydicom
     import glob
-    import json
-    import time
-    import os
-    import logging
-    import traceback
-    import uuid
+    from airflow.models import Variable
 
-    from airflow.api.common.experimental.trigger_dag import trigger_dag as trigger
+    batch_size = int(Variable.get("incoming_dcm_batch_size", default_var=DEFAULT_BATCH_SIZE))
+    max_latency = get_max_latency()
 
     def check_all_files_arrived(dcm_path):
         if not os.path.isdir(dcm_path):
@@ -46,37 +152,54 @@ def process_incoming(ds, **kwargs):
         dcm_files = sorted(glob.glob(dcm_path+"/*.dcm*"))
         return dcm_files
 
-    def trigger_it(dag_id, dcm_path, series_uid):
-        dag_run_id = generate_run_id(dag_id)
-
-        target = os.path.join("/data", dag_run_id, "batch", series_uid, 'extract-metadata-input')
-        print("MOVE!")
-        print("SRC: {}".format(dcm_path))
-        print("TARGET: {}".format(target))
-        shutil.move(dcm_path, target)
-
-        print(("TRIGGERING! DAG-ID: %s RUN_ID: %s" % (dag_id, dag_run_id)))
-        trigger(dag_id=dag_id, run_id=dag_run_id, replace_microseconds=False)
-
     dicom_path = kwargs['dag_run'].conf.get('dicom_path')
-    patient_id = kwargs['dag_run'].conf.get('patientID')
-    study_id = kwargs['dag_run'].conf.get('studyInstanceUID')
     series_uid = kwargs['dag_run'].conf.get('seriesInstanceUID')
-    callingAET = kwargs['dag_run'].conf.get('callingAET')
-    calledAET = kwargs['dag_run'].conf.get('calledAET')
 
     dcm_path = os.path.join("/ctpinput", dicom_path)
     print(("Dicom-path: %s" % dcm_path))
+    check_all_files_arrived(dcm_path)
 
-    dcm_files = check_all_files_arrived(dcm_path)
-    incoming_dcm = pydicom.dcmread(dcm_files[0])
-    # @all images
-    trigger_it(dag_id="service-extract-metadata", dcm_path=dcm_path, series_uid=series_uid)
+    owned_window = None
+    with staging_lock():
+        closed_windows = flush_overdue_windows(max_latency)
+        window = get_current_window()
+        if window is None:
+            window = owned_window = open_window()
+
+        if stage_series(window, dcm_path, series_uid) >= batch_size:
+            closed_windows.append(close_window(window))
+
+    for window in closed_windows:
+        trigger_it(window)
 
-    import shutil
     print(("Deleting temp data: %s" % dcm_path))
     shutil.rmtree(dcm_path, ignore_errors=True)
 
+    if owned_window is not None and owned_window not in closed_windows:
+        return owned_window["run_id"]
+    return None
+
+
+def flush_owned_window(**kwargs):
+    """
+    Sensor of the run that opened a window: flushes it after max_latency, if it has not been filled up in the meantime.
+    :returns: True once there is nothing left to flush for this run
+    """
+    owned_run_id = kwargs['ti'].xcom_pull(task_ids='trigger_dags')
+    if owned_run_id is None:
+        return True
+
+    with staging_lock():
+        window = get_current_window()
+        if window is None or window["run_id"] != owned_run_id:
+            print("Window {} was already triggered".format(owned_run_id))
+            return True
+        if time.time() - window["opened"] < get_max_latency():
+            return False
+        close_window(window)
+    trigger_it(window)
+    return True
+
 
 run_this = PythonOperator(
     task_id='trigger_dags',
@@ -90,6 +213,22 @@ run_this = PythonOperator(
     python_callable=process_incoming,
     dag=dag)
 
+flush_window = PythonSensor(
+    task_id='flush_window',
+    provide_context=True,
+    pool='default_pool',
+    executor_config={
+        "cpu_millicores": 100,
+        "ram_mem_mb": 50,
+        "gpu_mem_mb": 0
+    },
+    python_callable=flush_owned_window,
+    # the executor slot is released between the pokes
+    mode='reschedule',
+    poke_interval=10,
+    timeout=60 * 60,
+    dag=dag)
+
 check_ctp = LocalCtpQuarantineCheckOperator(dag=dag)
 
-run_this >> check_ctp
+run_this >> [flush_window, check_ctp]
@@ -1,10 +1,12 @@
+import os
 from datetime import datetime
-from airflow.operators.python_operator import PythonOperator
+from airflow.operators.python_operator import PythonOperator, BranchPythonOperator
 from airflow.models import DAG
 from datetime import timedelta
 import pydicom
 from shutil import copyfile
 from airflow.utils.dates import days_ago
+from airflow.utils.trigger_rule import TriggerRule
 from kaapana.blueprints.kaapana_utils import generate_run_id
 from kaapana.blueprints.kaapana_global_variables import BATCH_NAME
 from kaapana.operators.LocalDeleteFromElasticOperator import LocalDeleteFromElasticOperator
@@ -28,47 +30,129 @@ dag = DAG(
 )
 
 
-def start_reindexing(ds, **kwargs):
-    import os
-    import glob
-    from airflow.api.common.experimental.trigger_dag import trigger_dag as trigger
-    from elasticsearch import Elasticsearch
+# series per service-extract-metadata run and threads reading the DICOM headers
+REINDEX_BATCH_SIZE = 200
+REINDEX_WORKERS = 8
 
-    pacs_data_dir = '/pacsdata'
-    workflowdata_dir = "/data/"
-    dag_id = "service-extract-metadata"
 
-    print("Start re-index")
+def get_checkpoint_file(run_id):
+    # the checkpoint lives in the run dir -> clearing the dag-run resumes, a new dag-run starts from scratch
+    return os.path.join("/data", run_id, "reindex-checkpoint.json")
 
-    dcm_dirs = []
-    file_list = glob.glob(pacs_data_dir+"/**/*", recursive=True)
-    for fi in file_list:
-        if os.path.isfile(fi):
-            dcm_dirs.append(os.path.dirname(fi))
-    dcm_dirs = list(set(dcm_dirs))
 
-    print("Files found: {}".format(len(file_list)))
-    print("Dcm dirs found: {}".format(len(dcm_dirs)))
-    for dcm_dir in dcm_dirs:
-        dag_run_id = generate_run_id(dag_id)
-        print("Run-id: {}".format(dag_run_id))
+def check_resume(ds, **kwargs):
+    # a resumed re-index must not delete the metadata of the series indexed before the checkpoint
+    if os.path.isfile(get_checkpoint_file(kwargs['dag_run'].run_id)):
+        print("Checkpoint found -> resuming without cleaning elasticsearch")
+        return [reindex_pacs.task_id]
+    return [clean_elasticsearch.task_id, reindex_pacs.task_id]
 
-        dcm_file = os.path.join(dcm_dir, os.listdir(dcm_dir)[0])
-        print("DIR: {}".format(dcm_dir))
-        print("dcm-file: {}".format(dcm_file))
-        incoming_dcm = pydicom.dcmread(dcm_file)
-        seriesUID = incoming_dcm.SeriesInstanceUID
 
-        target_dir = os.path.join(workflowdata_dir, dag_run_id, BATCH_NAME, "{}".format(seriesUID), 'extract-metadata-input')
-        print(target_dir)
+def iter_dcm_dirs(root_dir, resume_after=None):
+    """
+    Yields (dir_path, first_file_path) for every directory containing files, depth first with sorted names.
+    This order equals the order of the path parts, so all directories up to resume_after can be skipped without reading them.
+    """
+    resume_parts = tuple(os.path.relpath(resume_after, root_dir).split(os.sep)) if resume_after is not None else None
+    stack = [root_dir]
+    while stack:
+        dir_path = stack.pop()
+        dir_parts = tuple(os.path.relpath(dir_path, root_dir).split(os.sep)) if dir_path != root_dir else ()
+        files, sub_dirs = [], []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry.name)
 
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
+        if files and (resume_parts is None or dir_parts > resume_parts):
+            yield dir_path, os.path.join(dir_path, min(files))
 
+        for sub_dir in sorted(sub_dirs, reverse=True):
+            sub_dir_parts = dir_parts + (os.path.basename(sub_dir),)
+            # skip subtrees which were completely processed before the checkpoint
+            if resume_parts is not None and sub_dir_parts < resume_parts and resume_parts[:len(sub_dir_parts)] != sub_dir_parts:
+                continue
+            stack.append(sub_dir)
+
+
+def start_reindexing(ds, **kwargs):
+    import json
+    import itertools
+    from multiprocessing.pool import ThreadPool
+    from airflow.api.common.experimental.trigger_dag import trigger_dag as trigger
+
+    pacs_data_dir = '/pacsdata'
+    workflowdata_dir = "/data/"
+    dag_id = "service-extract-metadata"
+    checkpoint_file = get_checkpoint_file(kwargs['dag_run'].run_id)
+
+    def read_series_uid(dcm_dir_entry):
+        dcm_dir, dcm_file = dcm_dir_entry
+        try:
+            incoming_dcm = pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=["SeriesInstanceUID"])
+            return dcm_dir, dcm_file, str(incoming_dcm.SeriesInstanceUID)
+        except Exception as e:
+            print("Could not read {}: {}".format(dcm_file, e))
+            return dcm_dir, dcm_file, None
+
+    def copy_to_batch(dag_run_id, dcm_file, series_uid):
+        target_dir = os.path.join(workflowdata_dir, dag_run_id, BATCH_NAME, "{}".format(series_uid), 'extract-metadata-input')
+        os.makedirs(target_dir, exist_ok=True)
         copyfile(dcm_file, os.path.join(target_dir, os.path.basename(dcm_file)+".dcm"))
 
-        trigger(dag_id=dag_id, run_id=dag_run_id, replace_microseconds=False)
+    resume_after = None
+    if os.path.isfile(checkpoint_file):
+        with open(checkpoint_file) as f:
+            resume_after = json.load(f)["last_dir"]
+        print("Resuming re-index after: {}".format(resume_after))
+
+    print("Start re-index")
 
+    dir_count = 0
+    triggered_count = 0
+    dcm_dirs = iter_dcm_dirs(pacs_data_dir, resume_after=resume_after)
+    with ThreadPool(REINDEX_WORKERS) as threadpool:
+        while True:
+            dcm_dir_batch = list(itertools.islice(dcm_dirs, REINDEX_BATCH_SIZE))
+            if not dcm_dir_batch:
+                break
+            dir_count += len(dcm_dir_batch)
+
+            dag_run_id = generate_run_id(dag_id)
+            print("Run-id: {}".format(dag_run_id))
+            series_count = 0
+            for dcm_dir, dcm_file, series_uid in threadpool.imap(read_series_uid, dcm_dir_batch):
+                if series_uid is None:
+                    continue
+                copy_to_batch(dag_run_id, dcm_file, series_uid)
+                series_count += 1
+
+            if series_count > 0:
+                # one run with series_count batch elements -> metadata is pushed with one bulk request
+                trigger(dag_id=dag_id, run_id=dag_run_id, replace_microseconds=False)
+                triggered_count += 1
+
+            os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+            with open(checkpoint_file, "w") as f:
+                json.dump({"last_dir": dcm_dir_batch[-1][0]}, f)
+            print("Dcm dirs processed: {} - runs triggered: {}".format(dir_count, triggered_count))
+
+    print("Dcm dirs found: {}".format(dir_count))
+
+
+check_resume_from_checkpoint = BranchPythonOperator(
+    task_id='check-resume',
+    provide_context=True,
+    pool='default_pool',
+    executor_config={
+        "cpu_millicores": 100,
+        "ram_mem_mb": 50,
+        "gpu_mem_mb": 0
+    },
+    python_callable=check_resume,
+    dag=dag)
 
 clean_elasticsearch = LocalDeleteFromElasticOperator(dag=dag, operator_in_dir='extract-metadata-input', delete_all_documents=True)
 clean = LocalWorkflowCleanerOperator(dag=dag, clean_workflow_dir=True)
@@ -83,7 +167,10 @@ reindex_pacs = PythonOperator(
         "gpu_mem_mb": 0
     },
     python_callable=start_reindexing,
+    # clean_elasticsearch is skipped when resuming
+    trigger_rule=TriggerRule.NONE_FAILED,
     dag=dag)
 
 
-clean_elasticsearch >> reindex_pacs >> clean
+check_resume_from_checkpoint >> clean_elasticsearch >> reindex_pacs >> clean
+check_resume_from_checkpoint >> reindex_pacs
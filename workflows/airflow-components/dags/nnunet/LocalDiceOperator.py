@@ -3,7 +3,7 @@ import json
 import numpy as np
 import nibabel as nib
 from datetime import timedelta
-from multiprocessing.pool import ThreadPool
+from multiprocessing import Pool
 from glob import glob
 from os.path import join, basename, dirname, exists
 from pathlib import Path
@@ -13,6 +13,131 @@ import pandas as pd
 from kaapana.operators.KaapanaPythonBaseOperator import KaapanaPythonBaseOperator
 from matplotlib import rcParams
 rcParams.update({'figure.autolayout': True})
+
+# slices per np.bincount call -> bounds the temporary index array
+CHUNK_SLICES = 32
+
+
+def load_label_map(nifti_path):
+    """
+    Loads a label NIFTI in the smallest unsigned dtype of its label range (instead of get_fdata -> float64).
+    """
+    nifti = nib.load(nifti_path)
+    label_map = np.asanyarray(nifti.dataobj)
+    if label_map.dtype.kind == 'f':
+        label_map = np.rint(label_map)
+    max_label = int(label_map.max())
+    if label_map.min() < 0:
+        raise ValueError(f"Negative label in NIFTI: {nifti_path}")
+    label_map = label_map.astype(np.min_scalar_type(max_label), copy=False)
+    voxel_volume_ml = float(np.prod(nifti.header.get_zooms()[:3])) / 1000.0
+    return label_map, voxel_volume_ml
+
+
+def get_border(label_map):
+    """
+    Voxels with a differently labeled 6-neighbour.
+    """
+    border = np.zeros(label_map.shape, dtype=bool)
+    for axis in range(label_map.ndim):
+        front = [slice(None)] * label_map.ndim
+        back = [slice(None)] * label_map.ndim
+        front[axis] = slice(1, None)
+        back[axis] = slice(None, -1)
+        diff = label_map[tuple(front)] != label_map[tuple(back)]
+        border[tuple(front)] |= diff
+        border[tuple(back)] |= diff
+    return border
+
+
+def confusion_histogram(gt, pred, num_labels):
+    """
+    Joint label histogram of gt and pred in one pass: np.bincount over gt * num_labels + pred.
+    :returns: num_labels x num_labels matrix, rows -> gt label, cols -> pred label
+    """
+    histogram = np.zeros(num_labels * num_labels, dtype=np.int64)
+    index_dtype = np.min_scalar_type(num_labels * num_labels)
+    for start in range(0, gt.shape[0], CHUNK_SLICES):
+        gt_chunk = gt[start:start + CHUNK_SLICES].astype(index_dtype)
+        gt_chunk *= num_labels
+        gt_chunk += pred[start:start + CHUNK_SLICES]
+        histogram += np.bincount(gt_chunk.ravel(), minlength=num_labels * num_labels)
+    return histogram.reshape(num_labels, num_labels)
+
+
+def calc_metrics(gt, pred, gt_border, voxel_volume_ml, empty_score=1.0):
+    """
+    Dice, IoU, volumes and surface dice (at zero tolerance) of every label, derived from the confusion histogram
+    of the volumes and of their borders.
+    :returns: {label_int: {metric: value}} for every label present in pred
+    """
+    if pred.shape != gt.shape:
+        print("#")
+        print("##################################################")
+        print("#")
+        print("#################  ERROR  #######################")
+        print("#")
+        print("# ----> SHAPE MISMATCH!")
+        print(f"# gt:   {gt.shape}")
+        print(f"# pred: {pred.shape}")
+        print("#")
+        print("#")
+        print("##################################################")
+        print("#")
+        raise ValueError("Shape mismatch: pred and gt must have the same shape.")
+
+    num_labels = max(int(gt.max()), int(pred.max())) + 1
+    confusion = confusion_histogram(gt, pred, num_labels)
+    if confusion[:, 0].sum() == 0 or confusion[0, :].sum() == 0:
+        raise ValueError("Couldn't find a 'Clear Label' 0 in NIFTI!")
+
+    true_positive = np.diag(confusion)
+    gt_volume = confusion.sum(axis=1)
+    pred_volume = confusion.sum(axis=0)
+
+    # border voxels labeled the same in gt and pred -> diagonal of the border histogram
+    pred_border = get_border(pred)
+    gt_border_count = np.bincount(gt[gt_border], minlength=num_labels)
+    pred_border_count = np.bincount(pred[pred_border], minlength=num_labels)
+    same_border = pred_border & gt_border & (gt == pred)
+    same_border_count = np.bincount(pred[same_border], minlength=num_labels)
+
+    metrics = {}
+    for label in np.nonzero(pred_volume)[0]:
+        if label == 0:
+            continue
+        sum_volume = gt_volume[label] + pred_volume[label]
+        union = sum_volume - true_positive[label]
+        sum_border = gt_border_count[label] + pred_border_count[label]
+        metrics[int(label)] = {
+            "dice": 2. * true_positive[label] / sum_volume if sum_volume > 0 else empty_score,
+            "iou": true_positive[label] / union if union > 0 else empty_score,
+            "volume_gt_ml": float(gt_volume[label] * voxel_volume_ml),
+            "volume_pred_ml": float(pred_volume[label] * voxel_volume_ml),
+            "surface_dice": 2. * same_border_count[label] / sum_border if sum_border > 0 else empty_score
+        }
+    return metrics
+
+
+def evaluate_case(gt_file, pred_files):
+    """
+    Loads the gt once and evaluates every prediction of the case against it.
+    Runs inside the worker processes.
+    :param pred_files: [(model_id, pred_file)]
+    :returns: gt_file, {model_id: metrics}
+    """
+    print(f"# Loading gt-file: {gt_file}")
+    gt, voxel_volume_ml = load_label_map(gt_file)
+    gt_border = get_border(gt)
+    results = {}
+    for model_id, pred_file in pred_files:
+        print(f"# Evaluating {model_id}: {pred_file}")
+        pred, _ = load_label_map(pred_file)
+        results[model_id] = calc_metrics(gt=gt, pred=pred, gt_border=gt_border, voxel_volume_ml=voxel_volume_ml)
+        del pred
+    return gt_file, results
+
+
 class LocalDiceOperator(KaapanaPythonBaseOperator):
     def create_plots(self, result_dir, result_table):
         print(f"# Creating boxplots @: {result_dir}")
@@ -71,48 +196,22 @@ class LocalDiceOperator(KaapanaPythonBaseOperator):
 
         return labels, model_id
 
-    def prep_nifti(self, nifti_path):
-        nifti_numpy = nib.load(nifti_path).get_fdata().astype(int)
-        nifti_labels = list(np.unique(nifti_numpy))
-
-        if 0 in nifti_labels:
-            nifti_labels.remove(0)
-        else:
-            print("#")
-            print(f"# Couldn't find a 'Clear Label' 0 in NIFTI!")
-            print(f"# NIFTI-path: {nifti_path}")
-            print("#")
-            exit(1)
-
-        return nifti_numpy, nifti_labels
-
-    def calc_dice(self, pred, gt, empty_score=1.0):
-        pred = np.asarray(pred).astype(bool)
-        gt = np.asarray(gt).astype(bool)
-
-        if pred.shape != gt.shape:
-            print("#")
-            print("##################################################")
-            print("#")
-            print("#################  ERROR  #######################")
-            print("#")
-            print("# ----> SHAPE MISMATCH!")
-            print(f"# gt:   {gt.shape}")
-            print(f"# pred: {pred.shape}")
-            print("#")
-            print("#")
-            print("##################################################")
-            print("#")
-            raise ValueError("Shape mismatch: pred and gt must have the same shape.")
-
-        im_sum = pred.sum() + gt.sum()
-        if im_sum == 0:
-            return empty_score
-
-        # Compute Dice coefficient
-        intersection = np.logical_and(pred, gt)
-
-        return 2. * intersection.sum() / im_sum
+    def get_label_key(self, labels, pred_label, model_id):
+        if labels == None:
+            return str(pred_label)
+        if str(pred_label) in labels:
+            return labels[str(pred_label)]
+        if model_id == "ensemble":
+            return str(pred_label)
+        print("##################################################")
+        print("#")
+        print("##################### INFO ######################")
+        print("#")
+        print(f"# predicted label {pred_label} can't be found!")
+        print(f"# labels: {labels}")
+        print("#")
+        print("##################################################")
+        return None
 
     def start(self, ds, **kwargs):
         print("# Evaluating predictions started ...")
@@ -123,6 +222,7 @@ class LocalDiceOperator(KaapanaPythonBaseOperator):
 
         result_scores_case_based = {}
         result_scores_model_based = {}
+        result_metrics = {}
         result_table = []
 
         run_dir = os.path.join(self.workflow_dir, kwargs['dag_run'].run_id)
@@ -134,7 +234,10 @@ class LocalDiceOperator(KaapanaPythonBaseOperator):
                 print(f"# pred: {self.ensemble_dir}")
                 exit(1)
 
-        batch_folders = [f for f in glob(os.path.join(run_dir, self.batch_name, '*'))]
+        # gt_file -> {"file_id", "pred_files": [(model_id, pred_file)]}, every case is evaluated by one worker
+        cases = {}
+        model_labels = {}
+        batch_folders = sorted([f for f in glob(os.path.join(run_dir, self.batch_name, '*'))])
         print("# Found {} batches".format(len(batch_folders)))
         for batch_element_dir in batch_folders:
             print(f"# processing batch-element: {batch_element_dir}")
@@ -144,121 +247,67 @@ class LocalDiceOperator(KaapanaPythonBaseOperator):
             if labels == None or model_id == None:
                 labels, model_id = self.get_model_infos(model_batch_dir=batch_element_dir)
             model_id = f"{model_id}_{model_counter}"
+            model_labels[model_id] = labels
 
             single_model_pred_files = sorted(glob(join(single_model_pred_dir, "*.nii*"), recursive=False))
             for single_model_pred_file in single_model_pred_files:
-                case_counter += 1
-                ensemble_already_processed = False
                 file_id = basename(single_model_pred_file).replace(".nii.gz", "")
-
                 gt_file = join(run_dir, "nnunet-cohort", file_id, self.gt_dir, basename(single_model_pred_file))
                 if not exists(gt_file):
                     print("# Could not find gt-file !")
                     print(f"# gt:   {gt_file}")
                     exit(1)
-                if self.anonymize:
-                    if file_id not in self.anonymize_lookup_table:
-                        self.anonymize_lookup_table[file_id] = f"case_{case_counter}"
-                    file_id = self.anonymize_lookup_table[file_id]
-
-                # result_scores_sm[model_id][file_id]["gt_file"] = gt_file
-                # result_scores_sm[model_id][file_id]["pred_file"] = single_model_pred_file
-                print(f"# Loading gt-file: {gt_file}")
-                gt_numpy, gt_labels = self.prep_nifti(gt_file)
-                print(f"# Loading model-file: {single_model_pred_file}")
-                sm_numpy, sm_labels = self.prep_nifti(single_model_pred_file)
-                print("#")
-                print(f"# gt_labels:   {gt_labels}")
-                print(f"# pred_labels: {sm_labels}")
-                print("#")
 
-                print(f"# Loading labels...")
-                for pred_label in sm_labels:
-                    print(f"# label: {pred_label}")
-                    label_key = labels[str(pred_label)] if labels != None and str(pred_label) in labels else None
-                    print(f"# label_key: {label_key}")
-                    if label_key == None and labels != None:
-                        print("##################################################")
-                        print("#")
-                        print("##################### INFO ######################")
-                        print("#")
-                        print(f"# predicted label {pred_label}: {label_key} can't be found!")
-                        print(f"# labels: {labels}")
-                        print("#")
-                        print("##################################################")
-                        # assert pred_label in gt_labels
-                    else:
-                        label_strip_gt = (gt_numpy == pred_label).astype(int)
-                        label_strip_sm = (sm_numpy == pred_label).astype(int)
-                        dice_result = self.calc_dice(pred=label_strip_sm, gt=label_strip_gt)
-
-                        print(f"# Adding dataset: {file_id}/{model_id}/{label_key}/{dice_result}")
-                        result_table.append([
-                            file_id,
-                            model_id,
-                            label_key,
-                            dice_result
-                        ])
-
-                        if model_id not in result_scores_model_based:
-                            result_scores_model_based[model_id] = {}
-                        if label_key not in result_scores_model_based[model_id]:
-                            result_scores_model_based[model_id][label_key] = {}
-                        result_scores_model_based[model_id][label_key][file_id] = dice_result
-
-                        if file_id not in result_scores_case_based:
-                            result_scores_case_based[file_id] = {}
-                        if label_key not in result_scores_case_based[file_id]:
-                            result_scores_case_based[file_id][label_key] = {}
-                        result_scores_case_based[file_id][label_key][model_id] = dice_result
-
-                        # print(f"# {str(pred_label)}:{label_key} -> dice: {dice_result}")
-                        if "ensemble" in result_scores_case_based[file_id][label_key]:
-                            ensemble_already_processed = True
-                print("#")
-
-                ensemble_numyp = None
-                ensemble_labels = None
-                if self.ensemble_dir != None and not ensemble_already_processed:
-                    print("# Ensemble prediction...")
-                    print("#")
-                    ensemble_file = join(self.ensemble_dir, basename(single_model_pred_file))
-                    ensemble_numyp, ensemble_labels = self.prep_nifti(ensemble_file)
-                    model_id_ensemble = "ensemble"
-                    for pred_label in ensemble_labels:
-                        label_key = labels[str(pred_label)] if str(pred_label) in labels else str(pred_label)
-                        if label_key == None and labels != None:
-                            print("##################################################")
-                            print("#")
-                            print("##################### INFO ######################")
-                            print("#")
-                            print(f"# predicted label {pred_label}: {label_key} can't be found!")
-                            print(f"# labels: {labels}")
-                            print("#")
-                            print("##################################################")
-                            # assert pred_label in gt_labels
-                        else:
-                            label_strip_gt = (gt_numpy == pred_label).astype(int)
-                            label_strip_ensemble = (ensemble_numyp == pred_label).astype(int)
-                            dice_result = self.calc_dice(pred=label_strip_ensemble, gt=label_strip_gt)
-                            # print(f"# {str(pred_label)}:{label_key} -> dice: {dice_result}")
-                            print(f"# Adding ensemble: {file_id}/{model_id_ensemble}/{label_key}/{dice_result}")
+                if gt_file not in cases:
+                    case_counter += 1
+                    if self.anonymize:
+                        if file_id not in self.anonymize_lookup_table:
+                            self.anonymize_lookup_table[file_id] = f"case_{case_counter}"
+                        file_id = self.anonymize_lookup_table[file_id]
+                    cases[gt_file] = {"file_id": file_id, "pred_files": []}
+                    if self.ensemble_dir != None:
+                        cases[gt_file]["pred_files"].append(("ensemble", join(self.ensemble_dir, basename(single_model_pred_file))))
+                cases[gt_file]["pred_files"].append((model_id, single_model_pred_file))
+
+        model_labels["ensemble"] = next(iter(model_labels.values()), None)
+
+        print(f"# Evaluating {len(cases)} cases with {self.parallel_processes} processes")
+        evaluation_jobs = [(gt_file, case["pred_files"]) for gt_file, case in cases.items()]
+        with Pool(self.parallel_processes) as pool:
+            try:
+                for gt_file, case_results in pool.starmap(evaluate_case, evaluation_jobs, chunksize=1):
+                    file_id = cases[gt_file]["file_id"]
+                    for model_id, label_metrics in case_results.items():
+                        print(f"# {file_id}/{model_id} pred_labels: {list(label_metrics.keys())}")
+                        for pred_label, metrics in label_metrics.items():
+                            label_key = self.get_label_key(labels=model_labels[model_id], pred_label=pred_label, model_id=model_id)
+                            if label_key == None:
+                                continue
+                            dice_result = metrics["dice"]
+                            print(f"# Adding dataset: {file_id}/{model_id}/{label_key}/{dice_result}")
                             result_table.append([
                                 file_id,
-                                model_id_ensemble,
+                                model_id,
                                 label_key,
                                 dice_result
                             ])
 
-                            if file_id not in result_scores_case_based:
-                                result_scores_case_based[file_id] = {}
-                            if label_key not in result_scores_case_based[file_id]:
-                                result_scores_case_based[file_id][label_key] = {}
-                            result_scores_case_based[file_id][label_key][model_id_ensemble] = dice_result
-                    print("#")
-
-                processed_count += 1
+                            if model_id != "ensemble":
+                                result_scores_model_based.setdefault(model_id, {}).setdefault(label_key, {})[file_id] = dice_result
+                            result_scores_case_based.setdefault(file_id, {}).setdefault(label_key, {})[model_id] = dice_result
+                            result_metrics.setdefault(file_id, {}).setdefault(label_key, {})[model_id] = metrics
+                        processed_count += 1
+            except ValueError as e:
+                print("#")
                 print("##################################################")
+                print("#")
+                print("#################  ERROR  #######################")
+                print("#")
+                print(f"# ----> {e}")
+                print("#")
+                print("##################################################")
+                print("#")
+                exit(1)
 
         print("# ")
         print("# RESULTS: ")
@@ -280,6 +329,10 @@ class LocalDiceOperator(KaapanaPythonBaseOperator):
         with open(result_ensemble_path, 'w+', encoding='utf-8') as f:
             json.dump(result_scores_model_based, f, ensure_ascii=False, default=str, indent=4, sort_keys=True)
 
+        result_metrics_path = os.path.join(result_dir, "results_metrics.json")
+        with open(result_metrics_path, 'w+', encoding='utf-8') as f:
+            json.dump(result_metrics, f, ensure_ascii=False, default=str, indent=4, sort_keys=True)
+
         self.create_plots(result_dir=result_dir, result_table=result_table)
 
         if processed_count == 0:
@@ -303,12 +356,14 @@ class LocalDiceOperator(KaapanaPythonBaseOperator):
                  batch_name=None,
                  workflow_dir=None,
                  anonymize=True,
+                 parallel_processes=3,
                  *args,
                  **kwargs):
 
         self.gt_dir = gt_operator.operator_out_dir
         self.ensemble_dir = ensemble_operator.operator_out_dir if ensemble_operator != None else None
         self.anonymize = anonymize
+        self.parallel_processes = parallel_processes
 
         super().__init__(
             dag,
@@ -0,0 +1,34 @@
+from datetime import timedelta
+from kaapana.operators.KaapanaPythonBaseOperator import KaapanaPythonBaseOperator
+from nnunet.getTasks import update_task_index
+
+
+class LocalUpdateTaskIndexOperator(KaapanaPythonBaseOperator):
+    """
+    Updates the index of the installed nnUNet tasks after a model has been installed or removed,
+    so the next parse of the nnUNet DAGs doesn't have to scan the models.
+    """
+
+    def start(self, ds, **kwargs):
+        print("# Updating nnUNet task index ...")
+        task_index = update_task_index(force=self.force)
+        for model, indexed_model in sorted(task_index["models"].items()):
+            print(f"# {model}: {sorted(indexed_model['tasks'].keys())}")
+        print("# DONE")
+
+    def __init__(self,
+                 dag,
+                 force=False,
+                 *args,
+                 **kwargs):
+
+        self.force = force
+
+        super().__init__(
+            dag,
+            name="update-task-index",
+            python_callable=self.start,
+            execution_timeout=timedelta(minutes=10),
+            *args,
+            **kwargs
+        )
@@ -1,15 +1,24 @@
 import json
 import os
 from glob import glob
-from os.path import join, basename, dirname, normpath, exists
+from os.path import join, basename, exists
 
+# index of the installed tasks next to the models, see update_task_index
+TASK_INDEX_NAME = ".task-index.json"
+TASK_INDEX_VERSION = 2
 
-def get_dataset_json(model_path, installed_task):
-    dataset_json_path = join(model_path, installed_task, "**", "dataset.json")
-    dataset_json_path = glob(dataset_json_path, recursive=True)
+
+def find_dataset_json(model_path, installed_task):
+    dataset_json_path = glob(join(model_path, installed_task, "**", "dataset.json"), recursive=True)
     if len(dataset_json_path) > 0 and exists(dataset_json_path[-1]):
-        dataset_json_path = dataset_json_path[-1]
         print(f"Found dataset.json at {dataset_json_path[-1]}")
+        return dataset_json_path[-1]
+    return None
+
+
+def get_dataset_json(model_path, installed_task, dataset_json_path=None):
+    dataset_json_path = dataset_json_path or find_dataset_json(model_path=model_path, installed_task=installed_task)
+    if dataset_json_path is not None:
         with open(dataset_json_path) as f:
             dataset_json = json.load(f)
     else:
@@ -53,30 +62,116 @@ def get_available_pretrained_tasks(af_home_path):
     available_pretrained_task_names = [*{k: v for (k, v) in tasks.items() if "supported" in tasks[k] and tasks[k]["supported"]}]
     return tasks, available_pretrained_task_names
 
+def get_task_info(model_path, installed_task, dataset_json_path=None):
+    dataset_json = get_dataset_json(model_path=model_path, installed_task=installed_task, dataset_json_path=dataset_json_path)
+    return {
+        "description": dataset_json["description"] if "description" in dataset_json else "N/A",
+        "input-mode": dataset_json["input-mode"] if "input-mode" in dataset_json else "all",
+        "input": dataset_json["input"],
+        "body_part": dataset_json["body_part"] if "body_part" in dataset_json else "N/A",
+        "targets": dataset_json["targets"],
+        "supported": True,
+        "info": dataset_json["info"] if "info" in dataset_json else "N/A",
+        "url": dataset_json["url"] if "url" in dataset_json else "N/A",
+        "task_url": dataset_json["task_url"] if "task_url" in dataset_json else "N/A"
+    }
+
+
+def load_task_index(installed_models_path):
+    try:
+        with open(join(installed_models_path, TASK_INDEX_NAME)) as f:
+            task_index = json.load(f)
+        if task_index.get("version") == TASK_INDEX_VERSION:
+            return task_index
+    except (OSError, ValueError):
+        pass
+    return {"version": TASK_INDEX_VERSION, "models": {}}
+
+
+def save_task_index(installed_models_path, task_index):
+    # the scheduler may only have read access to the models -> the index is then rebuilt in memory on every parse
+    index_path = join(installed_models_path, TASK_INDEX_NAME)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump(task_index, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f"Could not write task index {index_path}: {e}")
+
+
+def get_mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def index_task(model_path, installed_task, task_mtime):
+    print(f"Indexing nnUNet task {basename(model_path)}/{installed_task}")
+    dataset_json_path = find_dataset_json(model_path=model_path, installed_task=installed_task)
+    return {
+        "mtime_ns": task_mtime,
+        "dataset_json": dataset_json_path,
+        "dataset_json_mtime_ns": get_mtime_ns(dataset_json_path) if dataset_json_path is not None else None,
+        "info": get_task_info(model_path=model_path, installed_task=installed_task, dataset_json_path=dataset_json_path)
+    }
+
+
+def is_task_up_to_date(indexed_task, task_mtime):
+    # the dataset.json is nested in the task dir -> its own mtime is checked, the task dir mtime doesn't change with it.
+    # Tasks without a dataset.json are searched again, it may not have been extracted yet.
+    if indexed_task is None or indexed_task["mtime_ns"] != task_mtime or indexed_task["dataset_json"] is None:
+        return False
+    return get_mtime_ns(indexed_task["dataset_json"]) == indexed_task["dataset_json_mtime_ns"]
+
+
+def update_task_index(installed_models_path=None, force=False):
+    """
+    Task index: {"models": {model: {"tasks": {task: {"mtime_ns": .., "dataset_json": .., "dataset_json_mtime_ns": .., "info": {..}}}}}}
+    A task is only scanned again if its directory or its dataset.json changed since the last update
+    or no dataset.json has been found yet, the dataset.json of all other tasks is taken from the index.
+    :returns: task index
+    """
+    installed_models_path = installed_models_path or join("/models", "nnUNet")
+    task_index = load_task_index(installed_models_path) if not force else {"version": TASK_INDEX_VERSION, "models": {}}
+    models = {}
+    changed = force
+    for model_entry in os.scandir(installed_models_path):
+        if not model_entry.is_dir() or "ensembles" in model_entry.name:
+            continue
+        indexed_tasks = task_index["models"].get(model_entry.name, {}).get("tasks", {})
+        tasks = {}
+        for task_entry in os.scandir(model_entry.path):
+            if not task_entry.is_dir():
+                continue
+            task_mtime = task_entry.stat().st_mtime_ns
+            indexed_task = indexed_tasks.get(task_entry.name)
+            if is_task_up_to_date(indexed_task, task_mtime):
+                tasks[task_entry.name] = indexed_task
+            else:
+                tasks[task_entry.name] = index_task(model_path=model_entry.path, installed_task=task_entry.name, task_mtime=task_mtime)
+                changed = changed or tasks[task_entry.name] != indexed_task
+        if tasks.keys() != indexed_tasks.keys():
+            changed = True
+        models[model_entry.name] = {"tasks": tasks}
+
+    if changed or models.keys() != task_index["models"].keys():
+        task_index["models"] = models
+        save_task_index(installed_models_path, task_index)
+    return task_index
+
+
 def get_installed_tasks(af_home_path):
     installed_tasks = {}
     installed_models_path = join("/models", "nnUNet")
     if not exists(installed_models_path):
         return installed_tasks
-    installed_models = [basename(normpath(f.path)) for f in os.scandir(installed_models_path) if f.is_dir() and "ensembles" not in f.name]
-    for installed_model in installed_models:
-        model_path = join(installed_models_path, installed_model)
-        installed_tasks_dirs = [basename(normpath(f.path)) for f in os.scandir(model_path) if f.is_dir()]
-        for installed_task in installed_tasks_dirs:
+    task_index = update_task_index(installed_models_path)
+    for installed_model in sorted(task_index["models"].keys()):
+        for installed_task, indexed_task in task_index["models"][installed_model]["tasks"].items():
             if installed_task not in installed_tasks:
-                dataset_json = get_dataset_json(model_path=model_path, installed_task=installed_task)
-                installed_tasks[installed_task] = {
-                    "description": dataset_json["description"] if "description" in dataset_json else "N/A",
-                    "model": [],
-                    "input-mode": dataset_json["input-mode"] if "input-mode" in dataset_json else "all",
-                    "input": dataset_json["input"],
-                    "body_part": dataset_json["body_part"] if "body_part" in dataset_json else "N/A",
-                    "targets": dataset_json["targets"],
-                    "supported": True,
-                    "info": dataset_json["info"] if "info" in dataset_json else "N/A",
-                    "url": dataset_json["url"] if "url" in dataset_json else "N/A",
-                    "task_url": dataset_json["task_url"] if "task_url" in dataset_json else "N/A"
-                }
+                installed_tasks[installed_task] = {"model": [], **indexed_task["info"]}
             if installed_model not in installed_tasks[installed_task]["model"]:
                 installed_tasks[installed_task]["model"].append(installed_model)
                 installed_tasks[installed_task]["model"].sort()
@@ -1,5 +1,5 @@
 from flask import g, Blueprint, request, jsonify, Response, url_for
-from sqlalchemy import and_
+from sqlalchemy import and_, func
 from sqlalchemy.orm.exc import NoResultFound
 from datetime import datetime
 import airflow.api
@@ -21,50 +21,17 @@ import time
 from kaapana.blueprints.kaapana_utils import generate_run_id
 from kaapana.blueprints.kaapana_utils import generate_minio_credentials
 from airflow.api.common.experimental.trigger_dag import trigger_dag as trigger
-from kaapana.operators.HelperElasticsearch import HelperElasticsearch
 from flask import current_app as app
-from multiprocessing.pool import ThreadPool
 
 _log = LoggingMixin().log
-parallel_processes = 1
+# DAG creating the DagRuns of a meta-trigger with single_execution (see LocalBulkTriggerOperator)
+bulk_trigger_dag_id = "service-bulk-trigger"
 """
 Represents a blueprint kaapanaApi
 """
 kaapanaApi = Blueprint('kaapana', __name__, url_prefix='/kaapana')
 
 
-def async_dag_trigger(queue_entry):
-    hit, dag_id, tmp_conf = queue_entry
-    hit = hit["_source"]
-    studyUID = hit[HelperElasticsearch.study_uid_tag]
-    seriesUID = hit[HelperElasticsearch.series_uid_tag]
-    SOPInstanceUID = hit[HelperElasticsearch.SOPInstanceUID_tag]
-    modality = hit[HelperElasticsearch.modality_tag]
-
-    print(f"# Triggering {dag_id} - series: {seriesUID}")
-
-    conf = {
-        "inputs": [
-            {
-                "dcm-uid": {
-                    "study-uid": studyUID,
-                    "series-uid": seriesUID,
-                    "modality": modality
-                }
-            }
-        ],
-        "conf": tmp_conf
-    }
-
-    dag_run_id = generate_run_id(dag_id)
-    try:
-        result = trigger(dag_id=dag_id, run_id=dag_run_id, conf=conf, replace_microseconds=False)
-    except Exception as e:
-        pass
-
-    return seriesUID, result
-
-
 @csrf.exempt
 @kaapanaApi.route('/api/trigger/<string:dag_id>', methods=['POST'])
 def trigger_dag(dag_id):
@@ -85,7 +52,7 @@ def trigger_dag(dag_id):
         index = tmp_conf["index"]
         dag_id = tmp_conf["dag"]
         form_data = tmp_conf["form_data"]
-        cohort_limit = int(tmp_conf["cohort_limit"] if "cohort_limit" in tmp_conf else None)
+        cohort_limit = int(tmp_conf["cohort_limit"]) if tmp_conf.get("cohort_limit") is not None else None
         single_execution = True if "single_execution" in form_data and form_data["single_execution"] else False
 
         print(f"query: {query}")
@@ -94,22 +61,22 @@ def trigger_dag(dag_id):
         print(f"single_execution: {single_execution}")
 
         if single_execution:
-            hits = HelperElasticsearch.get_query_cohort(elastic_query=query, elastic_index=index)
-            if hits is None:
-                message = ["Error in HelperElasticsearch: {}!".format(dag_id)]
-                response = jsonify(message=message)
-                response.status_code = 500
-                return response
-
-            hits = hits[:cohort_limit] if cohort_limit is not None else hits
-
-            queue = []
-            for hit in hits:
-                queue.append((hit, dag_id, tmp_conf))
+            # One DagRun per series: created in batches by the service-bulk-trigger DAG, its run_id is the job_id
+            job_id = generate_run_id(dag_id)
+            trigger(dag_id=bulk_trigger_dag_id, run_id=job_id, conf={
+                "bulk_trigger": {
+                    "dag_id": dag_id,
+                    "query": query,
+                    "index": index,
+                    "conf": tmp_conf,
+                    "cohort_limit": cohort_limit
+                }
+            }, replace_microseconds=False)
 
-            trigger_results = ThreadPool(parallel_processes).imap_unordered(async_dag_trigger, queue)
-            for seriesUID, result in trigger_results:
-                print(f"#  Done: {seriesUID}:{result}")
+            message = ["{} triggered for each series!".format(dag_id)]
+            response = jsonify(message=message, job_id=job_id, status_url=url_for('kaapana.trigger_job_status', job_id=job_id))
+            response.status_code = HTTPStatus.ACCEPTED
+            return response
 
         else:
             conf = {
@@ -147,6 +114,32 @@ def trigger_dag(dag_id):
         return response
 
 
+@kaapanaApi.route('/api/trigger/jobs/<string:job_id>', methods=['GET'])
+@csrf.exempt
+def trigger_job_status(job_id):
+    session = settings.Session()
+    try:
+        job_run = session.query(DagRun).filter(and_(DagRun.dag_id == bulk_trigger_dag_id, DagRun.run_id == job_id)).one_or_none()
+        if job_run is None:
+            return Response('Trigger job {} does not exist'.format(job_id), HTTPStatus.NOT_FOUND)
+        dag_id = job_run.conf["bulk_trigger"]["dag_id"]
+        dag_run_states = session.query(DagRun.state, func.count(DagRun.id)).filter(
+            and_(DagRun.dag_id == dag_id, DagRun.run_id.like(f"{job_id}-%"))).group_by(DagRun.state).all()
+    finally:
+        session.close()
+
+    dag_run_states = dict(dag_run_states)
+    return jsonify(
+        job_id=job_id,
+        dag_id=dag_id,
+        state=job_run.state,
+        created=sum(dag_run_states.values()),
+        start_date=job_run.start_date.isoformat() if job_run.start_date else None,
+        end_date=job_run.end_date.isoformat() if job_run.end_date else None,
+        dag_run_states=dag_run_states
+    )
+
+
 @kaapanaApi.route('/api/getdagruns', methods=['GET'])
 @csrf.exempt
 def getAllDagRuns():
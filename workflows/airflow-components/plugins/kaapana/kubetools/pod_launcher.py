@@ -27,6 +27,7 @@ from airflow import AirflowException
 from requests.exceptions import HTTPError
 from kaapana.kubetools.kube_client import get_kube_client
 from kaapana.kubetools.pod_stopper import PodStopper
+from kaapana.kubetools.pod_watcher import PodWatcher
 
 # NONE = None
 # REMOVED = "removed"
@@ -68,12 +69,30 @@ class PodLauncher(LoggingMixin):
     pod_stopper = PodStopper()
 
     def __init__(self, kube_client=None, in_cluster=True, cluster_context=None,
-                 extract_xcom=False):
+                 extract_xcom=False, use_pod_watcher=True):
         super(PodLauncher, self).__init__()
         self._client, self._batch_client, self._extensions_client = kube_client or get_kube_client(in_cluster=in_cluster,
                                                                                                    cluster_context=cluster_context)
         self._watch = watch.Watch()
         self.extract_xcom = extract_xcom
+        self.use_pod_watcher = use_pod_watcher
+        self._pod_watcher = None
+
+    def _get_pod_watcher(self, pod):
+        # the watcher only tracks plain pods - jobs are still polled
+        if self.use_pod_watcher and pod.kind == "Pod":
+            return PodWatcher(kube_client=self._client, namespace=pod.namespace, pod_name=pod.name)
+        return None
+
+    def wait_for_pod_update(self, pod, timeout):
+        """
+        Waits for the next event of the pod's watch stream (at most timeout seconds).
+        Without a watcher this is the former polling interval.
+        """
+        if self._pod_watcher is not None:
+            self._pod_watcher.wait_for_change(timeout)
+        else:
+            time.sleep(timeout)
 
     def run_pod_async(self, pod):
         req = pod.get_kube_object()
@@ -98,6 +117,15 @@ class PodLauncher(LoggingMixin):
             startup_timeout (int): Timeout for startup of the pod (if pod is pending for
              too long, considers task a failure
         """
+        self._pod_watcher = self._get_pod_watcher(pod)
+        try:
+            return self._run_pod(pod, startup_timeout=startup_timeout, get_logs=get_logs)
+        finally:
+            if self._pod_watcher is not None:
+                self._pod_watcher.stop()
+                self._pod_watcher = None
+
+    def _run_pod(self, pod, startup_timeout, get_logs):
         resp = self.run_pod_async(pod)
         curr_time = dt.now()
 
@@ -149,7 +177,7 @@ class PodLauncher(LoggingMixin):
                     break
                     # raise AirflowException("Pod took too long to start")
 
-                time.sleep(1)
+                self.wait_for_pod_update(pod, timeout=1)
 
         if return_msg is None:
             return_msg = self._monitor_pod(pod, get_logs)
@@ -180,13 +208,13 @@ class PodLauncher(LoggingMixin):
             if self.extract_xcom:
                 while self.base_container_is_running(pod):
                     self.log.info('Container %s has state %s', pod.name, State.RUNNING)
-                    time.sleep(2)
+                    self.wait_for_pod_update(pod, timeout=2)
                 result = self._extract_xcom(pod)
                 self.log.info(result)
                 result = json.loads(result)
             while self.pod_is_running(pod):
                 self.log.debug('Pod %s has state %s', pod.name, State.RUNNING)
-                time.sleep(2)
+                self.wait_for_pod_update(pod, timeout=2)
             return (self._task_status(pod=pod, event=self.read_pod(pod)), result)
         except Exception as e:
             self.log.warn(f"################# ISSUE! Could not _monitor_pod: {pod}")
@@ -216,6 +244,10 @@ class PodLauncher(LoggingMixin):
     def read_pod(self, pod):
         try:
             if pod.kind == "Pod":
+                if self._pod_watcher is not None:
+                    cached_pod = self._pod_watcher.get_pod()
+                    if cached_pod is not None:
+                        return cached_pod
                 return self._client.read_namespaced_pod(pod.name, pod.namespace)
             elif pod.kind == "Job":
                 job_name = self._batch_client.read_namespaced_job(pod.name, pod.namespace).metadata._name
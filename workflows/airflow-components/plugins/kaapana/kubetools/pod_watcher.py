@@ -0,0 +1,111 @@
+import threading
+import time
+from airflow.utils.log.logging_mixin import LoggingMixin
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+
+class PodWatcher(LoggingMixin):
+    """
+    Watch stream of a single pod (field_selector metadata.name=<pod_name>) for one PodLauncher.
+    Every task process only receives the events of its own pod, no namespace wide list or watch is needed.
+    The latest pod object is cached and the waiting launcher is woken up on every change,
+    so it doesn't have to poll read_namespaced_pod.
+    A new stream starts without resourceVersion -> the api server sends the current state of the pod first.
+    It resumes from the last seen resourceVersion and starts over if that version expired (410).
+    While the stream is down the cache is not trusted and PodLauncher falls back to polling.
+    """
+    watch_timeout_seconds = 60
+    reconnect_delay = 2
+
+    def __init__(self, kube_client, namespace, pod_name):
+        super(PodWatcher, self).__init__()
+        self._client = kube_client
+        self.namespace = namespace
+        self.pod_name = pod_name
+        self.healthy = False
+
+        self._pod = None
+        self._condition = threading.Condition()
+        self._resource_version = None
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name=f"pod-watcher-{pod_name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._condition:
+            self.healthy = False
+            self._pod = None
+            self._condition.notify_all()
+
+    def get_pod(self):
+        """
+        :returns: cached pod object or None if the stream is down or no event has been received yet
+        """
+        with self._condition:
+            if not self.healthy:
+                return None
+            return self._pod
+
+    def wait_for_change(self, timeout):
+        """
+        Blocks until a new event of the pod arrives or timeout seconds passed.
+        Falls back to a plain sleep while the stream is down.
+        """
+        with self._condition:
+            if not self.healthy:
+                self._condition.wait(timeout)
+                return
+            last_pod = self._pod
+            self._condition.wait_for(lambda: self._pod is not last_pod or not self.healthy, timeout)
+
+    def _set_pod(self, pod_object, deleted=False):
+        with self._condition:
+            self._resource_version = pod_object.metadata.resource_version
+            self._pod = None if deleted else pod_object
+            self.healthy = True
+            self._condition.notify_all()
+
+    def _set_unhealthy(self):
+        with self._condition:
+            self.healthy = False
+            self._condition.notify_all()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                pod_watch = watch.Watch()
+                stream_kwargs = {
+                    "namespace": self.namespace,
+                    "field_selector": f"metadata.name={self.pod_name}",
+                    "timeout_seconds": PodWatcher.watch_timeout_seconds
+                }
+                if self._resource_version is not None:
+                    stream_kwargs["resource_version"] = self._resource_version
+                for event in pod_watch.stream(self._client.list_namespaced_pod, **stream_kwargs):
+                    if self._stopped.is_set():
+                        pod_watch.stop()
+                        break
+                    if event["type"] == "ERROR":
+                        # resourceVersion too old -> start over with the current state
+                        self.log.info("PodWatcher %s: watch error %s -> restart", self.pod_name, event["raw_object"])
+                        self._resource_version = None
+                        self._set_unhealthy()
+                        pod_watch.stop()
+                        break
+                    self._set_pod(event["object"], deleted=event["type"] == "DELETED")
+
+            except ApiException as e:
+                self.log.warning("PodWatcher %s: watch failed: %s", self.pod_name, e)
+                if e.status == 410:
+                    self._resource_version = None
+                self._set_unhealthy()
+                time.sleep(PodWatcher.reconnect_delay)
+
+            except Exception as e:
+                self.log.warning("PodWatcher %s: watch failed: %s", self.pod_name, e)
+                self._resource_version = None
+                self._set_unhealthy()
+                time.sleep(PodWatcher.reconnect_delay)
@@ -3,6 +3,8 @@ from pint import UnitRegistry
 from collections import defaultdict
 from datetime import datetime
 import os
+import threading
+import time
 from kaapana.kubetools.prometheus_query import get_node_memory, get_node_mem_percent, get_node_cpu, get_node_cpu_util_percent, get_node_gpu_infos
 from airflow.models import Variable
 from airflow.api.common.experimental import pool as pool_api
@@ -42,6 +44,16 @@ class NodeUtil():
     memory_available_limit = None
     gpu_memory_available = None
 
+    # utilization snapshot, refreshed in the background (see refresh_snapshot)
+    snapshot = None
+    snapshot_ttl = 5
+    snapshot_lock = threading.Lock()
+    refresh_thread = None
+    # (time, ram_mem_mb, cpu_millicores) of every TI queued by check_ti_scheduling
+    reservations = []
+    # seconds until the pod of a queued TI is created and its requests are part of the fetched allocations
+    pod_start_lag = 30
+
     @staticmethod
     def get_pool_by_name(name):
         try:
@@ -194,168 +206,222 @@ class NodeUtil():
             return False
 
     @staticmethod
-    def check_ti_scheduling(ti, logger):
-        if NodeUtil.ureg is None:
+    def init_util_helper(logger):
+        if logger != None:
+            logger.warning("Inititalize Util-Helper!")
+        NodeUtil.enable = Variable.get(key="util_scheduling", default_var=None)
+        if NodeUtil.enable == None:
+            Variable.set("util_scheduling", True)
+            NodeUtil.enable = 'True'
+
+        if logger != None:
+            logger.warning("-> init UnitRegistry...")
+        ureg = UnitRegistry()
+        units_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'kubernetes_units.txt')
+        if not os.path.isfile(units_file_path):
             if logger != None:
-                logger.warning("Inititalize Util-Helper!")
-            NodeUtil.enable = Variable.get(key="util_scheduling", default_var=None)
-            if NodeUtil.enable == None:
-                Variable.set("util_scheduling", True)
-                NodeUtil.enable = 'True'
+                logger.warning("Could not find kubernetes_units.txt @  {} !".format(units_file_path))
+                logger.warning("abort.")
+            exit(1)
+        else:
+            ureg.load_definitions(units_file_path)
+
+        def names(self, names):
+            self._names = names
+        V1ContainerImage.names = V1ContainerImage.names.setter(names)
+        k8s.config.load_incluster_config()
+        NodeUtil.core_v1 = k8s.client.CoreV1Api()
+        NodeUtil.ureg = ureg
 
+    @staticmethod
+    def refresh_snapshot(logger=None):
+        """
+        Fetches node/pod allocations, Prometheus utilization and the util-scheduling Variables
+        and publishes them as a new snapshot. Runs in the refresh thread, never inside the scheduler loop.
+        """
+        start = time.time()
+        enable = Variable.get(key="util_scheduling", default_var="True").lower() == "true"
+
+        default_cpu = 70
+        default_ram = 80
+        max_util_cpu = Variable.get(key="max_util_cpu", default_var=None)
+        max_util_ram = Variable.get(key="max_util_ram", default_var=None)
+        if max_util_cpu is None and max_util_ram is None:
+            Variable.set("max_util_cpu", default_cpu)
+            Variable.set("max_util_ram", default_ram)
+            max_util_cpu = default_cpu
+            max_util_ram = default_ram
+        NodeUtil.max_util_cpu = int(max_util_cpu)
+        NodeUtil.max_util_ram = int(max_util_ram)
+        NodeUtil.snapshot_ttl = float(Variable.get(key="util_snapshot_ttl", default_var=NodeUtil.snapshot_ttl))
+        NodeUtil.pod_start_lag = float(Variable.get(key="util_pod_start_lag", default_var=NodeUtil.pod_start_lag))
+
+        if not NodeUtil.compute_allocated_resources(logger=logger):
             if logger != None:
-                logger.warning("-> init UnitRegistry...")
-            NodeUtil.ureg = UnitRegistry()
-            units_file_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'kubernetes_units.txt')
-            if not os.path.isfile(units_file_path):
+                logger.warning("############################################# COULD NOT FETCH UTILIZATION!")
+            with NodeUtil.snapshot_lock:
+                NodeUtil.snapshot = None
+            return False
+
+        NodeUtil.cpu_percent = get_node_cpu_util_percent(logger=logger)
+        NodeUtil.mem_percent = get_node_mem_percent()
+        if NodeUtil.cpu_percent is not None:
+            Variable.set("CPU_PERCENT", "{}".format(NodeUtil.cpu_percent))
+        if NodeUtil.mem_percent is not None:
+            Variable.set("RAM_PERCENT", "{}".format(NodeUtil.mem_percent))
+
+        snapshot = {
+            # the allocations reflect the pods existing at the start of the refresh
+            "fetched": start,
+            "updated": time.time(),
+            "refresh_duration": time.time() - start,
+            "enable": enable,
+            "max_util_cpu": NodeUtil.max_util_cpu,
+            "max_util_ram": NodeUtil.max_util_ram,
+            "cpu_percent": NodeUtil.cpu_percent,
+            "mem_percent": NodeUtil.mem_percent,
+            "memory_pressure": NodeUtil.memory_pressure,
+            "disk_pressure": NodeUtil.disk_pressure,
+            "pid_pressure": NodeUtil.pid_pressure,
+            "memory_available_req": NodeUtil.memory_available_req,
+            "cpu_available_req": NodeUtil.cpu_available_req,
+        }
+        with NodeUtil.snapshot_lock:
+            NodeUtil.snapshot = snapshot
+        return True
+
+    @staticmethod
+    def refresh_loop(logger):
+        while True:
+            try:
+                NodeUtil.refresh_snapshot(logger=logger)
+            except Exception as e:
                 if logger != None:
-                    logger.warning("Could not find kubernetes_units.txt @  {} !".format(units_file_path))
-                    logger.warning("abort.")
-                exit(1)
-            else:
-                NodeUtil.ureg.load_definitions(units_file_path)
+                    logger.warning("############################################# Util-snapshot refresh failed: {}".format(e))
+                with NodeUtil.snapshot_lock:
+                    NodeUtil.snapshot = None
+            time.sleep(NodeUtil.snapshot_ttl)
+
+    @staticmethod
+    def ensure_refresh_thread(logger):
+        if NodeUtil.refresh_thread is not None:
+            return
+        if NodeUtil.ureg is None:
+            NodeUtil.init_util_helper(logger=logger)
+        # first snapshot synchronously -> the first scheduling loop already has data
+        try:
+            NodeUtil.refresh_snapshot(logger=logger)
+        except Exception as e:
+            if logger != None:
+                logger.warning("############################################# Util-snapshot refresh failed: {}".format(e))
+        NodeUtil.refresh_thread = threading.Thread(target=NodeUtil.refresh_loop, args=(logger,), name="util-snapshot", daemon=True)
+        NodeUtil.refresh_thread.start()
 
-            def names(self, names):
-                self._names = names
-            V1ContainerImage.names = V1ContainerImage.names.setter(names)
-            k8s.config.load_incluster_config()
-            NodeUtil.core_v1 = k8s.client.CoreV1Api()
+    @staticmethod
+    def start_scheduling_loop():
+        """
+        Called once per scheduler loop: reservations of queued TIs are only dropped once the current snapshot
+        was fetched more than pod_start_lag seconds after the reservation -> their pods are part of the allocations.
+        Until then the reserved resources are subtracted from every snapshot, so the same free capacity isn't handed out twice.
+        """
+        snapshot = NodeUtil.snapshot
+        if snapshot is None:
+            return
+        NodeUtil.reservations = [
+            reservation for reservation in NodeUtil.reservations
+            if snapshot["fetched"] <= reservation[0] + NodeUtil.pod_start_lag
+        ]
+
+    @staticmethod
+    def get_reserved_resources():
+        reserved_memory = sum(reservation[1] for reservation in NodeUtil.reservations)
+        reserved_cpu = sum(reservation[2] for reservation in NodeUtil.reservations)
+        return reserved_memory, reserved_cpu
+
+    @staticmethod
+    def get_snapshot_age():
+        snapshot = NodeUtil.snapshot
+        return None if snapshot is None else time.time() - snapshot["updated"]
 
-        NodeUtil.enable = True if Variable.get(key="util_scheduling", default_var=None).lower() == "true" else False
+    @staticmethod
+    def check_ti_scheduling(ti, logger):
+        """
+        Decides if ti fits onto the node based on the current utilization snapshot.
+        No I/O happens here - the snapshot is refreshed by a background thread every snapshot_ttl seconds.
+        """
+        NodeUtil.ensure_refresh_thread(logger=logger)
+        snapshot = NodeUtil.snapshot
+
+        if snapshot is None:
+            if logger != None:
+                logger.warning("############################################# COULD NOT FETCH UTILIZATION -> SKIPPING!")
+            return True
 
+        NodeUtil.enable = snapshot["enable"]
         if not NodeUtil.enable or ti == None:
-            NodeUtil.compute_allocated_resources(logger=logger)
             if logger != None:
                 logger.warning("Util-scheduler is disabled!!")
             return True
 
-        else:
-            config = ti.executor_config
-            if "ram_mem_mb" not in config:
-                if logger != None:
-                    logger.warning("Execuexecutor_config not found!")
-                    logger.warning(ti.operator)
-                    logger.warning(ti)
-                return False
-            default_cpu = 70
-            default_ram = 80
-            NodeUtil.max_util_cpu = Variable.get(key="max_util_cpu", default_var=None)
-            NodeUtil.max_util_ram = Variable.get(key="max_util_ram", default_var=None)
-            if NodeUtil.max_util_cpu is None and NodeUtil.max_util_ram is None:
-                Variable.set("max_util_cpu", default_cpu)
-                Variable.set("max_util_ram", default_ram)
-                NodeUtil.max_util_cpu = default_cpu
-                NodeUtil.max_util_ram = default_ram
-            else:
-                NodeUtil.max_util_cpu = int(NodeUtil.max_util_cpu)
-                NodeUtil.max_util_ram = int(NodeUtil.max_util_ram)
-
-            now = datetime.now()
-            if NodeUtil.last_update is None or (now - NodeUtil.last_update).seconds >= 3:
-                util_result = NodeUtil.compute_allocated_resources(logger=logger)
-                if not util_result:
-                    logger.warning("############################################# COULD NOT FETCH UTILIZATION -> SKIPPING!")
-                    return True
-
-            NodeUtil.cpu_percent = get_node_cpu_util_percent(logger=logger)
-            if NodeUtil.cpu_percent is None or NodeUtil.cpu_percent > NodeUtil.max_util_cpu:
-                if logger != None:
-                    logger.warning("############################################# High CPU utilization -> waiting!")
-                    logger.warning("############################################# cpu_percent: {}".format(NodeUtil.cpu_percent))
-                return False
-            Variable.set("CPU_PERCENT", "{}".format(NodeUtil.cpu_percent))
-
-            NodeUtil.mem_percent = get_node_mem_percent()
-            if NodeUtil.mem_percent is None or NodeUtil.mem_percent > NodeUtil.max_util_ram:
-                if logger != None:
-                    logger.warning("############################################# High RAM utilization -> waiting!")
-                    logger.warning("############################################# mem_percent: {}".format(NodeUtil.mem_percent))
-                return False
-            Variable.set("RAM_PERCENT", "{}".format(NodeUtil.mem_percent))
+        config = ti.executor_config
+        if "ram_mem_mb" not in config:
+            if logger != None:
+                logger.warning("Execuexecutor_config not found!")
+                logger.warning(ti.operator)
+                logger.warning(ti)
+            return False
 
-            if NodeUtil.memory_pressure:
-                if logger != None:
-                    logger.warning("##########################################################################################")
-                    logger.warning("#################################### Instable system! ####################################")
-                    logger.warning("##################################### memory_pressure ####################################")
-                    logger.warning("##########################################################################################")
-                return False
+        cpu_percent = snapshot["cpu_percent"]
+        if cpu_percent is None or cpu_percent > snapshot["max_util_cpu"]:
+            if logger != None:
+                logger.warning("############################################# High CPU utilization -> waiting!")
+                logger.warning("############################################# cpu_percent: {}".format(cpu_percent))
+            return False
 
-            if NodeUtil.disk_pressure:
-                if logger != None:
-                    logger.warning("##########################################################################################")
-                    logger.warning("#################################### Instable system! ####################################")
-                    logger.warning("##################################### disk_pressure ####################################")
-                    logger.warning("##########################################################################################")
-                return False
+        mem_percent = snapshot["mem_percent"]
+        if mem_percent is None or mem_percent > snapshot["max_util_ram"]:
+            if logger != None:
+                logger.warning("############################################# High RAM utilization -> waiting!")
+                logger.warning("############################################# mem_percent: {}".format(mem_percent))
+            return False
 
-            if NodeUtil.pid_pressure:
+        for pressure in ["memory_pressure", "disk_pressure", "pid_pressure"]:
+            if snapshot[pressure]:
                 if logger != None:
                     logger.warning("##########################################################################################")
                     logger.warning("#################################### Instable system! ####################################")
-                    logger.warning("##################################### pid_pressure ####################################")
+                    logger.warning("##################################### {} ####################################".format(pressure))
                     logger.warning("##########################################################################################")
                 return False
 
-            ti_ram_mem_mb = 0 if config["ram_mem_mb"] == None else config["ram_mem_mb"]
-            ti_cpu_millicores = 0 if config["cpu_millicores"] == None else config["cpu_millicores"]
-            # ti_gpu_mem_mb = 0 if config["gpu_mem_mb"] == None else config["gpu_mem_mb"]
+        ti_ram_mem_mb = 0 if config["ram_mem_mb"] == None else config["ram_mem_mb"]
+        ti_cpu_millicores = 0 if config["cpu_millicores"] == None else config["cpu_millicores"]
+        # ti_gpu_mem_mb = 0 if config["gpu_mem_mb"] == None else config["gpu_mem_mb"]
 
-            if ti_ram_mem_mb >= NodeUtil.memory_available_req:
-                if logger != None:
-                    # if ti_ram_mem_mb >= NodeUtil.memory_available_limit or ti_ram_mem_mb >= NodeUtil.memory_available_req:
-                    logger.warning("Not enough RAM -> not scheduling")
-                    logger.warning("MEM LIMIT: {}/{}".format(ti_ram_mem_mb, NodeUtil.memory_available_req))
-                    logger.warning("MEM REQ:   {}/{}".format(ti_ram_mem_mb, NodeUtil.memory_available_req))
-                return False
+        reserved_memory, reserved_cpu = NodeUtil.get_reserved_resources()
+        memory_available_req = snapshot["memory_available_req"] - reserved_memory
+        cpu_available_req = snapshot["cpu_available_req"] - reserved_cpu
 
-            if ti_cpu_millicores >= NodeUtil.cpu_available_req:
-                if logger != None:
-                    # if ti_cpu_millicores >= NodeUtil.cpu_available_limit or ti_cpu_millicores >= NodeUtil.cpu_available_req:
-                    logger.warning("Not enough CPU cores -> not scheduling")
-                    logger.warning("CPU LIMIT: {}/{}".format(ti_cpu_millicores, NodeUtil.cpu_available_req))
-                    logger.warning("CPU REQ:   {}/{}".format(ti_cpu_millicores, NodeUtil.cpu_available_req))
-                return False
-
-            # if ti_gpu_mem_mb > 0 and NodeUtil.gpu_dev_free <= 1:
-            #     logger.warning("All GPUs are in currently in use -> not scheduling")
-            #     return False
-
-            # if NodeUtil.gpu_memory_available is not None and ti_gpu_mem_mb > NodeUtil.gpu_memory_available:
-            #     logger.warning("Not enough GPU memory -> not scheduling")
-            #     logger.warning("GPU: {}/{}".format(ti_gpu_mem_mb, NodeUtil.gpu_memory_available))
-            #     return False
+        if ti_ram_mem_mb >= memory_available_req:
+            if logger != None:
+                logger.warning("Not enough RAM -> not scheduling")
+                logger.warning("MEM REQ:   {}/{}".format(ti_ram_mem_mb, memory_available_req))
+            return False
 
-            tmp_memory_available_req = int(NodeUtil.memory_available_req - ti_ram_mem_mb)
-            tmp_cpu_available_req = int(NodeUtil.cpu_available_req - ti_cpu_millicores)
-            # tmp_gpu_memory_available = int(NodeUtil.gpu_memory_available - ti_gpu_mem_mb)
+        if ti_cpu_millicores >= cpu_available_req:
+            if logger != None:
+                logger.warning("Not enough CPU cores -> not scheduling")
+                logger.warning("CPU REQ:   {}/{}".format(ti_cpu_millicores, cpu_available_req))
+            return False
 
-            if tmp_memory_available_req < 0 or tmp_cpu_available_req < 0:
-                if logger != None:
-                    logger.error("############################################################### Error!")
-                    logger.error("Detected negative resource availability!")
-                    logger.error("memory_available_req: {}".format(tmp_memory_available_req))
-                    logger.error("cpu_available_req: {}".format(tmp_cpu_available_req))
-                return False
+        # if ti_gpu_mem_mb > 0 and NodeUtil.gpu_dev_free <= 1:
+        #     logger.warning("All GPUs are in currently in use -> not scheduling")
+        #     return False
 
-            NodeUtil.memory_available_req = tmp_memory_available_req
-            NodeUtil.cpu_available_req = tmp_cpu_available_req
-            # NodeUtil.gpu_memory_available = tmp_gpu_memory_available
-            # NodeUtil.gpu_dev_free = max(0, NodeUtil.gpu_dev_free)
-            NodeUtil.mem_req = NodeUtil.mem_req + ti_ram_mem_mb
-            NodeUtil.mem_lmt = NodeUtil.mem_lmt + ti_ram_mem_mb
+        # reserved until a snapshot contains the pod of the TI (see start_scheduling_loop)
+        NodeUtil.reservations.append((time.time(), ti_ram_mem_mb, ti_cpu_millicores))
 
-            Variable.set("CPU_NODE", "{}/{}".format(NodeUtil.cpu_lmt, NodeUtil.cpu_alloc))
-            Variable.set("CPU_FREE", "{}".format(NodeUtil.cpu_available_req))
-            Variable.set("RAM_NODE", "{}/{}".format(NodeUtil.mem_req, NodeUtil.mem_alloc))
-            Variable.set("RAM_FREE", "{}".format(NodeUtil.memory_available_req))
-            # Variable.set("GPU_DEV_COUNT", "{}/{}".format(NodeUtil.gpu_dev_count))
-            # Variable.set("GPU_DEV_FREE", "{}".format(NodeUtil.gpu_dev_free))
-            # Variable.set("GPU_MEM", "{}/{}".format(NodeUtil.gpu_mem_used, NodeUtil.gpu_mem_alloc))
-            # Variable.set("GPU_MEM_FREE", "{}".format(NodeUtil.gpu_memory_available))
-            Variable.set("UPDATED", datetime.utcnow())
-
-            return True
+        return True
 
 
 def get_gpu_pool(task_instance, logger):
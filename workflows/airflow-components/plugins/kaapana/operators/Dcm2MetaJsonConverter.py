@@ -1,6 +1,10 @@
 import os
+import sys
+import glob
 import json
+import time
 import logging
+import traceback
 import pytz
 from dateutil import parser
 from datetime import datetime
@@ -10,7 +14,16 @@ class Dcm2MetaJsonConversionException(Exception):
 
 
 class Dcm2MetaJsonConverter:
-    
+    """
+    Converts DICOM-JSON (as produced by dcm2json or pydicom's to_json_dict) into the flat meta-json used by the meta-index.
+
+    The VR specific conversions are dispatched via the VR_HANDLERS table (see end of class).
+    The resulting output key and handler per (tag, vr) are resolved once and cached,
+    parsed DA/TM/DT values are cached as well since the same dates/times repeat on every instance of a series.
+    vr list: http://dicom.nema.org/dicom/2013/output/chtml/part05/sect_6.2.html
+    """
+    cache_size = 10000
+
     def __init__(self,
                 format_time : str = "%H:%M:%S.%f", 
                 format_date : str = "%Y-%m-%d", 
@@ -23,7 +36,8 @@ class Dcm2MetaJsonConverter:
         self.exit_on_error = exception_on_error
         self.log = logging.getLogger(__name__)
 
-        if not dict_path:
+        self.dict_path = dict_path
+        if not self.dict_path:
             if 'DICT_PATH' in os.environ:
                 self.dict_path = os.getenv('DICT_PATH')
             else:
@@ -32,6 +46,10 @@ class Dcm2MetaJsonConverter:
         with open(self.dict_path, encoding='utf-8') as dict_data:
             self.dictionary = json.load(dict_data)
 
+        # (tag, vr) -> (output key, handler)
+        self.tag_table = {}
+        # vr -> {value: converted value}
+        self.value_cache = {"DA": {}, "TM": {}, "DT": {}}
 
     def get_new_key(self, key):
         new_key = ""
@@ -44,8 +62,54 @@ class Dcm2MetaJsonConverter:
 
         return new_key
 
+    def get_tag_entry(self, key, vr):
+        """
+        Resolves output key and VR handler of a tag once -> the dictionary lookup (and its warning) is not repeated per value.
+        """
+        entry = self.tag_table.get((key, vr))
+        if entry is None:
+            suffix, handler = Dcm2MetaJsonConverter.VR_HANDLERS.get(vr, Dcm2MetaJsonConverter.DEFAULT_VR_HANDLER)
+            entry = (self.get_new_key(key) + suffix, handler)
+            self.tag_table[(key, vr)] = entry
+        return entry
+
+    def cached_convert(self, vr, value, convert_func):
+        cache = self.value_cache[vr]
+        if value in cache:
+            return cache[value]
+        result = convert_func(value)
+        if len(cache) >= Dcm2MetaJsonConverter.cache_size:
+            cache.clear()
+        cache[value] = result
+        return result
 
     def get_time(self, time_str):
+        """
+        Fast path for the plain TM formats (HHMMSS[.F], MMSS, SS), every other input is handled by parse_time.
+        """
+        try:
+            time_split = time_str.split(".")
+            if len(time_split) <= 2 and time_split[0].isdigit() and len(time_split[0]) in (2, 4, 6) \
+                    and (len(time_split) == 1 or time_split[1] == "" or (time_split[1].isdigit() and len(time_split[1]) <= 6)):
+                time_part = time_split[0]
+                fsec = int(time_split[1]) if len(time_split) == 2 and time_split[1] != "" else 0
+                hour = minute = 0
+                if len(time_part) == 6:
+                    hour = int(time_part[:2])
+                    minute = int(time_part[2:4])
+                    sec = int(time_part[4:6])
+                elif len(time_part) == 4:
+                    minute = int(time_part[:2])
+                    sec = int(time_part[2:4])
+                else:
+                    sec = int(time_part)
+                return datetime(1900, 1, 1, hour, minute, sec, fsec).strftime(self.format_time)
+        except (ValueError, AttributeError):
+            pass
+
+        return self.parse_time(time_str)
+
+    def parse_time(self, time_str):
         try:
             hour = 0
             minute = 0
@@ -89,6 +153,55 @@ class Dcm2MetaJsonConverter:
             if self.exit_on_error:
                 raise Dcm2MetaJsonConversionException()
 
+    def get_date(self, date_str):
+        """
+        Fast path for YYYYMMDD, every other input (e.g. the non-compliant YYYY.MM.DD) is handled by dateutil.
+        """
+        if len(date_str) == 8 and date_str.isdigit():
+            try:
+                return datetime(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:8])).strftime(self.format_date)
+            except ValueError:
+                pass
+        return parser.parse(date_str).strftime(self.format_date)
+
+    def get_date_time(self, value_str):
+        """
+        Returns the formatted UTC date-time or None if the value can't be interpreted as DT.
+        """
+        date_time_string = None
+
+        if len(value_str) == 21 and "." in value_str:
+            date_time_string = parser.parse(value_str.split(".")[0]).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+        elif len(value_str) == 8:
+            self.log.debug("DATE ONLY FOUND")
+            datestr_date = parser.parse(value_str).strftime("%Y%m%d")
+            datestr_time = parser.parse("01:00:00").strftime("%H:%M:%S")
+            date_time_string = datestr_date + " " + datestr_time
+
+        elif len(value_str) == 16:
+            self.log.debug("DATETIME FOUND")
+            datestr_date = str(value_str)[:8]
+            datestr_time = str(value_str)[8:]
+            datestr_date = parser.parse(datestr_date).strftime(self.format_date)
+            datestr_time = parser.parse(datestr_time).strftime(self.format_time)
+            date_time_string = datestr_date + " " + datestr_time
+
+        else:
+            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
+            self.log.warn("++++++++++++++++++++++++++++ No Datetime ++++++++++++++++++++++++++++")
+            self.log.warn("Value: {}".format(value_str))
+            self.log.warn("LEN: {}".format(len(value_str)))
+            self.log.warn("Skipping...")
+            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
+            if self.exit_on_error:
+                raise Dcm2MetaJsonConversionException()
+
+        if date_time_string is None:
+            return None
+
+        date_time_formatted = parser.parse(date_time_string).strftime(self.format_date_time)
+        return self.convert_time_to_utc(date_time_formatted, self.format_date_time)
 
     def check_type(self, obj, val_type):
         try:
@@ -155,15 +268,150 @@ class Dcm2MetaJsonConverter:
 
         return tmp_data
 
+    # VR handlers: handler(self, new_key, value_str, new_meta_data) with new_key already containing the VR suffix
+
+    def convert_plain(self, new_key, value_str, new_meta_data):
+        # AE, AT, CS, LT, OB, OF, OW, ST, UN, UT
+        new_meta_data[new_key] = value_str
+
+    def convert_string(self, new_key, value_str, new_meta_data):
+        # LO, SH, UC, UI
+        new_meta_data[new_key] = str(value_str)
+
+    def convert_unknown_vr(self, new_key, value_str, new_meta_data):
+        self.log.warn(f"################ VR in ELSE! -> {new_key}: {value_str}")
+        new_meta_data[new_key] = value_str
+
+    def convert_age(self, new_key, value_str, new_meta_data):
+        # Age String: nnnD, nnnW, nnnM or nnnY
+        try:
+            int(value_str[:3])
+            new_meta_data[new_key] = value_str
+        except Exception as e:
+            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
+            self.log.warn("Could not extract age from: {}".format(value_str))
+            self.log.warn(e)
+            if self.exit_on_error:
+                raise Dcm2MetaJsonConversionException()
+
+    def convert_date(self, new_key, value_str, new_meta_data):
+        # YYYYMMDD
+        try:
+            if isinstance(value_str, list):
+                date_formatted = []
+                for date_str in value_str:
+                    if date_str == "":
+                        continue
+                    date_formatted.append(self.cached_convert("DA", date_str, self.get_date))
+            else:
+                date_formatted = self.cached_convert("DA", value_str, self.get_date)
+
+            new_meta_data[new_key] = date_formatted
+        except Exception as e:
+            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
+            self.log.warn("Could not extract date from: {}".format(value_str))
+            self.log.warn(e)
+            if self.exit_on_error:
+                raise Dcm2MetaJsonConversionException()
+
+    def convert_date_time(self, new_key, value_str, new_meta_data):
+        # YYYYMMDDHHMMSS.FFFFFF&ZZXX
+        try:
+            date_time_formatted = self.cached_convert("DT", value_str, self.get_date_time)
+            if date_time_formatted is not None:
+                new_meta_data[new_key] = date_time_formatted
+
+        except Exception as e:
+            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
+            self.log.warn("Could not extract Date Time from: {}".format(value_str))
+            self.log.warn(e)
+            if self.exit_on_error:
+                raise Dcm2MetaJsonConversionException()
+
+    def convert_time(self, new_key, value_str, new_meta_data):
+        # HHMMSS.FFFFFF
+        if isinstance(value_str, list):
+            time_formatted = []
+            for time_str in value_str:
+                if time_str == "" or time_str is None:
+                    continue
+                time_formatted.append(self.cached_convert("TM", time_str, self.get_time))
+        else:
+            time_formatted = self.cached_convert("TM", value_str, self.get_time)
+
+        new_meta_data[new_key] = time_formatted
+
+    def convert_float(self, new_key, value_str, new_meta_data):
+        # DS, FL, FD, OD
+        if isinstance(value_str, float):
+            new_meta_data[new_key] = value_str
+            return
+
+        checked_val = self.check_type(value_str, float)
+        if checked_val != "SKIPIT":
+            new_meta_data[new_key] = checked_val
+        else:
+            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
+            if self.exit_on_error:
+                raise Dcm2MetaJsonConversionException()
+
+    def convert_integer(self, new_key, value_str, new_meta_data):
+        # IS, SL, SS, UL, US
+        if isinstance(value_str, int):
+            new_meta_data[new_key] = value_str
+            return
+
+        checked_val = self.check_type(value_str, int)
+        if checked_val != "SKIPIT":
+            new_meta_data[new_key] = checked_val
+        else:
+            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
+            if self.exit_on_error:
+                raise Dcm2MetaJsonConversionException()
+
+    def convert_person_name(self, new_key, value_str, new_meta_data):
+        subcategories = ['Alphabetic',
+                         'Ideographic', 'Phonetic']
+        for cat in subcategories:
+            if cat in value_str:
+                new_meta_data[new_key+"_" +
+                              cat.lower()] = value_str[cat]
+
+    def convert_sequence(self, new_key, value_str, new_meta_data):
+        result = []
+        if isinstance(value_str, list):
+            result = self.check_list(value_str)
+            if isinstance(result, dict):
+                new_meta_data[new_key] = result
+            elif isinstance(result, list):
+                for cat_id in range(len(result)):
+                    cat = result[cat_id]
+                    if isinstance(cat, dict):
+                        pass
+                        # todo blowing up index ...
+                        # new_meta_data[new_key+"_"+str(cat_id)] = cat
+                    else:
+                        self.log.warn("Attention!")
+                        if self.exit_on_error:
+                            raise Dcm2MetaJsonConversionException()
+
+            else:
+                self.log.warn("ATTENTION!")
+                if self.exit_on_error:
+                    raise Dcm2MetaJsonConversionException()
+
+        elif isinstance(value_str, dict):
+            new_key = new_key+"_object"
+            result = self.replace_tags(value_str)
+            new_meta_data[new_key] = result
 
     def replace_tags(self, dicom_meta):
         new_meta_data = {}
-        for key, value in list(dicom_meta.items()):
-            new_key = ""
-            new_key = self.get_new_key(key)
+        for key, value in dicom_meta.items():
             if 'vr' in value and 'Value' in value:
-                value_str = dicom_meta[key]['Value']
-                vr = str(dicom_meta[key]['vr'])
+                value_str = value['Value']
+                vr = str(value['vr'])
+                new_key, handler = self.get_tag_entry(key, vr)
 
                 if "nan" in value_str:
                     self.log.warn("Found NAN! -> skipping")
@@ -173,435 +421,8 @@ class Dcm2MetaJsonConverter:
                     if len(value_str) == 1:
                         value_str = value_str[0]
 
-                try:  # vr list: http://dicom.nema.org/dicom/2013/output/chtml/part05/sect_6.2.html
-
-                    if vr == "AE":
-                        # Application Entity
-                        # A string of characters that identifies an Application Entity with leading and trailing spaces (20H) being non-significant.
-                        # A value consisting solely of spaces shall not be used.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = value_str
-
-                    elif vr == "AS":
-                        # Age String
-                        # A string of characters with one of the following formats -- nnnD, nnnW, nnnM, nnnY;
-                        # where nnn shall contain the number of days for D, weeks for W, months for M, or years for Y.
-
-                        # Example: "018M" would represent an age of 18 months.
-                        try:
-                            age_count = int(value_str[:3])
-                            identifier = value_str[3:]
-
-                            new_key = new_key+"_keyword"
-                            new_meta_data[new_key] = value_str
-                        except Exception as e:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            self.log.warn("Could not extract age from: {}".format(value_str))
-                            self.log.warn(e)
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "AT":
-                        # Attribute Tag
-                        # Ordered pair of 16-bit unsigned integers that is the value of a Data Element Tag.
-                        # Example: A Data Element Tag of (0018,00FF) would be encoded as a series of 4 bytes in a Little-Endian Transfer Syntax as 18H,00H,FFH,00H
-                        #  and in a Big-Endian Transfer Syntax as 00H,18H,00H,FFH.
-
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = value_str
-
-                    elif vr == "CS":
-                        # Code String
-                        # A string of characters with leading or trailing spaces (20H) being non-significant.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = value_str
-
-                    elif vr == "DA":
-                        # date
-                        # A string of characters of the format YYYYMMDD; where YYYY shall contain year,
-                        # MM shall contain the month, and DD shall contain the day, interpreted as a date of the Gregorian calendar system.
-                        # Example:
-                        # "19930822" would represent August 22, 1993.
-                        # Note:
-                        # The ACR-NEMA Standard 300 (predecessor to DICOM) supported a string of characters of the format
-                        # YYYY.MM.DD for this VR. Use of this format is not compliant.
-                        # See also DT VR in this table.
-                        try:
-                            if isinstance(value_str, list):
-                                date_formatted = []
-                                for date_str in value_str:
-                                    if date_str == "":
-                                        continue
-                                    date_formatted.append(parser.parse(date_str).strftime(self.format_date))
-                            else:
-                                date_formatted = parser.parse(value_str).strftime(self.format_date)
-
-                            new_key = new_key+"_date"
-                            new_meta_data[new_key] = date_formatted
-                        except Exception as e:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            self.log.warn("Could not extract date from: {}".format(value_str))
-                            self.log.warn(e)
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "DS":
-                        # Decimal String
-                        # A string of characters representing either a fixed point number or a floating point number.
-                        # A fixed point number shall contain only the characters 0-9 with an optional leading "+" or "-" and an optional "." to mark the decimal point.
-                        # A floating point number shall be conveyed as defined in ANSI X3.9, with an "E" or "e" to indicate the start of the exponent.
-                        # Decimal Strings may be padded with leading or trailing spaces. Embedded spaces are not allowed.
-
-                        #  Note
-                        #  Data Elements with multiple values using this VR may not be properly encoded if Explicit-VR transfer syntax is used
-                        #  and the VL of this attribute exceeds 65534 bytes.
-
-                        new_key = new_key+"_float"
-
-                        checked_val = self.check_type(value_str, float)
-                        if checked_val != "SKIPIT":
-                            new_meta_data[new_key] = checked_val
-                        else:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "DT":
-                        # Date Time
-                        # A concatenated date-time character string in the format:
-                        # YYYYMMDDHHMMSS.FFFFFF&ZZXX
-                        # 20020904000000.000000
-                        # "%Y-%m-%d %H:%M:%S.%f"
-                        try:
-                            date_time_string = None
-
-                            if len(value_str) == 21 and "." in value_str:
-                                date_time_string = parser.parse(value_str.split(".")[0]).strftime("%Y-%m-%d %H:%M:%S.%f")
-
-                            elif len(value_str) == 8:
-                                self.log.warn("DATE ONLY FOUND")
-                                datestr_date = parser.parse(value_str).strftime("%Y%m%d")
-                                datestr_time = parser.parse("01:00:00").strftime("%H:%M:%S")
-                                date_time_string = datestr_date + " " + datestr_time
-
-                            elif len(value_str) == 16:
-                                self.log.info("DATETIME FOUND")
-                                datestr_date = str(value_str)[:8]
-                                datestr_time = str(value_str)[8:]
-                                datestr_date = parser.parse(datestr_date).strftime(self.format_date)
-                                datestr_time = parser.parse(datestr_time).strftime(self.format_time)
-                                date_time_string = datestr_date + " " + datestr_time
-
-                            else:
-                                self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
-                                self.log.warn("++++++++++++++++++++++++++++ No Datetime ++++++++++++++++++++++++++++")
-                                self.log.warn("KEY  : {}".format(new_key))
-                                self.log.warn("Value: {}".format(value_str))
-                                self.log.warn("LEN: {}".format(len(value_str)))
-                                self.log.warn("Skipping...")
-                                self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
-                                if self.exit_on_error:
-                                    raise Dcm2MetaJsonConversionException()
-
-                            if date_time_string is not None:
-
-                                date_time_formatted = parser.parse(date_time_string).strftime(self.format_date_time)
-                                date_time_formatted = self.convert_time_to_utc(date_time_formatted, self.format_date_time)
-
-                                new_key = new_key+"_datetime"
-
-                                self.log.warn("Value: {}".format(value_str))
-                                self.log.warn("DATETIME: {}".format(date_time_formatted))
-                                new_meta_data[new_key] = date_time_formatted
-
-                        except Exception as e:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            self.log.warn("Could not extract Date Time from: {}".format(value_str))
-                            self.log.warn(e)
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "FL":
-                        # Floating Point Single
-                        # Single precision binary floating point number represented in IEEE 754:1985 32-bit Floating Point Number Format.
-
-                        new_key = new_key+"_float"
-
-                        checked_val = self.check_type(value_str, float)
-                        if checked_val != "SKIPIT":
-                            new_meta_data[new_key] = checked_val
-                        else:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "FD":
-                        # Floating Point Double
-                        # Double precision binary floating point number represented in IEEE 754:1985 64-bit Floating Point Number Format.
-
-                        new_key = new_key+"_float"
-
-                        checked_val = self.check_type(value_str, float)
-                        if checked_val != "SKIPIT":
-                            new_meta_data[new_key] = checked_val
-                        else:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "IS":
-                        # Integer String
-                        # A string of characters representing an Integer in base-10 (decimal), shall contain only the characters 0 - 9, with an optional leading "+" or "-". It may be padded with leading and/or trailing spaces. Embedded spaces are not allowed.
-                        # The integer, n, represented shall be in the range:
-                        # -231<= n <= (231-1).
-                        new_key = new_key+"_integer"
-
-                        checked_val = self.check_type(value_str, int)
-                        if checked_val != "SKIPIT":
-                            new_meta_data[new_key] = checked_val
-                        else:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "LO":
-                        # Long String
-                        # A character string that may be padded with leading and/or trailing spaces.
-                        # The character code 5CH (the BACKSLASH "\" in ISO-IR 6) shall not be present, as it is used as the delimiter
-                        # between values in multiple valued data elements. The string shall not have Control Characters except for ESC.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = str(value_str)
-
-                    elif vr == "LT":
-                        # Long Text
-                        # A character string that may contain one or more paragraphs.
-                        #  It may contain the Graphic Character set and the Control Characters, CR, LF, FF, and ESC.
-                        #  It may be padded with trailing spaces, which may be ignored, but leading spaces are considered to be significant.
-                        #  Data Elements with this VR shall not be multi-valued and therefore character code 5CH
-                        #  (the BACKSLASH "\" in ISO-IR 6) may be used.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = value_str
-
-                    elif vr == "OB":
-                        # Other Byte String
-                        # A string of bytes where the encoding of the contents is specified by the negotiated Transfer Syntax.
-                        #  OB is a VR that is insensitive to Little/Big Endian byte ordering (see Section 7.3).
-                        #  The string of bytes shall be padded with a single trailing NULL byte value (00H) when necessary to achieve even length.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = value_str
-
-                    elif vr == "OD":
-                        # Other Double String
-                        # A string of 64-bit IEEE 754:1985 floating point words.
-                        # OD is a VR that requires byte swapping within each 64-bit word when changing between Little Endian and Big Endian byte ordering
-
-                        new_key = new_key+"_float"
-
-                        checked_val = self.check_type(value_str, float)
-                        if checked_val != "SKIPIT":
-                            new_meta_data[new_key] = checked_val
-                        else:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "OF":
-                        # Other Float String
-                        # A string of 32-bit IEEE 754:1985 floating point words.
-                        # OF is a VR that requires byte swapping within each 32-bit word when changing between Little Endian and Big Endian byte ordering
-
-                        new_key = new_key+"_float"
-
-                        new_meta_data[new_key] = value_str
-
-                    elif vr == "OW":
-                        # Other Word String
-                        # A string of 16-bit words where the encoding of the contents is specified by the negotiated Transfer Syntax.
-                        #  OW is a VR that requires byte swapping within each word when changing between Little Endian and Big Endian byte ordering
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = value_str
-
-                    elif vr == "PN":
-                        # Person Name
-                        # A character string encoded using a 5 component convention. The character code 5CH (the BACKSLASH "\"
-                        # in ISO-IR 6) shall not be present, as it is used as the delimiter between values in multiple valued data
-                        # elements. The string may be padded with trailing spaces. For human use, the five components in their order
-                        # of occurrence are: family name complex, given name complex, middle name, name prefix, name suffix.
-                        new_key = new_key+"_keyword"
-                        subcategories = ['Alphabetic',
-                                         'Ideographic', 'Phonetic']
-                        for cat in subcategories:
-                            if cat in value_str:
-                                new_meta_data[new_key+"_" +
-                                              cat.lower()] = value_str[cat]
-
-                    elif vr == "SH":
-                        # Short String
-                        # A character string that may be padded with leading and/or trailing spaces. The character code 05CH
-                        # (the BACKSLASH "\" in ISO-IR 6) shall not be present, as it is used as the delimiter between values
-                        # for multiple data elements. The string shall not have Control Characters except ESC.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = str(value_str)
-
-                    elif vr == "UC":
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = str(value_str)
-
-                    elif vr == "SL":
-                        # Signed Long
-                        # Signed binary integer 32 bits long in 2's complement form.
-                        # Represents an integer, n, in the range:
-                        # - 231<= n <= 231-1.
-                        new_key = new_key+"_integer"
-
-                        checked_val = self.check_type(value_str, int)
-                        if checked_val != "SKIPIT":
-                            new_meta_data[new_key] = checked_val
-                        else:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "SQ":
-                        result = []
-                        new_key = new_key+"_object"
-                        if isinstance(value_str, list):
-                            result = self.check_list(value_str)
-                            if isinstance(result, dict):
-                                new_meta_data[new_key] = result
-                            elif isinstance(result, list):
-                                for cat_id in range(len(result)):
-                                    cat = result[cat_id]
-                                    if isinstance(cat, dict):
-                                        pass
-                                        # todo blowing up index ...
-                                        # new_meta_data[new_key+"_"+str(cat_id)] = cat
-                                    else:
-                                        self.log.warn("Attention!")
-                                        if self.exit_on_error:
-                                            raise Dcm2MetaJsonConversionException()
-
-                            else:
-                                self.log.warn("ATTENTION!")
-                                if self.exit_on_error:
-                                    raise Dcm2MetaJsonConversionException()
-
-                        elif isinstance(value_str, dict):
-                            new_key = new_key+"_object"
-                            result = self.replace_tags(value_str)
-                            new_meta_data[new_key] = result
-
-                    elif vr == "SS":
-                        # Signed Short
-                        # Signed binary integer 16 bits long in 2's complement form. Represents an integer n in the range:
-                        # -215<= n <= 215-1.
-                        new_key = new_key+"_integer"
-
-                        checked_val = self.check_type(value_str, int)
-                        if checked_val != "SKIPIT":
-                            new_meta_data[new_key] = checked_val
-                        else:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "ST":
-                        # Short Text
-                        # A character string that may contain one or more paragraphs.
-                        # It may contain the Graphic Character set and the Control Characters, CR, LF, FF, and ESC.
-                        #  It may be padded with trailing spaces, which may be ignored, but leading spaces are considered to be significant.
-                        #  Data Elements with this VR shall not be multi-valued and therefore character code 5CH (the BACKSLASH "\" in ISO-IR 6) may be used.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = value_str
-
-                    elif vr == "TM":
-                        # Time
-                        # A string of characters of the format HHMMSS.FFFFFF; where HH contains hours (range "00" - "23"), MM contains minutes (range "00" - "59"),
-                        # SS contains seconds (range "00" - "60"), and FFFFFF contains a fractional part of a second as small as 1 millionth of a second (range "000000" - "999999").
-                        # A 24-hour clock is used. Midnight shall be represented by only "0000" since "2400" would violate the hour range. The string may be padded with trailing spaces.
-                        # Leading and embedded spaces are not allowed. One or more of the components MM, SS, or FFFFFF may be unspecified as long as every component
-                        # to the right of an unspecified component is also unspecified, which indicates that the value is not precise to the precision of those unspecified components.
-                        # The FFFFFF component, if present, shall contain 1 to 6 digits. If FFFFFF is unspecified the preceding "." shall not be included.
-
-                        # Examples:
-                        # "070907.0705 " represents a time of 7 hours, 9 minutes and 7.0705 seconds.
-                        # "1010" represents a time of 10 hours, and 10 minutes.
-                        # "021 " is an invalid value.
-                        # Note
-                        # The ACR-NEMA Standard 300 (predecessor to DICOM) supported a string of characters of the format HH:MM:SS.frac for this VR. Use of this format is not compliant.
-                        # See also DT VR in this table.
-                        # The SS component may have a value of 60 only for a leap second.
-
-                        if isinstance(value_str, list):
-                            time_formatted = []
-                            for time_str in value_str:
-                                if time_str == "" or time_str is None:
-                                    continue
-                                time_formatted.append(self.get_time(time_str))
-                        else:
-                            time_formatted = self.get_time(value_str)
-
-                        new_key = new_key+"_time"
-                        new_meta_data[new_key] = time_formatted
-
-                    elif vr == "UI":
-                        # Unique Identifier (UID)
-                        # A character string containing a UID that is used to uniquely identify a wide variety of items.
-                        # The UID is a series of numeric components separated by the period "." character.
-                        # If a Value Field containing one or more UIDs is an odd number of bytes in length,
-                        # the Value Field shall be padded with a single trailing NULL (00H) character to ensure
-                        # that the Value Field is an even number of bytes in length. See Section 9 and Annex B for a complete specification and examples.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = str(value_str)
-
-                    elif vr == "UL":
-                        # Unsigned Long
-                        # Unsigned binary integer 32 bits long. Represents an integer n in the range:
-                        # 0 <= n < 232.
-
-                        new_key = new_key+"_integer"
-
-                        checked_val = self.check_type(value_str, int)
-                        if checked_val != "SKIPIT":
-                            new_meta_data[new_key] = checked_val
-                        else:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "UN":
-                        # Unknown
-                        # A string of bytes where the encoding of the contents is unknown.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = value_str
-
-                    elif vr == "US":
-                        # Unsigned Short
-                        # Unsigned binary integer 16 bits long. Represents integer n in the range:
-                        # 0 <= n < 216.
-                        new_key = new_key+"_integer"
-
-                        checked_val = self.check_type(value_str, int)
-                        if checked_val != "SKIPIT":
-                            new_meta_data[new_key] = checked_val
-                        else:
-                            self.log.warn("+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++ SKIPPED")
-                            if self.exit_on_error:
-                                raise Dcm2MetaJsonConversionException()
-
-                    elif vr == "UT":
-                        # Unlimited Text
-                        # A character string that may contain one or more paragraphs. It may contain the Graphic Character set and the Control Characters, CR, LF,
-                        # FF, and ESC. It may be padded with trailing spaces, which may be ignored, but leading spaces are considered to be significant.
-                        # Data Elements with this VR shall not be multi-valued and therefore character code 5CH (the BACKSLASH "\" in ISO-IR 6) may be used.
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = (value_str)
-
-                    else:
-                        self.log.warn(f"################ VR in ELSE!: {vr}")
-                        self.log.warn(f"DICOM META: {dicom_meta[key]}")
-                        new_key = new_key+"_keyword"
-                        new_meta_data[new_key] = (value_str)
+                try:
+                    handler(self, new_key, value_str, new_meta_data)
 
                 except Exception as e:
                     logging.error("#")
@@ -633,10 +454,43 @@ class Dcm2MetaJsonConverter:
                         entry_value = str(value["Value"]).strip('[]').encode('utf-8')
                         self.log.warn("value: {}".format(entry_value))
 
-                    self.log.warn("new_key: {}".format(new_key))
+                    self.log.warn("new_key: {}".format(self.get_new_key(key)))
 
         return new_meta_data
 
+    # vr -> (key suffix, handler)
+    VR_HANDLERS = {
+        "AE": ("_keyword", convert_plain),
+        "AS": ("_keyword", convert_age),
+        "AT": ("_keyword", convert_plain),
+        "CS": ("_keyword", convert_plain),
+        "DA": ("_date", convert_date),
+        "DS": ("_float", convert_float),
+        "DT": ("_datetime", convert_date_time),
+        "FL": ("_float", convert_float),
+        "FD": ("_float", convert_float),
+        "IS": ("_integer", convert_integer),
+        "LO": ("_keyword", convert_string),
+        "LT": ("_keyword", convert_plain),
+        "OB": ("_keyword", convert_plain),
+        "OD": ("_float", convert_float),
+        "OF": ("_float", convert_plain),
+        "OW": ("_keyword", convert_plain),
+        "PN": ("_keyword", convert_person_name),
+        "SH": ("_keyword", convert_string),
+        "UC": ("_keyword", convert_string),
+        "SL": ("_integer", convert_integer),
+        "SQ": ("_object", convert_sequence),
+        "SS": ("_integer", convert_integer),
+        "ST": ("_keyword", convert_plain),
+        "TM": ("_time", convert_time),
+        "UI": ("_keyword", convert_string),
+        "UL": ("_integer", convert_integer),
+        "UN": ("_keyword", convert_plain),
+        "US": ("_integer", convert_integer),
+        "UT": ("_keyword", convert_plain),
+    }
+    DEFAULT_VR_HANDLER = ("_keyword", convert_unknown_vr)
 
     def dcmJson2metaJson(self, dicom_metadata):
         """
@@ -720,3 +574,49 @@ class Dcm2MetaJsonConverter:
             new_meta_data["00101010 PatientAge_integer"] = patient_age_scan
 
         return new_meta_data
+
+
+def count_tags(dicom_meta):
+    tag_count = 0
+    for value in dicom_meta.values():
+        tag_count += 1
+        if isinstance(value, dict) and value.get("vr") == "SQ":
+            for item in value.get("Value", []):
+                if isinstance(item, dict):
+                    tag_count += count_tags(item)
+    return tag_count
+
+
+def benchmark(corpus_dir, dict_path=None, repetitions=3):
+    """
+    Micro-benchmark: converts every DICOM-JSON header (*.json) found in corpus_dir and reports tags/s.
+    """
+    headers = []
+    for json_path in sorted(glob.glob(os.path.join(corpus_dir, "**", "*.json"), recursive=True)):
+        with open(json_path, encoding='utf-8') as f:
+            headers.append(json.load(f))
+
+    if len(headers) == 0:
+        print(f"No DICOM-JSON headers found in {corpus_dir}")
+        return
+
+    tag_count = sum(count_tags(header) for header in headers)
+    converter = Dcm2MetaJsonConverter(exception_on_error=False, dict_path=dict_path)
+    logging.disable(logging.WARNING)
+    try:
+        for repetition in range(repetitions):
+            start = time.perf_counter()
+            for header in headers:
+                converter.dcmJson2metaJson(header)
+            duration = time.perf_counter() - start
+            print(f"run {repetition + 1}/{repetitions}: {len(headers)} headers, {tag_count} tags in {duration:.3f}s "
+                  f"-> {tag_count / duration:.0f} tags/s, {len(headers) / duration:.1f} headers/s")
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python Dcm2MetaJsonConverter.py <dicom-json-corpus-dir> [dicom_tag_dict.json]")
+        sys.exit(1)
+    benchmark(sys.argv[1], dict_path=sys.argv[2] if len(sys.argv) > 2 else None)
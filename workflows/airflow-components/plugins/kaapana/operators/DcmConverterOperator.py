@@ -7,6 +7,7 @@ class DcmConverterOperator(KaapanaBaseOperator):
     def __init__(self,
                  dag,
                  output_format="nrrd",
+                 parallel_processes=2,
                  env_vars=None,
                  execution_timeout=timedelta(minutes=90),
                  *args, **kwargs
@@ -15,8 +16,10 @@ class DcmConverterOperator(KaapanaBaseOperator):
         if env_vars is None:
             env_vars = {}
 
+        # one MITK converter per series runs on each requested cpu -> the memory request scales with the processes
         envs = {
             "CONVERTTO": output_format,
+            "PARALLEL_PROCESSES": str(parallel_processes),
         }
 
         env_vars.update(envs)
@@ -33,7 +36,8 @@ class DcmConverterOperator(KaapanaBaseOperator):
             env_vars=env_vars,
             image_pull_secrets=["registry-secret"],
             execution_timeout=execution_timeout,
-            ram_mem_mb=2000,
-            ram_mem_mb_lmt=12000,
+            ram_mem_mb=2000 * parallel_processes,
+            ram_mem_mb_lmt=max(12000, 2000 * parallel_processes),
+            cpu_millicores=1000 * parallel_processes,
             *args, **kwargs
         )
@@ -18,6 +18,7 @@ class DcmQueryOperator(KaapanaBaseOperator):
                  start_date: date=None,
                  end_date: date=None,
                  max_query_size: str = None,
+                 parallel_queries: int = 4,
                  env_vars=None,
                  level='study',
                  enable_proxy = False,
@@ -41,16 +42,17 @@ class DcmQueryOperator(KaapanaBaseOperator):
             "LOCAL_AE_TITLE": str(local_ae_title),
             "AE_TITLE": str(ae_title),
             "LEVEL": str(level),
+            "PARALLEL_QUERIES": str(parallel_queries),
         }
 
         if start_date:
-            env["START_DATE"] = start_date.strftime("%Y-%m-%d")
+            envs["START_DATE"] = start_date.strftime("%Y-%m-%d")
 
         if end_date:
-            env["END_DATE"] = end_date.strftime("%Y-%m-%d")
+            envs["END_DATE"] = end_date.strftime("%Y-%m-%d")
 
         if max_query_size:
-            env["MAX_QUERY_SIZE"] = int(max_query_size)
+            envs["MAX_QUERY_SIZE"] = str(int(max_query_size))
             
         env_vars.update(envs)
 
@@ -1,30 +1,219 @@
-
 import os
+import io
 import glob
+import json
+import hashlib
 import functools
+from minio.error import NoSuchKey, NoSuchBucket
 from kaapana.blueprints.kaapana_global_variables import BATCH_NAME, WORKFLOW_DIR
 from kaapana.operators.HelperMinio import HelperMinio
 
-def cache_action(cache_operator_dirs, action, dag_run_dir):
-    loaded_from_cache = True
+# Cache layout in the cache bucket:
+#   <operator_out_dir>/<cache_key>/manifest.json  -> {relative file path: {"size": .., "sha256": ..}}
+#   <operator_out_dir>/<cache_key>/<relative file path>
+# The cache key is a hash over the operator (out dir, image, env), the dag-run configuration
+# and the content of the batch element's input files, so a cache hit needs a single manifest lookup.
+# manage_cache='clear' removes all entries of the operator (<operator_out_dir>/), 'overwrite' only those of the current keys.
+CACHE_BUCKET = 'cache'
+MANIFEST_NAME = 'manifest.json'
+LOCAL_MANIFEST_NAME = '.kaapana-cache-manifest.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def load_local_manifest(dag_run_dir):
+    # local file path -> {"size", "mtime_ns", "sha256"}, avoids re-hashing unchanged files
+    try:
+        with open(os.path.join(dag_run_dir, LOCAL_MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_local_manifest(dag_run_dir, local_manifest):
+    os.makedirs(dag_run_dir, exist_ok=True)
+    with open(os.path.join(dag_run_dir, LOCAL_MANIFEST_NAME), 'w') as f:
+        json.dump(local_manifest, f)
+
+
+def file_sha256(file_path, local_manifest):
+    stat = os.stat(file_path)
+    entry = local_manifest.get(file_path)
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    local_manifest[file_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+    return local_manifest[file_path]["sha256"]
+
+
+def list_files(root_dir):
+    file_paths = [f for f in glob.glob(os.path.join(root_dir, '**', '*'), recursive=True) if os.path.isfile(f)]
+    return sorted(os.path.relpath(f, root_dir) for f in file_paths)
+
+
+def get_form_data(dag_run_conf):
+    if dag_run_conf is not None and "conf" in dag_run_conf and dag_run_conf["conf"] is not None:
+        return dag_run_conf["conf"].get("form_data")
+    return None
+
+
+def get_cache_key(operator, batch_element_dir, dag_run_conf, local_manifest):
+    key_hash = hashlib.sha256()
+    key_hash.update(json.dumps({
+        "operator_out_dir": operator.operator_out_dir,
+        "batch_element": os.path.basename(batch_element_dir),
+        "image": getattr(operator, 'image', None),
+        "env_vars": getattr(operator, 'env_vars', None),
+        "conf": {
+            "rest_call": dag_run_conf.get("rest_call"),
+            "form_data": get_form_data(dag_run_conf)
+        } if dag_run_conf else None
+    }, sort_keys=True, default=str).encode())
+
+    operator_in_dir = getattr(operator, 'operator_in_dir', None)
+    if operator_in_dir is not None:
+        input_dir = os.path.join(batch_element_dir, operator_in_dir)
+        for rel_path in list_files(input_dir):
+            key_hash.update(rel_path.encode())
+            key_hash.update(file_sha256(os.path.join(input_dir, rel_path), local_manifest).encode())
+
+    return key_hash.hexdigest()
+
+
+def get_remote_manifest(object_prefix):
+    try:
+        response = HelperMinio.minioClient.get_object(CACHE_BUCKET, f"{object_prefix}/{MANIFEST_NAME}")
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+    except (NoSuchKey, NoSuchBucket):
+        return None
+
+
+def cache_get(object_prefix, element_output_dir, local_manifest):
+    remote_manifest = get_remote_manifest(object_prefix)
+    if not remote_manifest:
+        return False, []
+
+    jobs = []
+    for rel_path, entry in remote_manifest.items():
+        file_path = os.path.join(element_output_dir, rel_path)
+        if os.path.isfile(file_path) and file_sha256(file_path, local_manifest) == entry["sha256"]:
+            continue
+        jobs.append((f"{object_prefix}/{rel_path}", file_path))
+    return True, jobs
+
+
+def cache_put(object_prefix, element_output_dir, local_manifest):
+    remote_manifest = get_remote_manifest(object_prefix) or {}
+    manifest = {}
+    jobs = []
+    for rel_path in list_files(element_output_dir):
+        file_path = os.path.join(element_output_dir, rel_path)
+        manifest[rel_path] = {"size": os.path.getsize(file_path), "sha256": file_sha256(file_path, local_manifest)}
+        if remote_manifest.get(rel_path) == manifest[rel_path]:
+            continue
+        jobs.append((f"{object_prefix}/{rel_path}", file_path))
+    return manifest, jobs
+
+
+def cache_remove(object_prefix):
+    object_names = [obj.object_name for obj in HelperMinio.minioClient.list_objects(CACHE_BUCKET, prefix=f"{object_prefix}/", recursive=True)]
+    HelperMinio.remove_objects(HelperMinio.minioClient, CACHE_BUCKET, object_names)
+
+
+def get_cache_keys(operator, dag_run_dir, dag_run_conf=None):
+    """
+    Cache key of every batch element -> has to be computed before the operator runs:
+    KaapanaBaseOperator.execute adds env vars (e.g. CUDA_VISIBLE_DEVICES, form data) and sets conf["rest_call"],
+    so a key computed afterwards would never be computed again by the next lookup.
+    """
     batch_folders = [f for f in glob.glob(os.path.join(dag_run_dir, BATCH_NAME, '*'))]
+    local_manifest = load_local_manifest(dag_run_dir)
+    cache_keys = {
+        batch_element_dir: get_cache_key(operator, batch_element_dir, dag_run_conf, local_manifest)
+        for batch_element_dir in batch_folders
+    }
+    save_local_manifest(dag_run_dir, local_manifest)
+    return cache_keys
+
+
+def cache_action(operator, action, dag_run_dir, cache_keys):
+    if action == 'clear':
+        # all entries of the operator, not only the ones of the current keys
+        try:
+            cache_remove(operator.operator_out_dir)
+        except NoSuchBucket:
+            print(f'Skipping since bucket {CACHE_BUCKET} does not exist')
+        return False
+
+    loaded_from_cache = True
+    batch_folders = list(cache_keys.keys())
     if not batch_folders:
-        loaded_from_cache=False
-    local_root_dir = os.path.join(dag_run_dir, BATCH_NAME)
-    for batch_element_dir in batch_folders:
-        for cache_operator_dir in cache_operator_dirs:
-            element_output_dir = os.path.join(batch_element_dir, cache_operator_dir)
-            rel_dir = os.path.relpath(element_output_dir, local_root_dir)
-            rel_dir = '' if rel_dir== '.' else rel_dir
-            object_dirs = [rel_dir]
-            HelperMinio.apply_action_to_object_dirs(HelperMinio.minioClient, action, 'cache', local_root_dir, object_dirs=object_dirs)
+        loaded_from_cache = False
+
+    local_manifest = load_local_manifest(dag_run_dir)
+    transfer_jobs = []
+    manifests = {}
+    for batch_element_dir, cache_key in cache_keys.items():
+        element_output_dir = os.path.join(batch_element_dir, operator.operator_out_dir)
+        object_prefix = f"{operator.operator_out_dir}/{cache_key}"
+
+        if action == 'get':
             try:
-                if len(os.listdir(element_output_dir)) == 0:
+                found, jobs = cache_get(object_prefix, element_output_dir, local_manifest)
+            except NoSuchBucket:
+                found, jobs = False, []
+            if not found:
+                print(f"No cache entry for {batch_element_dir}")
+                loaded_from_cache = False
+                break
+            transfer_jobs.extend(jobs)
+
+        elif action == 'put':
+            manifest, jobs = cache_put(object_prefix, element_output_dir, local_manifest)
+            manifests[object_prefix] = manifest
+            transfer_jobs.extend(jobs)
+
+        elif action == 'remove':
+            try:
+                cache_remove(object_prefix)
+            except NoSuchBucket:
+                print(f'Skipping since bucket {CACHE_BUCKET} does not exist')
+        else:
+            raise NameError('You need to define an action: get, remove, clear or put!')
+
+    if action == 'get' and not loaded_from_cache:
+        save_local_manifest(dag_run_dir, local_manifest)
+        return False
+
+    if action in ['get', 'put']:
+        print(f"Cache {action}: transferring {len(transfer_jobs)} files")
+        HelperMinio.apply_action_to_files(HelperMinio.minioClient, action, CACHE_BUCKET, transfer_jobs)
+
+    if manifests:
+        HelperMinio.make_bucket(HelperMinio.minioClient, CACHE_BUCKET)
+    # the manifest is written last -> an entry is only visible once all its files are uploaded
+    for object_prefix, manifest in manifests.items():
+        manifest_data = json.dumps(manifest).encode()
+        HelperMinio.minioClient.put_object(CACHE_BUCKET, f"{object_prefix}/{MANIFEST_NAME}", io.BytesIO(manifest_data), len(manifest_data))
+
+    save_local_manifest(dag_run_dir, local_manifest)
+
+    if action == 'get':
+        for batch_element_dir in batch_folders:
+            try:
+                if len(os.listdir(os.path.join(batch_element_dir, operator.operator_out_dir))) == 0:
                     loaded_from_cache = False
             except FileNotFoundError:
-                loaded_from_cache = False 
+                loaded_from_cache = False
     return loaded_from_cache
-    
+
 
 # Decorator
 def cache_operator_output(func):
@@ -36,28 +225,37 @@ def cache_operator_output(func):
             raise AssertionError("Invalid name '{}' for manage_cache. It must be set to None, 'ignore', 'cache', 'overwrite' or 'clear'".format(self.manage_cache))
 
         if 'context' in kwargs:
-            run_id = kwargs['context']['run_id']
+            context = kwargs['context']
         elif type(args) == tuple and len(args) == 1 and "run_id" in args[0]:
-            run_id = args[0]['run_id']
+            context = args[0]
         else:
-            run_id = kwargs['run_id']
+            context = kwargs
+        run_id = context['run_id']
+        dag_run = context.get('dag_run')
+        dag_run_conf = dag_run.conf if dag_run is not None else None
 
         dag_run_dir = os.path.join(WORKFLOW_DIR, run_id)
-        if self.manage_cache == 'overwrite' or self.manage_cache == 'clear':
-            cache_action(cache_operator_dirs, 'remove', dag_run_dir)
+        # the same keys are used for get and put, func changes env_vars and the dag-run conf
+        cache_keys = get_cache_keys(self, dag_run_dir, dag_run_conf) if self.manage_cache in ['cache', 'overwrite'] else {}
+        if self.manage_cache == 'overwrite':
+            # only the entries of the current keys, they are written again after func
+            cache_action(self, 'remove', dag_run_dir, cache_keys)
+            print('Clearing cache')
+        elif self.manage_cache == 'clear':
+            cache_action(self, 'clear', dag_run_dir, cache_keys)
             print('Clearing cache')
 
         if self.manage_cache == 'cache':
-            if cache_action(cache_operator_dirs, 'get', dag_run_dir) is True:
+            if cache_action(self, 'get', dag_run_dir, cache_keys) is True:
                 print(f'{", ".join(cache_operator_dirs)} output loaded from cache')
                 return
-        
+
         x = func(self, *args, **kwargs)
         if self.manage_cache  == 'cache' or self.manage_cache == 'overwrite':
-            cache_action(cache_operator_dirs, 'put', dag_run_dir)
+            cache_action(self, 'put', dag_run_dir, cache_keys)
             print(f'{", ".join(cache_operator_dirs)} output saved to cache')
         else:
             print('Caching is not used!')
         return x
 
-    return wrapper
\ No newline at end of file
+    return wrapper
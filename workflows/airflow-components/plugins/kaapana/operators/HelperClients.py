@@ -0,0 +1,54 @@
+import os
+import threading
+
+
+class HelperClients():
+    """
+    Process-wide registry of service clients (minio, elasticsearch, dicomweb ...).
+    Clients are built on first use inside a task and not while the DAG files are parsed.
+    Every client keeps its own connection pool, which is shared by all threads of the process.
+    Forked processes (e.g. multiprocessing pools) get their own clients, connection pools can't be shared across a fork.
+    """
+    _clients = {}
+    _pid = None
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(key, factory):
+        """
+        :param key: hashable name of the client, e.g. ("elasticsearch", host, port)
+        :param factory: callable without arguments building the client, only called on the first use in the process
+        """
+        with HelperClients._lock:
+            if HelperClients._pid != os.getpid():
+                HelperClients._clients = {}
+                HelperClients._pid = os.getpid()
+            if key not in HelperClients._clients:
+                HelperClients._clients[key] = factory()
+            return HelperClients._clients[key]
+
+    @staticmethod
+    def reset(key=None):
+        with HelperClients._lock:
+            if key is None:
+                HelperClients._clients = {}
+            else:
+                HelperClients._clients.pop(key, None)
+
+
+class LazyClient():
+    """
+    Class attribute resolving to a client of the HelperClients registry, e.g.
+
+        class HelperMinio():
+            minioClient = LazyClient("minio", create_minio_client)
+
+    HelperMinio.minioClient builds the client on the first access.
+    """
+
+    def __init__(self, key, factory):
+        self.key = key
+        self.factory = factory
+
+    def __get__(self, instance, owner):
+        return HelperClients.get(self.key, self.factory)
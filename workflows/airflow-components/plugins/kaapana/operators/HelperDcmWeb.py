@@ -1,26 +1,91 @@
+import io
 import requests
 import logging
 import os
 import tempfile
 import time
 import pydicom
-from dicomweb_client.api import DICOMwebClient
+import pydicom.errors
 from typing import List
 from os.path import join
 from pathlib import Path
 from glob import glob
-from urllib3.filepost import encode_multipart_formdata, choose_boundary
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from urllib3.filepost import choose_boundary
+from kaapana.operators.HelperClients import LazyClient
 
 
 class DcmWebException(Exception):
     pass
 
+class MultipartDicomStream():
+    """
+    File-like multipart/related body of a STOW-RS request.
+    The DICOM files are read chunk by chunk while the request is sent, the total length is known upfront,
+    so requests sends a Content-Length instead of a chunked body.
+    """
+
+    def __init__(self, files, boundary):
+        self.segments = []
+        for file in files:
+            self.segments.append(f"--{boundary}\r\nContent-Type: application/dicom\r\n\r\n".encode())
+            self.segments.append(file)
+            self.segments.append(b"\r\n")
+        self.segments.append(f"--{boundary}--\r\n".encode())
+        self.length = sum(len(segment) if isinstance(segment, bytes) else os.path.getsize(segment) for segment in self.segments)
+        self.segment_index = 0
+        self.current = None
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        size = HelperDcmWeb.chunk_size if size is None or size < 0 else size
+        while self.segment_index < len(self.segments):
+            if self.current is None:
+                segment = self.segments[self.segment_index]
+                self.current = io.BytesIO(segment) if isinstance(segment, bytes) else open(segment, "rb")
+            data = self.current.read(size)
+            if data:
+                return data
+            self.current.close()
+            self.current = None
+            self.segment_index += 1
+        return b""
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+
+def create_dicomweb_client():
+    from dicomweb_client.api import DICOMwebClient
+    return DICOMwebClient(url=f"{HelperDcmWeb.pacs_dcmweb}/rs")
+
+
+def create_dcmweb_session():
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+    return session
+
+
 class HelperDcmWeb():
     pacs_dcmweb_endpoint = "http://dcm4chee-service.store.svc:8080/dcm4chee-arc/aets/"
     #pacs_dcmweb_endpoint = "http://10.128.128.212:8080/dcm4chee-arc/aets/"
     pacs_dcmweb = pacs_dcmweb_endpoint + "KAAPANA"
-    client = DICOMwebClient(url=f"{pacs_dcmweb}/rs")
+    # built on first use
+    client = LazyClient("dicomweb", create_dicomweb_client)
+    session = LazyClient("dcmweb-session", create_dcmweb_session)
     wait_time=5
+    parallel_instances=8
+    chunk_size=1024 * 1024
+    # STOW-RS: instances and bytes per request, concurrent requests and retries of single instances
+    stow_max_instances = 100
+    stow_max_bytes = 64 * 1024 * 1024
+    stow_parallel_requests = 4
+    stow_retries = 3
     log = logging.getLogger(__name__)
 
     @staticmethod
@@ -36,12 +101,21 @@ class HelperDcmWeb():
             return False
     
     @staticmethod
-    def downloadSeries(seriesUID, target_dir, include_series_dir=False):
+    def downloadSeries(seriesUID, target_dir, include_series_dir=False, mode="wado-rs", parallel_instances=None):
+        """
+        Download all instances of a series into target_dir.
+
+        mode="wado-rs" fetches the whole series as one multipart/related response and streams every part
+        straight to disk. Instances missing afterwards (or every instance for mode="wado-uri") are fetched
+        one by one from the legacy /wado endpoint on a bounded thread pool sharing one pooled session.
+
+        :returns: True if all instances have been downloaded, False otherwise
+        """
         payload = {
             'SeriesInstanceUID': seriesUID
         }
         url = HelperDcmWeb.pacs_dcmweb + "/rs/instances"
-        httpResponse = requests.get(url, params=payload)
+        httpResponse = HelperDcmWeb.session.get(url, params=payload)
         # print(f"Requesting URL: {url}")
         # print(f"httpResponse: {httpResponse}")
         # print(f"payload: {payload}")
@@ -59,15 +133,67 @@ class HelperDcmWeb():
             if include_series_dir:
                 target_dir = join(target_dir, seriesUID)
             Path(target_dir).mkdir(parents=True, exist_ok=True)
-            for objectUID in objectUIDList:
-                studyUID = objectUID[0]
-                objectUID = objectUID[1]
-                HelperDcmWeb.downloadObject(
-                    studyUID=studyUID,
-                    seriesUID=seriesUID,
-                    objectUID=objectUID,
-                    target_dir=target_dir
-                )
+
+            start_time = time.time()
+            downloaded_bytes = 0
+            missing_objects = objectUIDList
+            if mode == "wado-rs" and len(objectUIDList) > 0:
+                try:
+                    downloaded_bytes += HelperDcmWeb.downloadSeriesMultipart(
+                        studyUID=objectUIDList[0][0],
+                        seriesUID=seriesUID,
+                        target_dir=target_dir
+                    )
+                except (requests.exceptions.RequestException, DcmWebException) as e:
+                    HelperDcmWeb.log.warning("WADO-RS download of series %s failed: %s -> falling back to single instances", seriesUID, e)
+                missing_objects = [
+                    objectUID for objectUID in objectUIDList
+                    if not os.path.isfile(os.path.join(target_dir, objectUID[1] + ".dcm"))
+                ]
+
+            def download(objectUID):
+                try:
+                    return objectUID, HelperDcmWeb.downloadObject(
+                        studyUID=objectUID[0],
+                        seriesUID=seriesUID,
+                        objectUID=objectUID[1],
+                        target_dir=target_dir
+                    ), None
+                except (DcmWebException, requests.exceptions.RequestException) as e:
+                    # no partially written instance is left behind
+                    file_path = os.path.join(target_dir, objectUID[1] + ".dcm")
+                    if os.path.isfile(file_path):
+                        os.remove(file_path)
+                    return objectUID, 0, e
+
+            failed_objects = []
+            if len(missing_objects) > 0:
+                parallel_instances = parallel_instances if parallel_instances is not None else HelperDcmWeb.parallel_instances
+                with ThreadPool(min(parallel_instances, len(missing_objects))) as pool:
+                    for objectUID, object_bytes, error in pool.imap_unordered(download, missing_objects):
+                        if error is not None:
+                            HelperDcmWeb.log.error("Could not download instance %s of series %s: %s", objectUID[1], seriesUID, error)
+                            failed_objects.append(objectUID)
+                        downloaded_bytes += object_bytes
+
+            duration = max(time.time() - start_time, 1e-6)
+            HelperDcmWeb.log.info(
+                "Series %s: %d instances (%d single requests), %.1f MB in %.2fs -> %.2f MB/s, %.1f instances/s",
+                seriesUID,
+                len(objectUIDList),
+                len(missing_objects),
+                downloaded_bytes / 1024 / 1024,
+                duration,
+                downloaded_bytes / 1024 / 1024 / duration,
+                len(objectUIDList) / duration
+            )
+            if failed_objects:
+                print("################################")
+                print("#")
+                print(f"# Could not download {len(failed_objects)} of {len(objectUIDList)} instances of series {seriesUID}!")
+                print("#")
+                print("################################")
+                return False
             return True
         else:
             print("################################")
@@ -79,7 +205,116 @@ class HelperDcmWeb():
             print("################################")
             return False
 
-    @ staticmethod
+    @staticmethod
+    def downloadSeriesMultipart(studyUID, seriesUID, target_dir):
+        """
+        Retrieve a complete series via WADO-RS and write every part of the multipart/related response
+        to target_dir while it arrives. Files are named by their SOPInstanceUID.
+
+        :returns: number of bytes written
+        """
+        url = f"{HelperDcmWeb.pacs_dcmweb}/rs/studies/{studyUID}/series/{seriesUID}"
+        headers = {
+            'Accept': 'multipart/related; type="application/dicom"; transfer-syntax=*'
+        }
+        with HelperDcmWeb.session.get(url, headers=headers, stream=True) as response:
+            if response.status_code != requests.codes.ok:
+                raise DcmWebException(f"Error accessing {url} errorcode {response.status_code}")
+
+            content_type = response.headers.get("Content-Type", "")
+            boundary = None
+            for param in content_type.split(";")[1:]:
+                key, _, value = param.strip().partition("=")
+                if key.lower() == "boundary":
+                    boundary = value.strip('"')
+            if boundary is None:
+                raise DcmWebException(f"No multipart boundary in response of {url}: {content_type}")
+
+            written_bytes = 0
+            for part_path in HelperDcmWeb._stream_multipart_to_files(
+                response.iter_content(chunk_size=HelperDcmWeb.chunk_size),
+                boundary=boundary.encode(),
+                target_dir=target_dir
+            ):
+                try:
+                    written_bytes += os.path.getsize(part_path)
+                    sop_instance_uid = pydicom.dcmread(
+                        part_path,
+                        stop_before_pixels=True,
+                        specific_tags=["SOPInstanceUID"]
+                    ).SOPInstanceUID
+                    os.replace(part_path, os.path.join(target_dir, f"{sop_instance_uid}.dcm"))
+                except (pydicom.errors.InvalidDicomError, OSError, AttributeError) as e:
+                    # malformed part -> the missing instances are fetched one by one
+                    if os.path.isfile(part_path):
+                        os.remove(part_path)
+                    raise DcmWebException(f"Invalid part in WADO-RS response of {url}: {e}")
+
+        return written_bytes
+
+    @staticmethod
+    def _stream_multipart_to_files(chunks, boundary: bytes, target_dir: str):
+        """
+        Split a multipart/related byte stream into files without holding a whole part in memory.
+        Yields the path of every completely written part.
+        """
+        delimiter = b"\r\n--" + boundary
+        # the first delimiter is not necessarily preceded by CRLF
+        buffer = b"\r\n"
+        part_file = None
+        part_path = None
+        part_count = 0
+        in_headers = False
+        finished = False
+
+        try:
+            for chunk in chunks:
+                if finished:
+                    break
+                buffer += chunk
+                while True:
+                    if part_file is None and not in_headers:
+                        # preamble or end of a part -> search next delimiter
+                        idx = buffer.find(delimiter)
+                        if idx == -1 or len(buffer) < idx + len(delimiter) + 2:
+                            break
+                        after = buffer[idx + len(delimiter):idx + len(delimiter) + 2]
+                        buffer = buffer[idx + len(delimiter) + 2:]
+                        if after == b"--":
+                            finished = True
+                            break
+                        in_headers = True
+                    if in_headers:
+                        idx = buffer.find(b"\r\n\r\n")
+                        if idx == -1:
+                            break
+                        buffer = buffer[idx + 4:]
+                        in_headers = False
+                        part_count += 1
+                        part_path = os.path.join(target_dir, f".part_{part_count:06d}.dcm")
+                        part_file = open(part_path, "wb")
+                    idx = buffer.find(delimiter)
+                    if idx == -1:
+                        # keep a tail which could contain the beginning of the delimiter
+                        keep = len(delimiter) - 1
+                        if len(buffer) > keep:
+                            part_file.write(buffer[:-keep])
+                            buffer = buffer[-keep:]
+                        break
+                    part_file.write(buffer[:idx])
+                    part_file.close()
+                    part_file = None
+                    buffer = buffer[idx:]
+                    yield part_path
+        finally:
+            if part_file is not None:
+                part_file.close()
+                os.remove(part_path)
+
+        if not finished:
+            raise DcmWebException("Multipart response ended before closing delimiter")
+
+    @staticmethod
     def downloadObject(studyUID, seriesUID, objectUID, target_dir):
         payload = {
             'requestType': 'WADO',
@@ -89,11 +324,16 @@ class HelperDcmWeb():
             'contentType': 'application/dicom'
         }
         url = HelperDcmWeb.pacs_dcmweb + "/wado"
-        response = requests.get(url, params=payload)
         fileName = objectUID+".dcm"
         filePath = os.path.join(target_dir, fileName)
-        with open(filePath, "wb") as f:
-            f.write(response.content)
+        written_bytes = 0
+        with HelperDcmWeb.session.get(url, params=payload, stream=True) as response:
+            if response.status_code != requests.codes.ok:
+                raise DcmWebException(f"Error downloading object {objectUID} errorcode {response.status_code}")
+            with open(filePath, "wb") as f:
+                for chunk in response.iter_content(chunk_size=HelperDcmWeb.chunk_size):
+                    written_bytes += f.write(chunk)
+        return written_bytes
 
     @staticmethod
     def quido_rs(aet: str, sub_url: str):
@@ -154,9 +394,11 @@ class HelperDcmWeb():
             HelperDcmWeb.log.info("Study deleted")
 
             HelperDcmWeb.log.info("3/4 Upload series to keep again to PACS")
+            upload_files = []
             for upload_series_uid in series_uids_keep:
-                HelperDcmWeb.log.info("Upload series %s", upload_series_uid)
-                HelperDcmWeb.upload_dcm_files(aet, os.path.join(tmp_dir, upload_series_uid))
+                upload_files.extend(glob(os.path.join(tmp_dir, upload_series_uid, "*.dcm")))
+            HelperDcmWeb.log.info("Upload series %s", series_uids_keep)
+            HelperDcmWeb.upload_dcm_file_list(aet, upload_files)
 
             HelperDcmWeb.log.info("4/4 Delete temp files")
             # deletion of tmp_files should happen automaticaly if scope of tmp_dir is left
@@ -167,14 +409,111 @@ class HelperDcmWeb():
 
     @staticmethod
     def upload_dcm_files(aet: str, path: str):
-        files = glob(os.path.join(path, "*.dcm"))
-        total_files = len(files)
-        uploaded_fiels = 0
+        HelperDcmWeb.upload_dcm_file_list(aet, glob(os.path.join(path, "*.dcm")))
+
+    @staticmethod
+    def upload_dcm_file_list(aet: str, files: List[str], parallel_requests=None):
+        """
+        Upload DICOM files via STOW-RS without decoding them.
+        Files are grouped by study into multipart requests of at most stow_max_instances files / stow_max_bytes,
+        which are sent by parallel_requests threads. The instances of a failed request are retried one by one.
+        """
+        studies = {}
         for file in files:
-            uploaded_fiels += 1
-            HelperDcmWeb.log.info("Uploading %d / %d:  %s", uploaded_fiels, total_files, file)
-            dataset = pydicom.dcmread(file)
-            HelperDcmWeb.client.store_instances(datasets=[dataset])
+            study_uid = str(pydicom.dcmread(file, stop_before_pixels=True, specific_tags=["StudyInstanceUID"]).StudyInstanceUID)
+            studies.setdefault(study_uid, []).append(file)
+
+        requests_list = []
+        for study_uid, study_files in studies.items():
+            request_files, request_bytes = [], 0
+            for file in study_files:
+                file_size = os.path.getsize(file)
+                if request_files and (len(request_files) >= HelperDcmWeb.stow_max_instances or request_bytes + file_size > HelperDcmWeb.stow_max_bytes):
+                    requests_list.append((study_uid, request_files))
+                    request_files, request_bytes = [], 0
+                request_files.append(file)
+                request_bytes += file_size
+            if request_files:
+                requests_list.append((study_uid, request_files))
+
+        def upload(request):
+            study_uid, request_files = request
+            if HelperDcmWeb.stow_rs(aet, study_uid, request_files):
+                return []
+            HelperDcmWeb.log.warning("STOW-RS of %d instances of study %s failed -> retrying single instances", len(request_files), study_uid)
+            failed_files = []
+            for file in request_files:
+                for retry in range(HelperDcmWeb.stow_retries):
+                    if HelperDcmWeb.stow_rs(aet, study_uid, [file]):
+                        break
+                    time.sleep(retry + 1)
+                else:
+                    failed_files.append(file)
+            return failed_files
+
+        start_time = time.time()
+        total_bytes = sum(os.path.getsize(file) for file in files)
+        failed_files = []
+        parallel_requests = parallel_requests if parallel_requests is not None else HelperDcmWeb.stow_parallel_requests
+        if requests_list:
+            with ThreadPool(min(parallel_requests, len(requests_list))) as pool:
+                for request_failed_files in pool.imap_unordered(upload, requests_list):
+                    failed_files.extend(request_failed_files)
+
+        duration = max(time.time() - start_time, 1e-6)
+        HelperDcmWeb.log.info(
+            "Uploaded %d instances of %d studies in %d requests, %.1f MB in %.2fs -> %.2f MB/s, %.1f instances/s",
+            len(files) - len(failed_files),
+            len(studies),
+            len(requests_list),
+            total_bytes / 1024 / 1024,
+            duration,
+            total_bytes / 1024 / 1024 / duration,
+            len(files) / duration
+        )
+        if failed_files:
+            raise DcmWebException(f"Could not upload {len(failed_files)} instances: {failed_files}")
+
+    @staticmethod
+    def stow_rs(aet: str, study_uid: str, files: List[str]):
+        """
+        Store files with one STOW-RS request.
+
+        :returns: True if the PACS stored all instances
+        """
+        url = f"{HelperDcmWeb.pacs_dcmweb}/rs/studies/{study_uid}"
+        boundary = choose_boundary()
+        headers = {
+            'Content-Type': f'multipart/related; type="application/dicom"; boundary={boundary}',
+            'Accept': 'application/dicom+json'
+        }
+        body = MultipartDicomStream(files, boundary)
+        try:
+            response = HelperDcmWeb.session.post(url, data=body, headers=headers)
+        except requests.exceptions.RequestException as e:
+            HelperDcmWeb.log.warning("STOW-RS request to %s failed: %s", url, e)
+            return False
+        finally:
+            body.close()
+        if response.status_code == requests.codes.ok:
+            return True
+        if response.status_code == requests.codes.accepted:
+            # 202: stored with warnings or partially stored -> only a batch with failed instances is retried one by one,
+            # a single instance is accepted with a 202, as the former dicomweb_client upload did
+            failed_sop_count = HelperDcmWeb.get_failed_sop_count(response)
+            if failed_sop_count == 0 or len(files) == 1:
+                HelperDcmWeb.log.warning("STOW-RS to %s returned 202 (%d failed instances): %s", url, failed_sop_count, response.text[:500])
+                return True
+        HelperDcmWeb.log.warning("STOW-RS of %d instances to %s returned %d: %s", len(files), url, response.status_code, response.text[:500])
+        return False
+
+    @staticmethod
+    def get_failed_sop_count(response):
+        # FailedSOPSequence (0008,1198) of the STOW-RS response
+        try:
+            return len(response.json().get("00081198", {}).get("Value", []))
+        except (ValueError, AttributeError):
+            return 0
 
 
     @staticmethod
@@ -1,4 +1,10 @@
-from elasticsearch import Elasticsearch
+from kaapana.operators.HelperClients import LazyClient
+
+
+def create_elasticsearch_client():
+    from elasticsearch import Elasticsearch
+    return Elasticsearch(hosts=HelperElasticsearch._elastichost, maxsize=HelperElasticsearch.max_connections)
+
 
 class HelperElasticsearch():
     study_uid_tag = "0020000D StudyInstanceUID_keyword"
@@ -7,11 +13,21 @@ class HelperElasticsearch():
     modality_tag = "00080060 Modality_keyword"
 
     _elastichost = "elastic-meta-service.meta.svc:9200"
-    es = Elasticsearch(hosts=_elastichost)
+    max_connections = 10
+    # built on first use
+    es = LazyClient("elasticsearch", create_elasticsearch_client)
+
+    # hits per scroll page and how long elasticsearch keeps the scroll context between two pages
+    page_size = 1000
+    scroll_timeout = "5m"
 
     @staticmethod
-    def get_query_cohort(elastic_query, elastic_index="meta-index"):
-        print("Getting cohort for elastic-query: {}".format(elastic_query))
+    def iter_query_cohort(elastic_query, elastic_index="meta-index", page_size=None, limit=None):
+        """
+        Generator over all hits of elastic_query, fetched page by page with the scroll API.
+        Only the study-/series-/SOPInstanceUID and the modality are fetched.
+        """
+        print("Streaming cohort for elastic-query: {}".format(elastic_query))
         print("elastic-index: {}".format(elastic_index))
 
         queryDict = {}
@@ -19,17 +35,32 @@ class HelperElasticsearch():
         queryDict["_source"] = {"includes": [HelperElasticsearch.study_uid_tag, HelperElasticsearch.series_uid_tag,
                                              HelperElasticsearch.SOPInstanceUID_tag, HelperElasticsearch.modality_tag]}
 
+        from elasticsearch import helpers
+        hits = helpers.scan(HelperElasticsearch.es,
+                            query=queryDict,
+                            index=elastic_index,
+                            size=page_size or HelperElasticsearch.page_size,
+                            scroll=HelperElasticsearch.scroll_timeout,
+                            preserve_order=False,
+                            clear_scroll=True)
         try:
-            res = HelperElasticsearch.es.search(index=[elastic_index], body=queryDict, size=10000, from_=0)
+            for hit_count, hit in enumerate(hits):
+                if limit is not None and hit_count >= limit:
+                    break
+                yield hit
+        finally:
+            # releases the scroll context if the caller stops early
+            hits.close()
+
+    @staticmethod
+    def get_query_cohort(elastic_query, elastic_index="meta-index", page_size=None, limit=None):
+        try:
+            return list(HelperElasticsearch.iter_query_cohort(elastic_query=elastic_query, elastic_index=elastic_index, page_size=page_size, limit=limit))
         except Exception as e:
             print("ERROR in elasticsearch search!")
             print(e)
             return None
 
-        hits = res['hits']['hits']
-
-        return hits
-
     @staticmethod
     def get_series_metadata(series_uid, elastic_index="meta-index"):
         queryDict = {}
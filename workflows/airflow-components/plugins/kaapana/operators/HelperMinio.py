@@ -1,30 +1,171 @@
 import os
+import hashlib
 import pathlib
+import threading
+from multiprocessing.pool import ThreadPool
 from datetime import timedelta
 
-from minio import Minio
 from minio.error import (ResponseError, BucketAlreadyOwnedByYou,
                          BucketAlreadyExists, NoSuchBucket, NoSuchKey)
+from kaapana.operators.HelperClients import LazyClient
+
+
+def create_minio_client():
+    import urllib3
+    from minio import Minio
+    # one pooled connection per parallel transfer
+    http_client = urllib3.PoolManager(
+        timeout=urllib3.Timeout.DEFAULT_TIMEOUT,
+        maxsize=HelperMinio.max_workers,
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
+    return Minio(HelperMinio._minio_host+":"+HelperMinio._minio_port,
+                 access_key=os.environ.get('MINIOUSER'),
+                 secret_key=os.environ.get('MINIOPASSWORD'),
+                 secure=False,
+                 http_client=http_client)
+
+
+class MinioUploadStream():
+    """
+    Writable file object uploading everything written to it as one multipart upload, the size doesn't have to be known in advance.
+    Full parts are uploaded on a pool of HelperMinio.max_workers threads while the next part is written,
+    so at most max_workers + 1 parts are held in memory.
+    The part size grows every 1000 parts to stay below the 10000 parts limit of S3 (~880GB with the default part size).
+    minio 6 has no public api for uploads of unknown size, the multipart calls of the client are used directly.
+    """
+    part_size = 16 * 1024 * 1024
+
+    def __init__(self, minioClient, bucket_name, object_name, content_type='application/octet-stream'):
+        from minio.definitions import UploadPart
+        self.UploadPart = UploadPart
+        self.minioClient = minioClient
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.upload_id = minioClient._new_multipart_upload(bucket_name, object_name, {'Content-Type': content_type})
+        self.buffer = bytearray()
+        self.part_count = 0
+        self.size = 0
+        self.uploaded_parts = {}
+        self.error = None
+        self.closed = False
+        self.threadpool = ThreadPool(HelperMinio.max_workers)
+        self.free_slots = threading.BoundedSemaphore(HelperMinio.max_workers)
+
+    def upload_part(self, part_number, part_data):
+        etag, _ = self.minioClient._do_put_object(self.bucket_name, self.object_name, part_data, len(part_data), self.upload_id, part_number)
+        return part_number, etag, len(part_data)
+
+    def part_uploaded(self, result):
+        part_number, etag, size = result
+        self.uploaded_parts[part_number] = self.UploadPart(self.bucket_name, self.object_name, self.upload_id, part_number, etag, None, size)
+        self.free_slots.release()
+
+    def part_failed(self, error):
+        self.error = self.error or error
+        self.free_slots.release()
+
+    def submit_part(self, part_data):
+        self.free_slots.acquire()
+        if self.error is not None:
+            self.free_slots.release()
+            raise self.error
+        self.part_count += 1
+        self.threadpool.apply_async(self.upload_part, (self.part_count, part_data), callback=self.part_uploaded, error_callback=self.part_failed)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed upload stream')
+        self.buffer += data
+        self.size += len(data)
+        current_part_size = self.part_size * (1 + self.part_count // 1000)
+        while len(self.buffer) >= current_part_size:
+            self.submit_part(bytes(self.buffer[:current_part_size]))
+            del self.buffer[:current_part_size]
+            current_part_size = self.part_size * (1 + self.part_count // 1000)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            # the last part may be smaller than 5MB
+            if self.buffer or self.part_count == 0:
+                self.submit_part(bytes(self.buffer))
+                self.buffer = bytearray()
+            self.threadpool.close()
+            self.threadpool.join()
+            if self.error is not None:
+                raise self.error
+            self.minioClient._complete_multipart_upload(self.bucket_name, self.object_name, self.upload_id, self.uploaded_parts)
+            print(f"Uploaded {self.size} bytes in {self.part_count} parts to {self.bucket_name}/{self.object_name}")
+        except:
+            self.abort()
+            raise
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+        self.threadpool.terminate()
+        print(f"Aborting upload of {self.bucket_name}/{self.object_name}")
+        try:
+            self.minioClient._remove_incomplete_upload(self.bucket_name, self.object_name, self.upload_id)
+        except ResponseError as err:
+            print(err)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
 
 class HelperMinio():
 
     _minio_host='minio-service.store.svc'
     _minio_port='9000'
-    minioClient = Minio(_minio_host+":"+_minio_port,
-                        access_key=os.environ.get('MINIOUSER'),
-                        secret_key=os.environ.get('MINIOPASSWORD'),
-                        secure=False)
+    # built on first use
+    minioClient = LazyClient("minio", create_minio_client)
+
+    # number of parallel transfers per call, the Minio client is thread safe
+    max_workers = 8
+
+    @staticmethod
+    def get_local_etag(file_path):
+        # The ETag of a single part upload is the md5 of the object, multipart ETags ("<md5>-<parts>") can't be reproduced without the part size
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
 
     @staticmethod
-    def apply_action_to_file(minioClient, action, bucket_name, object_name, file_path, file_white_tuples=None):
+    def is_up_to_date(file_path, size, etag):
+        if size is None or etag is None or not os.path.isfile(file_path) or os.path.getsize(file_path) != size:
+            return False
+        etag = etag.strip('"')
+        if '-' in etag:
+            return False
+        return HelperMinio.get_local_etag(file_path) == etag
+
+    @staticmethod
+    def apply_action_to_file(minioClient, action, bucket_name, object_name, file_path, file_white_tuples=None, size=None, etag=None):
         print(file_path)
         if file_white_tuples is not None and not file_path.lower().endswith(file_white_tuples):
             print(f'Not applying action to object {object_name}, since this action is only allowed for files that end with {file_white_tuples}!')
             return
         if action == 'get': 
+            if HelperMinio.is_up_to_date(file_path, size, etag):
+                print(f"Skipping file: {object_name}, since {file_path} is already up to date")
+                return
             print(f"Getting file: {object_name} from {bucket_name} to {file_path}")
             try:
-                minioClient.stat_object(bucket_name, object_name)
                 os.makedirs(os.path.dirname(file_path), exist_ok=True)
                 minioClient.fget_object(bucket_name, object_name, file_path)
             except NoSuchKey as err:
@@ -50,13 +191,95 @@ class HelperMinio():
         else:
             raise NameError('You need to define an action: get, remove or put!')
 
+    @staticmethod
+    def remove_objects(minioClient, bucket_name, object_names):
+        # remove_objects is lazy, the deletion requests (1000 objects each) are only sent while iterating over the errors
+        object_names = list(object_names)
+        print(f"Removing {len(object_names)} files from {bucket_name}")
+        errors = list(minioClient.remove_objects(bucket_name, object_names))
+        for err in errors:
+            print(f"Could not remove {err.object_name}: {err.error_message}")
+        if errors:
+            raise Exception(f'Could not remove {len(errors)} objects from {bucket_name}')
+
+    @staticmethod
+    def apply_action_to_files(minioClient, action, bucket_name, file_jobs, file_white_tuples=None):
+        """
+        Applies action to all (object_name, file_path[, size, etag]) tuples of file_jobs.
+        Removes are sent as bulk requests, gets and puts run on a pool of max_workers threads.
+        """
+        if action not in ['get', 'remove', 'put']:
+            raise NameError('You need to define an action: get, remove or put!')
+        file_jobs = list(file_jobs)
+        if not file_jobs:
+            return
+        if action == 'remove':
+            object_names = [file_job[0] for file_job in file_jobs if file_white_tuples is None or file_job[1].lower().endswith(file_white_tuples)]
+            HelperMinio.remove_objects(minioClient, bucket_name, object_names)
+            return
+        if action == 'put':
+            print(f'Creating bucket {bucket_name} if it does not already exist.')
+            HelperMinio.make_bucket(minioClient, bucket_name)
+
+        def apply_action(file_job):
+            object_name, file_path, *stat = file_job
+            if action == 'put':
+                try:
+                    minioClient.fput_object(bucket_name, object_name, file_path)
+                except ResponseError as err:
+                    print(err)
+                    raise
+                print(f"Put file: {file_path} to {bucket_name} to {object_name}")
+            else:
+                HelperMinio.apply_action_to_file(minioClient, action, bucket_name, object_name, file_path, file_white_tuples, *stat)
+
+        if action == 'put' and file_white_tuples is not None:
+            for object_name, file_path, *_ in file_jobs:
+                if not file_path.lower().endswith(file_white_tuples):
+                    print(f'Not applying action to object {object_name}, since this action is only allowed for files that end with {file_white_tuples}!')
+            file_jobs = [file_job for file_job in file_jobs if file_job[1].lower().endswith(file_white_tuples)]
+
+        with ThreadPool(max(1, min(HelperMinio.max_workers, len(file_jobs)))) as threadpool:
+            for _ in threadpool.imap_unordered(apply_action, file_jobs):
+                pass
+
+    @staticmethod
+    def list_object_dirs(minioClient, bucket_name, object_dirs=None, split_level=None):
+        """
+        Lists the objects located in object_dirs, only the prefixes of object_dirs are listed instead of the whole bucket.
+        Without split_level only the objects directly located in an object_dir are returned,
+        with split_level all objects whose first split_level path parts match an object_dir.
+        """
+        if not object_dirs:
+            yield from minioClient.list_objects(bucket_name, recursive=True)
+            return
+
+        recursive = split_level is not None and split_level > 0
+        listed_object_names = set()
+        for object_dir in dict.fromkeys(object_dirs):
+            prefix = object_dir.strip('/')
+            prefix = f'{prefix}/' if prefix not in ['', '.'] else ''
+            for bucket_obj in minioClient.list_objects(bucket_name, prefix=prefix, recursive=recursive):
+                if bucket_obj.is_dir or bucket_obj.object_name in listed_object_names:
+                    continue
+                path_object_name = pathlib.Path(bucket_obj.object_name)
+                # select folder level to look into
+                if recursive:
+                    path_object_dir = os.path.join(*path_object_name.parts[:split_level])
+                else:
+                    path_object_dir = os.path.join(path_object_name.parent)
+                if path_object_dir in object_dirs:
+                    listed_object_names.add(bucket_obj.object_name)
+                    yield bucket_obj
 
     @staticmethod
     def apply_action_to_object_names(minioClient, action, bucket_name, local_root_dir, object_names=None, file_white_tuples=None):
+        file_jobs = []
         for object_name in object_names:
             file_path = os.path.join(local_root_dir, object_name)
             if action!='put' or os.path.isfile(file_path):
-                HelperMinio.apply_action_to_file(minioClient, action, bucket_name, object_name, file_path, file_white_tuples)
+                file_jobs.append((object_name, file_path))
+        HelperMinio.apply_action_to_files(minioClient, action, bucket_name, file_jobs, file_white_tuples)
             
     @staticmethod
     def apply_action_to_object_dirs(minioClient,
@@ -71,6 +294,7 @@ class HelperMinio():
             if not object_dirs:
                 print(f'Uploading everything from {local_root_dir}')
                 object_dirs = ['']
+            file_jobs = []
             for object_dir in object_dirs:
                 for path, _, files in os.walk(os.path.join(local_root_dir, object_dir)):
                     for name in files:
@@ -78,23 +302,29 @@ class HelperMinio():
                         rel_dir = os.path.relpath(path, local_root_dir)
                         rel_dir = '' if rel_dir== '.' else rel_dir
                         object_name =os.path.join(rel_dir, name)
-                        HelperMinio.apply_action_to_file(minioClient, action, bucket_name, object_name, file_path, file_white_tuples)
+                        file_jobs.append((object_name, file_path))
+            HelperMinio.apply_action_to_files(minioClient, action, bucket_name, file_jobs, file_white_tuples)
         else:
             try:
-                for bucket_obj in minioClient.list_objects(bucket_name, recursive=True):
+                file_jobs = []
+                for bucket_obj in HelperMinio.list_object_dirs(minioClient, bucket_name, object_dirs, split_level):
                     object_name = bucket_obj.object_name
                     file_path = os.path.join(local_root_dir, object_name)
-                    path_object_name = pathlib.Path(object_name)
-                    # select folder level to look into
-                    if split_level and split_level > 0:
-                        path_object_dir = os.path.join(*path_object_name.parts[:split_level])
-                    else:
-                        path_object_dir = os.path.join(path_object_name.parent)
-                    if not object_dirs or path_object_dir in object_dirs:
-                        HelperMinio.apply_action_to_file(minioClient, action, bucket_name, object_name, file_path, file_white_tuples)
+                    file_jobs.append((object_name, file_path, bucket_obj.size, bucket_obj.etag))
+                HelperMinio.apply_action_to_files(minioClient, action, bucket_name, file_jobs, file_white_tuples)
             except NoSuchBucket as err:
                 print(f'Skipping since bucket {bucket_name} does not exist')
 
+    @staticmethod
+    def open_upload_stream(minioClient, bucket_name, object_name, content_type='application/octet-stream'):
+        """
+        Returns a MinioUploadStream to write an object of unknown size (e.g. an archive) directly to Minio without a local file.
+        """
+        print(f'Creating bucket {bucket_name} if it does not already exist.')
+        HelperMinio.make_bucket(minioClient, bucket_name)
+        print(f"Streaming to {bucket_name}/{object_name}")
+        return MinioUploadStream(minioClient, bucket_name, object_name, content_type)
+
     @staticmethod
     def make_bucket(minioClient, bucket_name):
         try:
@@ -272,6 +272,8 @@ class KaapanaBaseOperator(BaseOperator):
         }
         if hasattr(self, 'operator_in_dir'):
             envs["OPERATOR_IN_DIR"] = str(self.operator_in_dir)
+        if self.cpu_millicores is not None:
+            envs["CPU_MILLICORES"] = str(self.cpu_millicores)
 
         if http_proxy is not None and http_proxy != "" and self.enable_proxy:
             envs.update(
@@ -0,0 +1,144 @@
+from datetime import timedelta
+
+from airflow.exceptions import DagNotFound
+from airflow.models import DagRun, DagModel, DagBag, TaskInstance
+from airflow import settings
+from airflow.settings import task_instance_mutation_hook
+from airflow.configuration import conf as airflow_conf
+from airflow.utils.state import State
+from airflow.utils import timezone
+
+from kaapana.operators.KaapanaPythonBaseOperator import KaapanaPythonBaseOperator
+from kaapana.operators.HelperElasticsearch import HelperElasticsearch
+
+
+def get_series_conf(hit, tmp_conf):
+    hit = hit["_source"]
+    studyUID = hit[HelperElasticsearch.study_uid_tag]
+    seriesUID = hit[HelperElasticsearch.series_uid_tag]
+    modality = hit[HelperElasticsearch.modality_tag]
+
+    conf = {
+        "inputs": [
+            {
+                "dcm-uid": {
+                    "study-uid": studyUID,
+                    "series-uid": seriesUID,
+                    "modality": modality
+                }
+            }
+        ],
+        "conf": tmp_conf
+    }
+    return seriesUID, conf
+
+
+def create_dag_runs(dag, dag_run_entries, session):
+    """
+    Same as trigger() -> DAG.create_dagrun() -> DagRun.verify_integrity() for a list of (run_id, execution_date, conf),
+    but all DagRuns and TaskInstances are added in one transaction instead of several commits per run.
+    """
+    for run_id, execution_date, run_conf in dag_run_entries:
+        for _dag in [dag] + dag.subdags:
+            session.add(DagRun(dag_id=_dag.dag_id,
+                               run_id=run_id,
+                               execution_date=execution_date,
+                               external_trigger=True,
+                               conf=run_conf,
+                               state=State.RUNNING))
+            for task in _dag.task_dict.values():
+                if task.start_date is not None and task.start_date > execution_date:
+                    continue
+                ti = TaskInstance(task, execution_date)
+                task_instance_mutation_hook(ti)
+                session.add(ti)
+    session.commit()
+
+
+def get_created_series(session, dag_id, job_id):
+    """
+    :returns: number of DagRuns already created for job_id, seriesUIDs of their confs
+    """
+    # job_id is a generated run_id -> may contain the LIKE wildcard "_"
+    job_id_pattern = job_id.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    dag_runs = session.query(DagRun).filter(DagRun.dag_id == dag_id, DagRun.run_id.like(f"{job_id_pattern}-%", escape="\\")).all()
+    created_series = set()
+    for dag_run in dag_runs:
+        for run_input in (dag_run.conf or {}).get("inputs", []):
+            created_series.add(run_input["dcm-uid"]["series-uid"])
+    return len(dag_runs), created_series
+
+
+class LocalBulkTriggerOperator(KaapanaPythonBaseOperator):
+    """
+    Creates one DagRun of conf["bulk_trigger"]["dag_id"] per series of an elastic cohort.
+    Runs as task of the service-bulk-trigger DAG (triggered by the meta-trigger api) and not inside the webserver,
+    so long cohorts are not killed with a recycled gunicorn worker. The DagRun of this task is the job:
+    its run_id is the job_id and the created DagRuns are named <job_id>-<number>.
+    A retry only creates the DagRuns of the series which have not been triggered yet.
+    """
+
+    def start(self, ds, **kwargs):
+        bulk_conf = kwargs['dag_run'].conf["bulk_trigger"]
+        job_id = kwargs['dag_run'].run_id
+        dag_id = bulk_conf["dag_id"]
+        print(f"Bulk trigger {job_id}: {dag_id}")
+
+        session = settings.Session()
+        try:
+            # the dag file is only parsed once for the whole cohort
+            dag_model = DagModel.get_current(dag_id)
+            if dag_model is None:
+                raise DagNotFound("Dag id {} not found in DagModel".format(dag_id))
+            dagbag = DagBag(dag_folder=dag_model.fileloc, store_serialized_dags=airflow_conf.getboolean('core', 'store_serialized_dags'))
+            dag = dagbag.get_dag(dag_id)
+            if dag is None:
+                raise DagNotFound("Dag id {} not found".format(dag_id))
+
+            # the scroll order is not stable -> a retry skips the series of the DagRuns which have already been created
+            created, created_series = get_created_series(session, dag_id, job_id)
+            if created > 0:
+                print(f"{created} DagRuns already created -> continuing")
+
+            dag_run_entries = []
+            execution_date = None
+            hits = HelperElasticsearch.iter_query_cohort(elastic_query=bulk_conf["query"], elastic_index=bulk_conf["index"], limit=bulk_conf["cohort_limit"])
+            for hit in hits:
+                seriesUID, conf = get_series_conf(hit, bulk_conf["conf"])
+                if seriesUID in created_series:
+                    continue
+                # (dag_id, execution_date) has to be unique
+                execution_date = max(timezone.utcnow(), execution_date + timedelta(microseconds=1)) if execution_date else timezone.utcnow()
+                dag_run_entries.append((f"{job_id}-{created + len(dag_run_entries):06d}", execution_date, conf))
+
+                if len(dag_run_entries) >= self.batch_size:
+                    create_dag_runs(dag, dag_run_entries, session)
+                    created += len(dag_run_entries)
+                    dag_run_entries = []
+                    print(f"{created} DagRuns created")
+
+            if dag_run_entries:
+                create_dag_runs(dag, dag_run_entries, session)
+                created += len(dag_run_entries)
+            print(f"Done: {created} DagRuns created")
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def __init__(self,
+                 dag,
+                 batch_size=100,
+                 *args, **kwargs):
+
+        # number of DagRuns created per transaction
+        self.batch_size = batch_size
+
+        super().__init__(
+            dag,
+            name="bulk-trigger",
+            python_callable=self.start,
+            execution_timeout=timedelta(hours=6),
+            *args, **kwargs
+        )
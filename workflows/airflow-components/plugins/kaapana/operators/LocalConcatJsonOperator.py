@@ -1,11 +1,39 @@
 import os
 import glob
+import gzip
 import json
 import datetime
+from collections import deque
+from multiprocessing import Pool
 
 from kaapana.operators.KaapanaPythonBaseOperator import KaapanaPythonBaseOperator
 from kaapana.blueprints.kaapana_global_variables import BATCH_NAME, WORKFLOW_DIR
 
+
+def read_json_record(json_file, output_format):
+    """
+    Loads json_file and returns it serialized for the output file, so the worker processes do the parsing and encoding.
+    """
+    with open(json_file) as data_file:
+        json_dict = json.load(data_file)
+    if output_format == 'jsonl':
+        return json.dumps(json_dict, sort_keys=True)
+    # same layout as json.dump(records, indent=4, sort_keys=True) of the whole list
+    return "\n".join("    " + line for line in json.dumps(json_dict, indent=4, sort_keys=True).split("\n"))
+
+
+def iter_json_records(json_files, output_format, parallel_processes):
+    # records are returned in input order, at most 4 * parallel_processes records are held in memory
+    with Pool(parallel_processes) as pool:
+        pending = deque()
+        for json_file in json_files:
+            pending.append(pool.apply_async(read_json_record, (json_file, output_format)))
+            if len(pending) >= 4 * parallel_processes:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
 class LocalConcatJsonOperator(KaapanaPythonBaseOperator):
 
     def start(self, ds, **kwargs):
@@ -15,31 +43,53 @@ class LocalConcatJsonOperator(KaapanaPythonBaseOperator):
         run_dir = os.path.join(WORKFLOW_DIR, kwargs['dag_run'].run_id)
         batch_dirs = [f for f in glob.glob(os.path.join(run_dir, BATCH_NAME, '*'))]
         timestamp=datetime.datetime.utcnow()
-        json_output_path=os.path.join(run_dir,self.operator_out_dir,"{}-{}.json".format(timestamp, self.name))
+        json_output_path=os.path.join(run_dir,self.operator_out_dir,"{}-{}.{}".format(timestamp, self.name, self.output_format))
+        if self.gzip_output:
+            json_output_path += ".gz"
         if not os.path.exists(os.path.dirname(json_output_path)):
             os.makedirs(os.path.dirname(json_output_path))
 
         json_files=[]
         for batch_element_dir in batch_dirs:
-            batch_el_json_files = sorted(glob.glob(os.path.join(batch_element_dir, self.operator_in_dir,"**","*.json*"),recursive=True))
-            for json_file in batch_el_json_files:
-                with open(json_file) as data_file:    
-                    json_dict = json.load(data_file)
-                json_files.append(json_dict)
-
+            json_files.extend(sorted(glob.glob(os.path.join(batch_element_dir, self.operator_in_dir,"**","*.json*"),recursive=True)))
 
-        with open(json_output_path, "w", encoding='utf-8') as jsonData:
-            json.dump(json_files, jsonData, indent=4, sort_keys=True)
+        print(f"Concatenating {len(json_files)} json files to {json_output_path}")
+        open_output = gzip.open if self.gzip_output else open
+        # the records are written one by one, the concatenated list is never held in memory
+        with open_output(json_output_path, "wt", encoding='utf-8') as jsonData:
+            records = iter_json_records(json_files, self.output_format, self.parallel_processes)
+            if self.output_format == 'jsonl':
+                for record in records:
+                    jsonData.write(record + "\n")
+            elif not json_files:
+                jsonData.write("[]")
+            else:
+                jsonData.write("[\n")
+                for index, record in enumerate(records):
+                    if index > 0:
+                        jsonData.write(",\n")
+                    jsonData.write(record)
+                jsonData.write("\n]")
 
 
     def __init__(self,
                  dag,
                  name='concatenated',
+                 output_format='json',
+                 gzip_output=False,
+                 parallel_processes=4,
                  *args, **kwargs):
 
+        if output_format not in ['json', 'jsonl']:
+            raise AssertionError('output_format must be json or jsonl')
+
+        self.output_format = output_format
+        self.gzip_output = gzip_output
+        self.parallel_processes = parallel_processes
+
         super().__init__(
             dag,
             name=name,
             python_callable=self.start,
             *args, **kwargs
-        )
\ No newline at end of file
+        )
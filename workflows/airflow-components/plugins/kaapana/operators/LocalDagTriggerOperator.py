@@ -45,8 +45,7 @@ class LocalDagTriggerOperator(KaapanaPythonBaseOperator):
 
         return loaded_from_cache
 
-    def get_dicom_list(self):
-        dicom_info_list = []
+    def iter_dicom_list(self):
         if not self.use_dcm_files and self.conf == None or not "inputs" in self.conf:
             print("No config or inputs in config found!")
             print("Abort.")
@@ -73,14 +72,13 @@ class LocalDagTriggerOperator(KaapanaPythonBaseOperator):
                 study_uid = dicom_file[0x0020, 0x000D].value
                 series_uid = dicom_file[0x0020, 0x000E].value
                 modality = dicom_file[0x0008, 0x0060].value
-                dicom_info_list.append(
-                    {
-                        "dcm-uid": {
-                            "study-uid": study_uid,
-                            "series-uid": series_uid,
-                            "modality": modality
-                        }
-                    })
+                yield {
+                    "dcm-uid": {
+                        "study-uid": study_uid,
+                        "series-uid": series_uid,
+                        "modality": modality
+                    }
+                }
         else:
             inputs = self.conf["inputs"]
             if not isinstance(inputs, list):
@@ -101,22 +99,20 @@ class LocalDagTriggerOperator(KaapanaPythonBaseOperator):
                     query = elastic_query["query"]
                     index = elastic_query["index"]
 
-                    cohort = HelperElasticsearch.get_query_cohort(elastic_index=index, elastic_query=query)
-                    for series in cohort:
+                    # the cohort is streamed page by page -> cache checks and triggers start with the first page
+                    for series in HelperElasticsearch.iter_query_cohort(elastic_index=index, elastic_query=query):
                         series = series["_source"]
                         study_uid = series[HelperElasticsearch.study_uid_tag]
                         series_uid = series[HelperElasticsearch.series_uid_tag]
                         # SOPInstanceUID = series[ElasticDownloader.SOPInstanceUID_tag]
                         modality = series[HelperElasticsearch.modality_tag]
-                        dicom_info_list.append(
-                            {
-                                "dcm-uid": {
-                                    "study-uid": study_uid,
-                                    "series-uid": series_uid,
-                                    "modality": modality
-                                }
+                        yield {
+                            "dcm-uid": {
+                                "study-uid": study_uid,
+                                "series-uid": series_uid,
+                                "modality": modality
                             }
-                        )
+                        }
 
                 elif "dcm-uid" in input:
                     dcm_uid = input["dcm-uid"]
@@ -134,15 +130,13 @@ class LocalDagTriggerOperator(KaapanaPythonBaseOperator):
                     series_uid = dcm_uid["series-uid"]
                     modality = dcm_uid["modality"]
 
-                    dicom_info_list.append(
-                        {
-                            "dcm-uid": {
-                                "study-uid": study_uid,
-                                "series-uid": series_uid,
-                                "modality": modality
-                            }
+                    yield {
+                        "dcm-uid": {
+                            "study-uid": study_uid,
+                            "series-uid": series_uid,
+                            "modality": modality
                         }
-                    )
+                    }
 
                 else:
                     print("Error with dag-config!")
@@ -151,7 +145,13 @@ class LocalDagTriggerOperator(KaapanaPythonBaseOperator):
                     print("Dag-conf: {}".format(self.conf))
                     exit(1)
 
-        return dicom_info_list
+    def trigger_series(self, element):
+        conf = {
+            "inputs": element,
+            "conf": self.conf
+        }
+        dag_run_id = generate_run_id(self.trigger_dag_id)
+        return trigger(dag_id=self.trigger_dag_id, run_id=dag_run_id, conf=conf, replace_microseconds=False)
 
     def trigger_dag(self, ds, **kwargs):
         pending_dags = []
@@ -161,9 +161,8 @@ class LocalDagTriggerOperator(KaapanaPythonBaseOperator):
         self.dag_run_id = kwargs['dag_run'].run_id
         self.run_dir = os.path.join(WORKFLOW_DIR, self.dag_run_id)
 
-        dicom_info_list = self.get_dicom_list()
         trigger_series_list = []
-        for dicom_series in dicom_info_list:
+        for dicom_series in self.iter_dicom_list():
             for cache_operator in self.cache_operators:
                 cache_found = self.check_cache(dicom_series=dicom_series,cache_operator=cache_operator)
 
@@ -172,7 +171,9 @@ class LocalDagTriggerOperator(KaapanaPythonBaseOperator):
                         trigger_series_list.append([])
                     trigger_series_list[0].append(dicom_series)
                 elif not cache_found and self.trigger_mode == "single":
+                    # triggered right away, the remaining cohort is still streamed from elasticsearch
                     trigger_series_list.append([dicom_series])
+                    pending_dags.append(self.trigger_series(trigger_series_list[-1]))
 
                 elif not cache_found:
                     print()
@@ -194,14 +195,9 @@ class LocalDagTriggerOperator(KaapanaPythonBaseOperator):
         print("#############################################################")
         print()
 
-        for element in trigger_series_list:
-            conf = {
-                "inputs": element,
-                "conf": self.conf
-            }
-            dag_run_id = generate_run_id(self.trigger_dag_id)
-            triggered_dag = trigger(dag_id=self.trigger_dag_id, run_id=dag_run_id, conf=conf, replace_microseconds=False)
-            pending_dags.append(triggered_dag)
+        if self.trigger_mode == "batch":
+            for element in trigger_series_list:
+                pending_dags.append(self.trigger_series(element))
 
         while self.wait_till_done and len(pending_dags) > 0:
             print("Some triggered DAGs are still pending -> waiting {} s".format(self.delay))
@@ -1,28 +1,49 @@
 # -*- coding: utf-8 -*-
 
-import subprocess
 import os
-import fnmatch
 import json
-import yaml
-from pathlib import Path
-import shutil
-import pathlib
-from datetime import datetime
-from dateutil import parser
-import pytz
-import traceback
-import logging
 import glob
-from shutil import copyfile, rmtree
-import errno
-import re
+import pydicom
+from multiprocessing import Pool
 
 from kaapana.operators.KaapanaPythonBaseOperator import KaapanaPythonBaseOperator
 from kaapana.blueprints.kaapana_global_variables import BATCH_NAME, WORKFLOW_DIR
 from kaapana.operators.HelperCaching import cache_operator_output
 from kaapana.operators.Dcm2MetaJsonConverter import Dcm2MetaJsonConverter
 
+# (0014,3080) Bad Pixel Image
+# (7FE0,0008) Float Pixel Data
+# (7FE0,0009) Double Float Pixel Data
+# (7FE0,0010) Pixel Data -> never read because of stop_before_pixels
+SKIP_TAGS = [0x00143080, 0x7FE00008, 0x7FE00009, 0x7FE00010]
+
+converter = None
+
+
+def init_worker(worker_converter):
+    global converter
+    converter = worker_converter
+
+
+def extract_metadata(dcm_file_path, json_file_path):
+    """
+    Reads the DICOM header (without pixel data) and writes the converted meta-json.
+    Runs inside the worker processes -> uses the per process converter.
+    """
+    print(("Extracting metadata: %s" % dcm_file_path))
+    dataset = pydicom.dcmread(dcm_file_path, stop_before_pixels=True)
+    for tag in SKIP_TAGS:
+        if tag in dataset:
+            del dataset[tag]
+
+    dcm_json_dict = dataset.to_json_dict()
+    meta_json_dict = converter.dcmJson2metaJson(dcm_json_dict)
+
+    with open(json_file_path, "w", encoding='utf-8') as jsonData:
+        json.dump(meta_json_dict, jsonData, indent=4, sort_keys=True, ensure_ascii=True)
+
+    return json_file_path
+
 
 class LocalDcm2JsonOperator(KaapanaPythonBaseOperator):
 
@@ -34,9 +55,7 @@ class LocalDcm2JsonOperator(KaapanaPythonBaseOperator):
         run_dir = os.path.join(WORKFLOW_DIR, kwargs['dag_run'].run_id)
         batch_folder = [f for f in glob.glob(os.path.join(run_dir, BATCH_NAME, '*'))]
 
-        with open(self.dict_path, encoding='utf-8') as dict_data:
-            self.dictionary = json.load(dict_data)
-
+        extraction_jobs = []
         for batch_element_dir in batch_folder:
             dcm_files = sorted(glob.glob(os.path.join(batch_element_dir, self.operator_in_dir, "*.dcm*"), recursive=True))
 
@@ -45,96 +64,51 @@ class LocalDcm2JsonOperator(KaapanaPythonBaseOperator):
                 exit(1)
 
             print('length', len(dcm_files))
-            for dcm_file_path in dcm_files:
-
-                print(("Extracting metadata: %s" % dcm_file_path))
-
-                target_dir = os.path.join(batch_element_dir, self.operator_out_dir)
-                if not os.path.exists(target_dir):
-                    os.makedirs(target_dir)
-
-                json_file_path = os.path.join(target_dir, "{}.json".format(os.path.basename(batch_element_dir)))
-
-                if self.delete_private_tags:
-                    print("Deleting private tags!")
-                    command = "%s --no-backup --ignore-missing-tags --erase-all \"(0014,3080)\" --erase-all \"(7FE0,0008)\" --erase-all \"(7FE0,0009)\" --erase-all \"(7FE0,0010)\" %s;" % (
-                        self.dcmodify_path, dcm_file_path)
-                else:
-                    command = "%s --no-backup --ignore-missing-tags --erase-all \"(0014,3080)\" --erase-all \"(7FE0,0008)\" --erase-all \"(7FE0,0009)\" --erase-all \"(7FE0,0010)\" %s;" % (
-                        self.dcmodify_path, dcm_file_path)
-                # (0014,3080) Bad Pixel Image
-                # (7FE0,0008) Float Pixel Data
-                # (7FE0,0009) Double Float Pixel Data
-                # (7FE0,0010) Pixel Data
-                ret = subprocess.call([command], shell=True)
-                if ret != 0:
-                    print("Something went wrong with dcmodify...")
-                    exit(1)
-                self.executeDcm2Json(dcm_file_path, json_file_path)
-
-                with open(json_file_path, "r") as fp:
-                    dcm_json_dict = json.load(fp)
-
-                meta_json_dict = self.converter.dcmJson2metaJson(dcm_json_dict)
-
-                with open(json_file_path, "w", encoding='utf-8') as jsonData:
-                    json.dump(meta_json_dict, jsonData, indent=4, sort_keys=True, ensure_ascii=True)
-
-                # shutil.rmtree(self.temp_dir)
-
-                if self.bulk == False:
-                    break
-
-    def executeDcm2Json(self, inputDcm, outputJson):
-        """
-        Executes a conversion service
-
-        program -- path to the service
-        arguments -- the arguments for the service
-        """
-
-        command = self.dcm2json_path + " " + \
-            self.withAppostroph(inputDcm) + " " + \
-            self.withAppostroph(outputJson)
-        print(("Executing: " + command))
-        ret = subprocess.call(command, shell=True)
-        if ret != 0:
-            print("Something went wrong with dcm2json...")
-            exit(1)
-        return
-
-    def withAppostroph(self, content):
-        return "\"" + content + "\""
+            target_dir = os.path.join(batch_element_dir, self.operator_out_dir)
+            if not os.path.exists(target_dir):
+                os.makedirs(target_dir)
+
+            json_file_path = os.path.join(target_dir, "{}.json".format(os.path.basename(batch_element_dir)))
+            # with bulk every file of the batch element is written to the same json -> only the last one is kept
+            dcm_file_path = dcm_files[-1] if self.bulk else dcm_files[0]
+            extraction_jobs.append((dcm_file_path, json_file_path))
+
+        if self.converter is None:
+            self.converter = Dcm2MetaJsonConverter(
+                format_time="%H:%M:%S.%f",
+                format_date="%Y-%m-%d",
+                format_date_time="%Y-%m-%d %H:%M:%S.%f",
+                exception_on_error=self.exit_on_error,
+                dict_path=self.dict_path
+            )
+
+        print(f"Extracting metadata of {len(extraction_jobs)} files with {self.parallel_processes} processes")
+        with Pool(self.parallel_processes, initializer=init_worker, initargs=(self.converter,)) as pool:
+            for json_file_path in pool.starmap(extract_metadata, extraction_jobs):
+                print(("Written: %s" % json_file_path))
 
-  
     def __init__(self,
                  dag,
                  exit_on_error=False,
                  delete_private_tags=True,
                  bulk=False,
+                 parallel_processes=4,
                  *args, **kwargs):
 
-        self.dcmodify_path = 'dcmodify'
-        self.dcm2json_path = 'dcm2json'
-        self.converter = Dcm2MetaJsonConverter(
-            format_time="%H:%M:%S.%f",
-            format_date="%Y-%m-%d",
-            format_date_time="%Y-%m-%d %H:%M:%S.%f",
-            exception_on_error=exit_on_error
-        )
+        # the converter loads the whole DICOM dictionary -> built in start and not while the DAG is parsed
+        self.converter = None
 
         self.bulk = bulk
         self.exit_on_error = exit_on_error
         self.delete_private_tags = delete_private_tags
+        self.parallel_processes = parallel_processes
 
         os.environ["PYTHONIOENCODING"] = "utf-8"
-        if 'DCMDICTPATH' in os.environ and 'DICT_PATH' in os.environ:
-            self.dcmdictpath = os.getenv('DCMDICTPATH')
+        if 'DICT_PATH' in os.environ:
             self.dict_path = os.getenv('DICT_PATH')
         else:
             print("++++++++++++++++++++++++++++++++++++++++++++++++++++++")
-            print("DCMDICTPATH or DICT_PATH ENV NOT FOUND!")
-            print("dcmdictpath: {}".format(os.getenv('DCMDICTPATH')))
+            print("DICT_PATH ENV NOT FOUND!")
             print("dict_path: {}".format(os.getenv('DICT_PATH')))
             print("++++++++++++++++++++++++++++++++++++++++++++++++++++++")
             exit(1)
@@ -1,13 +1,74 @@
-import subprocess
 import os
-import errno
 import glob
 import json
 import shutil
+import pydicom
+from multiprocessing import Pool
 
 from kaapana.operators.KaapanaPythonBaseOperator import KaapanaPythonBaseOperator
 from kaapana.blueprints.kaapana_global_variables import BATCH_NAME, WORKFLOW_DIR
 
+ANONYMIZE_TAGS_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "anonymize-tags.json")
+# the body of deflated files can't be copied byte by byte behind a modified header
+DEFLATED_TRANSFER_SYNTAX = "1.2.840.10008.1.2.1.99"
+
+anonymize_tags = None
+
+
+def load_anonymize_tags(anonymize_tags_path=ANONYMIZE_TAGS_PATH):
+    """
+    Compiles the "gggg,eeee" keys of anonymize-tags.json to a set of integer tags.
+    """
+    with open(anonymize_tags_path) as data_file:
+        anonymize_dict = json.load(data_file)
+    anonymize_dict.pop("source", None)
+    return frozenset(int(tag.replace(",", ""), 16) for tag in anonymize_dict.keys())
+
+
+def init_worker(worker_anonymize_tags):
+    global anonymize_tags
+    anonymize_tags = worker_anonymize_tags
+
+
+def erase_tags(dataset, tags):
+    # like dcmodify --erase-all: the tags are removed on every level, including sequence items
+    erased_tags = tags.intersection(dataset.keys())
+    for tag in erased_tags:
+        del dataset[tag]
+    # the header is written like the original -> the group lengths (gggg,0000) of the groups with erased tags would be wrong
+    for group_length_tag in {tag & 0xFFFF0000 for tag in erased_tags}.intersection(dataset.keys()):
+        del dataset[group_length_tag]
+    for element in dataset:
+        if element.VR == "SQ":
+            for item in element.value:
+                erase_tags(item, tags)
+
+
+def anonymize_file(dcm_file, output_filepath):
+    """
+    Only the header is parsed and modified, everything from the pixel data on is copied unchanged from dcm_file.
+    Runs inside the worker processes -> uses the per process tag set.
+    """
+    try:
+        with open(dcm_file, "rb") as dcm:
+            # stops in front of the pixel data element, force: files without preamble / file meta are anonymized as well
+            dataset = pydicom.dcmread(dcm, stop_before_pixels=True, force=True)
+            file_meta = getattr(dataset, "file_meta", None)
+            transfer_syntax = file_meta.get("TransferSyntaxUID") if file_meta is not None else None
+            if transfer_syntax == DEFLATED_TRANSFER_SYNTAX:
+                dcm.seek(0)
+                dataset = pydicom.dcmread(dcm, force=True)
+            erase_tags(dataset, anonymize_tags)
+            with open(output_filepath, "wb") as output:
+                dataset.save_as(output, write_like_original=True)
+                if transfer_syntax != DEFLATED_TRANSFER_SYNTAX:
+                    shutil.copyfileobj(dcm, output, 1024 * 1024)
+    except Exception as e:
+        if os.path.isfile(output_filepath):
+            os.remove(output_filepath)
+        return dcm_file, f"{type(e).__name__}: {e}"
+    return dcm_file, None
+
 
 class LocalDcmAnonymizerOperator(KaapanaPythonBaseOperator):
 
@@ -15,61 +76,52 @@ class LocalDcmAnonymizerOperator(KaapanaPythonBaseOperator):
         print("Starting moule LocalDcmAnonymizerOperator...")
         print(kwargs)
 
-        if os.environ.get('DCMDICTPATH') is None:
-            print("DCMDICTPATH not found...")
-            exit(1)
-
-        anonymize_dict_path = os.path.dirname(os.path.realpath(__file__))+"/anonymize-tags.json"
-
-        with open(anonymize_dict_path) as data_file:
-            anonymize_tags = json.load(data_file)
-            if "source" in anonymize_tags:
-                del anonymize_tags["source"]
-
-        print("Anonymize tag loaded...")
-
-        erase_tags = ""
-        for tag in list(anonymize_tags.keys()):  # [:15]:
-            erase_tags += " --erase-all \"(%s)\"" % tag
+        tags = load_anonymize_tags()
+        print(f"{len(tags)} anonymize tags loaded...")
 
         run_dir = os.path.join(WORKFLOW_DIR, kwargs['dag_run'].run_id)
         batch_dirs = [f for f in glob.glob(os.path.join(run_dir, BATCH_NAME, '*'))]
 
         print("Found {} batch elements.".format(len(batch_dirs)))
 
-        anon_command = "dcmodify --no-backup --ignore-missing-tags " + erase_tags + " "
-
+        anonymize_jobs = []
         for batch_element_dir in batch_dirs:
             batch_element_out_dir = os.path.join(batch_element_dir, self.operator_out_dir)
             dcm_files = sorted(glob.glob(os.path.join(batch_element_dir, self.operator_in_dir, "*.dcm*"), recursive=True))
+            if self.single_slice:
+                dcm_files = dcm_files[:1]
             for dcm_file in dcm_files:
                 output_filepath = os.path.join(batch_element_out_dir, os.path.basename(dcm_file))
-                if not os.path.exists(os.path.dirname(output_filepath)):
-                    os.makedirs(os.path.dirname(output_filepath))
-
-                if not os.path.isfile(output_filepath) or self.overwrite:
-                    shutil.copyfile(dcm_file, output_filepath)
-
-                file_command = anon_command+output_filepath
-                ret = subprocess.call([file_command], shell=True)
-                if ret != 0:
-                    print("Something went wrong with dcmodify...")
-                    exit(1)
-
-                if self.single_slice:
-                    break
+                if os.path.isfile(output_filepath) and not self.overwrite:
+                    print(f"Skipping {dcm_file}, since {output_filepath} already exists")
+                    continue
+                os.makedirs(batch_element_out_dir, exist_ok=True)
+                anonymize_jobs.append((dcm_file, output_filepath))
+
+        print(f"Anonymizing {len(anonymize_jobs)} files with {self.parallel_processes} processes")
+        errors = []
+        with Pool(self.parallel_processes, initializer=init_worker, initargs=(tags,)) as pool:
+            for dcm_file, error in pool.starmap(anonymize_file, anonymize_jobs, chunksize=16):
+                if error is not None:
+                    print(f"Could not anonymize {dcm_file}: {error}")
+                    errors.append(dcm_file)
+
+        if errors:
+            print(f"Anonymization failed for {len(errors)} files!")
+            exit(1)
 
     def __init__(self,
                  dag,
                  bulk=False,
                  overwrite=True,
                  single_slice=False,
+                 parallel_processes=4,
                  *args, **kwargs):
 
-        self.dcmodify_path = 'dcmodify'
         self.bulk = bulk
         self.overwrite = overwrite
         self.single_slice = single_slice
+        self.parallel_processes = parallel_processes
 
         if 'DCMDICTPATH' in os.environ and 'DICT_PATH' in os.environ:
             self.dcmdictpath = os.getenv('DCMDICTPATH')
@@ -10,6 +10,7 @@ import time
 import json
 
 from kaapana.operators.KaapanaPythonBaseOperator import KaapanaPythonBaseOperator
+from kaapana.operators.HelperClients import HelperClients
 from kaapana.blueprints.kaapana_global_variables import BATCH_NAME, WORKFLOW_DIR
 
 
@@ -20,7 +21,7 @@ class LocalDeleteFromElasticOperator(KaapanaPythonBaseOperator):
         if 'conf' in conf and 'form_data' in conf['conf'] and conf['conf']['form_data'] is not None and 'delete_complete_study' in conf['conf']['form_data']:
                 self.delete_complete_study = conf['conf']['form_data']['delete_complete_study']
                 print('Delete entire study set to ', self.delete_complete_study)
-        self.es = Elasticsearch([{'host': self.elastic_host, 'port': self.elastic_port}])
+        self.es = HelperClients.get(("elasticsearch", self.elastic_host, self.elastic_port), lambda: Elasticsearch([{'host': self.elastic_host, 'port': self.elastic_port}]))
         if self.delete_all_documents:
             print("Delting all documents from elasticsearch...")
             query = {"query": {"match_all": {}}}
@@ -78,28 +78,7 @@ class LocalGetInputDataOperator(KaapanaPythonBaseOperator):
 
         return download_successful, seriesUID
 
-    def start(self, ds, **kwargs):
-        print("Starting moule LocalGetInputDataOperator...")
-        self.conf = kwargs['dag_run'].conf
-
-        cohort_limit = None
-        if self.conf is not None and "conf" in self.conf:
-            trigger_conf = self.conf["conf"]
-            cohort_limit = int(trigger_conf["cohort_limit"] if "cohort_limit" in trigger_conf else None)
-
-        dag_run_id = kwargs['dag_run'].run_id
-
-        if self.conf == None or not "inputs" in self.conf:
-            print("No config or inputs in config found!")
-            print("Skipping...")
-            return
-
-        inputs = self.conf["inputs"]
-
-        if not isinstance(inputs, list):
-            inputs = [inputs]
-
-        download_list = []
+    def iter_download_list(self, inputs, dag_run_id, cohort_limit=None):
         for input in inputs:
             if "elastic-query" in input:
                 elastic_query = input["elastic-query"]
@@ -115,9 +94,8 @@ class LocalGetInputDataOperator(KaapanaPythonBaseOperator):
                 query = elastic_query["query"]
                 index = elastic_query["index"]
 
-                cohort = HelperElasticsearch.get_query_cohort(elastic_index=index, elastic_query=query)
-
-                for series in cohort:
+                # the cohort is streamed page by page -> downloads start before the whole cohort is known
+                for series in HelperElasticsearch.iter_query_cohort(elastic_index=index, elastic_query=query, limit=cohort_limit):
                     series = series["_source"]
 
                     study_uid = series[HelperElasticsearch.study_uid_tag]
@@ -130,13 +108,11 @@ class LocalGetInputDataOperator(KaapanaPythonBaseOperator):
                     if self.check_modality:
                         self.check_dag_modality(input_modality=modality)
 
-                    download_list.append(
-                        {
-                            "studyUID": study_uid,
-                            "seriesUID": series_uid,
-                            "dag_run_id": dag_run_id
-                        }
-                    )
+                    yield {
+                        "studyUID": study_uid,
+                        "seriesUID": series_uid,
+                        "dag_run_id": dag_run_id
+                    }
 
             elif "dcm-uid" in input:
                 dcm_uid = input["dcm-uid"]
@@ -157,13 +133,11 @@ class LocalGetInputDataOperator(KaapanaPythonBaseOperator):
                 study_uid = dcm_uid["study-uid"]
                 series_uid = dcm_uid["series-uid"]
 
-                download_list.append(
-                    {
-                        "studyUID": study_uid,
-                        "seriesUID": series_uid,
-                        "dag_run_id": dag_run_id
-                    }
-                )
+                yield {
+                    "studyUID": study_uid,
+                    "seriesUID": series_uid,
+                    "dag_run_id": dag_run_id
+                }
 
             else:
                 print("Error with dag-config!")
@@ -172,11 +146,40 @@ class LocalGetInputDataOperator(KaapanaPythonBaseOperator):
                 print("Dag-conf: {}".format(self.conf))
                 exit(1)
 
-        download_list = download_list[:cohort_limit] if cohort_limit is not None else download_list
+    def start(self, ds, **kwargs):
+        print("Starting moule LocalGetInputDataOperator...")
+        self.conf = kwargs['dag_run'].conf
+
+        cohort_limit = None
+        if self.conf is not None and "conf" in self.conf:
+            trigger_conf = self.conf["conf"]
+            cohort_limit = int(trigger_conf["cohort_limit"]) if trigger_conf.get("cohort_limit") is not None else None
+
+        dag_run_id = kwargs['dag_run'].run_id
+
+        if self.conf == None or not "inputs" in self.conf:
+            print("No config or inputs in config found!")
+            print("Skipping...")
+            return
+
+        inputs = self.conf["inputs"]
+
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+
+        # Series are queued for download as soon as they are read from the conf or elasticsearch
+        download_pool = ThreadPool(self.parallel_downloads)
+        download_results = []
+        for download_series in self.iter_download_list(inputs=inputs, dag_run_id=dag_run_id, cohort_limit=cohort_limit):
+            if cohort_limit is not None and len(download_results) >= cohort_limit:
+                break
+            download_results.append(download_pool.apply_async(self.get_data, (download_series,)))
+        download_pool.close()
+
         print("")
-        print(f"## SERIES TO LOAD: {len(download_list)}")
+        print(f"## SERIES TO LOAD: {len(download_results)}")
         print("")
-        if len(download_list) == 0:
+        if len(download_results) == 0:
             print("#####################################################")
             print("#")
             print(f"# No series to download !! ")
@@ -185,11 +188,12 @@ class LocalGetInputDataOperator(KaapanaPythonBaseOperator):
             exit(1)
 
         series_download_fail = []
-        results = ThreadPool(self.parallel_downloads).imap_unordered(self.get_data, download_list)
-        for download_successful, series_uid in results:
+        for download_result in download_results:
+            download_successful, series_uid = download_result.get()
             print(f"# Series download ok: {series_uid}")
             if not download_successful:
                 series_download_fail.append(series_uid)
+        download_pool.join()
 
         if len(series_download_fail) > 0:
             print("#####################################################")
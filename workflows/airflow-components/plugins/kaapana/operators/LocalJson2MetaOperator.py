@@ -11,9 +11,15 @@ import pydicom
 import errno
 import time
 from kaapana.operators.HelperDcmWeb import HelperDcmWeb
+from kaapana.operators.HelperClients import HelperClients
 from kaapana.operators.KaapanaPythonBaseOperator import KaapanaPythonBaseOperator
 from kaapana.blueprints.kaapana_global_variables import BATCH_NAME, WORKFLOW_DIR
 
+
+def get_es_client(host, port):
+    # one client (and connection pool) per elastic host for the whole worker process
+    return HelperClients.get(("elasticsearch", host, port), lambda: elasticsearch.Elasticsearch([{'host': host, 'port': port}]))
+
 class LocalJson2MetaOperator(KaapanaPythonBaseOperator):
 
     def start(self, ds, **kwargs):
@@ -33,8 +39,10 @@ class LocalJson2MetaOperator(KaapanaPythonBaseOperator):
         self.run_id = kwargs['dag_run'].run_id
         print(("RUN_ID: %s" % self.run_id))
 
-        es = elasticsearch.Elasticsearch([{'host': self.elastic_host, 'port': self.elastic_port}])
+        es = get_es_client(host=self.elastic_host, port=self.elastic_port)
 
+        # series_uid -> merged json of all files found for this series within the batch
+        batch_jsons = {}
         for batch_element_dir in batch_folder:
 
             if self.jsonl_operator:
@@ -42,26 +50,27 @@ class LocalJson2MetaOperator(KaapanaPythonBaseOperator):
                 jsonl_dir = os.path.join(batch_element_dir, self.jsonl_operator.operator_out_dir)
                 jsonl_list = glob.glob(jsonl_dir+'/**/*.jsonl', recursive=True)
                 for jsonl_file in jsonl_list:
-                    print(("Pushing file: %s to elasticsearch!" % jsonl_file))
+                    print(("Collecting file: %s" % jsonl_file))
                     with open(jsonl_file, encoding='utf-8') as f:
                         for line in f:
                             obj = json.loads(line)
-                            self.push_json(obj)
+                            self.collect_json(obj, batch_jsons)
             else:
                 # TODO: is this dcm check neccesary? InstanceID is set in upload
                 dcm_files = sorted(glob.glob(os.path.join(batch_element_dir, self.rel_dicom_dir, "*.dcm*"), recursive=True))
                 self.get_id(dcm_files[0])
 
                 json_dir = os.path.join(batch_element_dir, self.json_operator.operator_out_dir)
-                print(("Pushing json files from: %s" % json_dir))
+                print(("Collecting json files from: %s" % json_dir))
                 json_list = glob.glob(json_dir+'/**/*.json', recursive=True)
                 print(("Found json files: %s" % len(json_list)))
 
                 for json_file in json_list:
-                    print(("Pushing file: %s to elasticsearch!" % json_file))
                     with open(json_file, encoding='utf-8') as f:
                         new_json = json.load(f)
-                    self.push_json(new_json)
+                    self.collect_json(new_json, batch_jsons)
+
+        self.push_jsons(batch_jsons)
 
     def mkdir_p(self, path):
         try:
@@ -83,15 +92,42 @@ class LocalJson2MetaOperator(KaapanaPythonBaseOperator):
         else:
             print("dicom_operator and dct_to_push not specified!")
 
-    def push_json(self, json_dict):
+    def collect_json(self, new_json, batch_jsons):
+        if "0020000E SeriesInstanceUID_keyword" in new_json:
+            instanceUID = new_json["0020000E SeriesInstanceUID_keyword"]
+        else:
+            print("Could not find SeriesUID...")
+            exit(1)
+
+        if instanceUID not in batch_jsons:
+            batch_jsons[instanceUID] = {}
+        batch_jsons[instanceUID].update(new_json)
+
+    def push_jsons(self, batch_jsons):
         global es
+        if len(batch_jsons) == 0:
+            print("No jsons to push found!")
+            return
+
         if (es.indices.exists(self.elastic_index)):
+            if self.check_in_pacs:
+                for instanceUID in batch_jsons:
+                    self.check_pacs_availability(instanceUID)
+
             try:
                 print(("Index", self.elastic_index, "exists, producing inserts and streaming them into ES."))
-                for ok, item in elasticsearch.helpers.streaming_bulk(es, self.produce_inserts(json_dict), chunk_size=500, raise_on_error=True):
-                    print(("status: %s" % item['index']['result']))
+                print(f"Pushing {len(batch_jsons)} series with chunk_size {self.bulk_chunk_size} and {self.bulk_thread_count} threads")
+                result_count = {}
+                for ok, item in elasticsearch.helpers.parallel_bulk(es, self.produce_inserts(batch_jsons),
+                                                                     chunk_size=self.bulk_chunk_size,
+                                                                     thread_count=self.bulk_thread_count,
+                                                                     raise_on_error=True):
                     if not ok:
                         print(("appendJsonToIndex(): %s Item: %s" % (ok, item)))
+                    result = item['index']['result']
+                    result_count[result] = result_count.get(result, 0) + 1
+                for result, count in result_count.items():
+                    print(("status: %s -> %d documents" % (result, count)))
             except Exception as e:
                 print("######################################################################################################### ERROR IN TRANSMISSION!")
                 logging.error(traceback.format_exc())
@@ -138,49 +174,37 @@ class LocalJson2MetaOperator(KaapanaPythonBaseOperator):
             time.sleep(self.avalability_check_delay)
             check_count += 1
 
-    def produce_inserts(self, new_json):
+    def produce_inserts(self, batch_jsons):
         global es
-        
-        if "0020000E SeriesInstanceUID_keyword" in new_json:
-            instanceUID = new_json["0020000E SeriesInstanceUID_keyword"]
-        else:
-            print("Could not find SeriesUID...")
-            exit(1)
-
-        if self.check_in_pacs:
-            self.check_pacs_availability(instanceUID)
 
-        global elastic_indexname
+        series_uids = list(batch_jsons.keys())
+        for chunk_start in range(0, len(series_uids), self.mget_chunk_size):
+            chunk_uids = series_uids[chunk_start:chunk_start + self.mget_chunk_size]
 
-        try:
-            old_json = es.get(index=self.elastic_index, doc_type="_doc", id=instanceUID)["_source"]
-            print("Series already found in ES")
-            if self.no_update:
-                exit(1)
-        except Exception as e:
-            print("doc is not updated! -> not found in es")
-            print(e)
-            old_json = {}
-
-        for new_key in new_json:
-            new_value = new_json[new_key]
-            old_json[new_key] = new_value
+            try:
+                existing_docs = es.mget(index=self.elastic_index, doc_type="_doc", body={"ids": chunk_uids})["docs"]
+                old_jsons = {doc["_id"]: doc["_source"] for doc in existing_docs if doc.get("found", False)}
+            except Exception as e:
+                print("Could not fetch existing docs -> treating all series as new")
+                print(e)
+                old_jsons = {}
 
-        uid = instanceUID
-        index = self.elastic_index
+            print(f"Series already found in ES: {len(old_jsons)} / {len(chunk_uids)}")
+            if self.no_update and len(old_jsons) > 0:
+                # raised inside the parallel_bulk worker -> re-raised in push_jsons
+                raise ValueError(f"no_update is set but series already exist in ES: {list(old_jsons.keys())}")
 
-        try:
+            for instanceUID in chunk_uids:
+                old_json = old_jsons.get(instanceUID, {})
+                old_json.update(batch_jsons[instanceUID])
 
-            doc = {}
-            doc["_id"] = uid
-            doc["_index"] = index
-            doc["_type"] = "_doc"
-            doc["_source"] = old_json
+                doc = {}
+                doc["_id"] = instanceUID
+                doc["_index"] = self.elastic_index
+                doc["_type"] = "_doc"
+                doc["_source"] = old_json
 
-            yield doc
-        except (KeyError) as e:
-            print(('KeyError in produce_inserts():', e, ', from input line: ', line[line.find('InstanceUID')-32:line.find('InstanceUID')+172]))
-            pass
+                yield doc
 
     def __init__(self,
                  dag,
@@ -195,6 +219,9 @@ class LocalJson2MetaOperator(KaapanaPythonBaseOperator):
                  elastic_port=9200,
                  elastic_index="meta-index",
                  check_in_pacs=True,
+                 bulk_chunk_size=500,
+                 bulk_thread_count=4,
+                 mget_chunk_size=1000,
                  *args, 
                  **kwargs):
 
@@ -211,6 +238,9 @@ class LocalJson2MetaOperator(KaapanaPythonBaseOperator):
         self.elastic_index = elastic_index
         self.instanceUID = None
         self.check_in_pacs = check_in_pacs
+        self.bulk_chunk_size = bulk_chunk_size
+        self.bulk_thread_count = bulk_thread_count
+        self.mget_chunk_size = mget_chunk_size
 
         super().__init__(
             dag=dag,
@@ -3,7 +3,11 @@ from minio import Minio
 import os
 import glob
 import uuid
-from zipfile import ZipFile
+import zlib
+import zipfile
+from zipfile import ZipFile, ZipInfo
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import datetime
 from datetime import timedelta
 
@@ -12,6 +16,73 @@ from kaapana.blueprints.kaapana_global_variables import BATCH_NAME, WORKFLOW_DIR
 from kaapana.blueprints.kaapana_utils import generate_minio_credentials
 from kaapana.operators.HelperMinio import HelperMinio
 
+ZIP_COMPRESSIONS = {
+    'deflated': zipfile.ZIP_DEFLATED,
+    'stored': zipfile.ZIP_STORED
+}
+# compressing these again only costs time
+COMPRESSED_FILE_TUPLES = ('.gz', '.zip', '.png', '.jpg', '.jpeg', '.pdf')
+# files up to this size are read and compressed on the thread pool, larger files are streamed in chunks by the archive writer
+MAX_POOL_FILE_SIZE = 64 * 1024 * 1024
+
+
+def compress_file(file_path, compress_type):
+    # zlib releases the GIL, so the files are compressed in parallel on a thread pool
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    crc = zlib.crc32(data)
+    file_size = len(data)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        data = compressor.compress(data) + compressor.flush()
+    return crc, file_size, data
+
+
+def write_compressed_file(zipObj, zinfo, crc, file_size, data):
+    # ZipFile has no api for already compressed data: the local header is written with the known sizes and the entry registered for the central directory
+    zinfo.CRC = crc
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(data)
+    zinfo.header_offset = zipObj.fp.tell()
+    zipObj.fp.write(zinfo.FileHeader(False))
+    zipObj.fp.write(data)
+    zipObj.filelist.append(zinfo)
+    zipObj.NameToInfo[zinfo.filename] = zinfo
+    zipObj.start_dir = zipObj.fp.tell()
+    zipObj._didModify = True
+
+
+def write_zip(fileobj, zip_jobs, compression='stored', parallel_processes=4):
+    """
+    Writes the (file_path, arcname) zip_jobs as zip archive to the (unseekable) fileobj.
+    Files are compressed on a pool of parallel_processes threads, at most 2 * parallel_processes files are held in memory.
+    compression: 'stored' (default, uncompressed archive as before) or 'deflated'
+    """
+    compress_type = ZIP_COMPRESSIONS[compression]
+    with ZipFile(fileobj, 'w', compression=compress_type, allowZip64=True) as zipObj, ThreadPool(parallel_processes) as threadpool:
+        pending = deque()
+
+        def write_next():
+            zinfo, file_path, result = pending.popleft()
+            if result is None:
+                zipObj.write(file_path, zinfo.filename, zinfo.compress_type)
+            else:
+                write_compressed_file(zipObj, zinfo, *result.get())
+
+        for file_path, arcname in zip_jobs:
+            zinfo = ZipInfo.from_file(file_path, arcname)
+            zinfo.compress_type = zipfile.ZIP_STORED if file_path.lower().endswith(COMPRESSED_FILE_TUPLES) else compress_type
+            if zinfo.file_size > MAX_POOL_FILE_SIZE:
+                pending.append((zinfo, file_path, None))
+            else:
+                pending.append((zinfo, file_path, threadpool.apply_async(compress_file, (file_path, zinfo.compress_type))))
+            while len(pending) > 2 * parallel_processes:
+                write_next()
+        while pending:
+            write_next()
+        print(f'Zipped {len(zipObj.filelist)} files')
+
+
 class LocalMinioOperator(KaapanaPythonBaseOperator):
 
     @rest_self_udpate
@@ -21,6 +92,9 @@ class LocalMinioOperator(KaapanaPythonBaseOperator):
         if 'conf' in conf and 'form_data' in conf['conf'] and conf['conf']['form_data'] is not None and 'zip_files' in conf['conf']['form_data']:
                 self.zip_files = conf['conf']['form_data']['zip_files']
                 print('Zip files set by form data', self.zip_files)
+        if 'conf' in conf and 'form_data' in conf['conf'] and conf['conf']['form_data'] is not None and 'zip_compression' in conf['conf']['form_data']:
+                self.zip_compression = conf['conf']['form_data']['zip_compression']
+                print('Zip compression set by form data', self.zip_compression)
 
         ###################
         # TODO: Can't be used like this, since token expires, we should use presigned_urls, which should be generated when the airflow is triggered 
@@ -84,31 +158,24 @@ class LocalMinioOperator(KaapanaPythonBaseOperator):
 
         if self.zip_files:
             timestamp = (datetime.datetime.now() + timedelta(hours=2)).strftime("%y-%m-%d-%H:%M:%S%f")
-            target_dir = os.path.join(run_dir, self.operator_out_dir)
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir)
-                
             zip_object_name = f"{kwargs['dag'].dag_id}_{timestamp}.zip"
-            zip_file_path = os.path.join(target_dir, zip_object_name)
-            with ZipFile(zip_file_path, 'w') as zipObj:
-                if not object_dirs:
-                    print(f'Zipping everything from {run_dir}')
-                    object_dirs = ['']
-                else:
-                    print(f'Zipping everything from {", ".join(object_dirs)}')
-                for object_dir in object_dirs:
-                    for path, _, files in os.walk(os.path.join(run_dir, object_dir)):
-                        for name in files:
-                            file_path = os.path.join(path, name)
-                            rel_dir = os.path.relpath(path, run_dir)
-                            rel_dir = '' if rel_dir== '.' else rel_dir
-                            if rel_dir == self.operator_out_dir:
-                                print('Skipping files in {rel_dir}, due to recursive zipping!')
-                                continue
-                            object_name =os.path.join(rel_dir, name)
-                            zipObj.write(os.path.join(path, name), object_name)
-            
-            HelperMinio.apply_action_to_file(minioClient, 'put', self.bucket_name, zip_object_name, zip_file_path, self.file_white_tuples)
+            if not object_dirs:
+                print(f'Zipping everything from {run_dir}')
+                object_dirs = ['']
+            else:
+                print(f'Zipping everything from {", ".join(object_dirs)}')
+            zip_jobs = []
+            for object_dir in object_dirs:
+                for path, _, files in os.walk(os.path.join(run_dir, object_dir)):
+                    for name in files:
+                        rel_dir = os.path.relpath(path, run_dir)
+                        rel_dir = '' if rel_dir== '.' else rel_dir
+                        zip_jobs.append((os.path.join(path, name), os.path.join(rel_dir, name)))
+
+            # the archive is streamed directly into a multipart upload, no local zip file is written
+            print(f'Zipping {len(zip_jobs)} files with compression "{self.zip_compression}" to {self.bucket_name}/{zip_object_name}')
+            with HelperMinio.open_upload_stream(minioClient, self.bucket_name, zip_object_name, content_type='application/zip') as upload_stream:
+                write_zip(upload_stream, zip_jobs, self.zip_compression, self.parallel_processes)
             return
                             
         if object_names:
@@ -142,12 +209,17 @@ class LocalMinioOperator(KaapanaPythonBaseOperator):
         minio_port='9000',
         file_white_tuples=None,
         zip_files=False,
+        zip_compression='stored',
+        parallel_processes=4,
         split_level=None,
         *args, **kwargs
         ):
     
         if action not in ['get', 'remove', 'put']:
             raise AssertionError('action must be get, remove or put')
+
+        if zip_compression not in ZIP_COMPRESSIONS:
+            raise AssertionError(f'zip_compression must be one of {list(ZIP_COMPRESSIONS.keys())}')
         
         if action == 'put':
             file_white_tuples = file_white_tuples or ('.json', '.mat', '.py', '.zip', '.txt', '.gz', '.csv', 'pdf', 'png', 'jpg')
@@ -162,6 +234,8 @@ class LocalMinioOperator(KaapanaPythonBaseOperator):
         self.minio_port = minio_port
         self.file_white_tuples = file_white_tuples
         self.zip_files = zip_files
+        self.zip_compression = zip_compression
+        self.parallel_processes = parallel_processes
         self.split_level = split_level
 
         super(LocalMinioOperator, self).__init__(
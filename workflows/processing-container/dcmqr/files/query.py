@@ -7,8 +7,12 @@
 # - http://dicom.nema.org/Dicom/2013/output/chtml/part04/sect_C.4.html
 # - http://dicom.nema.org/dicom/2013/output/chtml/part04/sect_C.3.html
 
+import os
+import json
+import queue
 import argparse
 import logging
+import threading
 import jsonlines
 import pydicom
 import math
@@ -17,7 +21,8 @@ from typing import List
 from pydicom.dataset import Dataset, DataElement
 from pynetdicom import AE, debug_logger
 from pynetdicom.status import code_to_status, code_to_category
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from multiprocessing.pool import ThreadPool
 from enum import Enum
 
 
@@ -155,20 +160,12 @@ class DicomQueryClient:
         return ds
 
 
-    def execute_query(self, tags: List = None, limit: int = None, start_dt: datetime = None, end_dt: datetime = None):
-        if self.level == QueryLevel.patient and limit:
-            self.log.warn("Limited Querys are not supported")
-            limit = None
-
+    def execute_query(self, tags: List = None, start_dt: datetime = None, end_dt: datetime = None):
         ds = self.create_query_dataset(tags)
         ds = self.set_time_frame(ds, start_dt, end_dt)
+        return self.execute_unlimited_query(ds)
 
-        if limit:
-            return self.execute_limited_query(ds, limit, start_dt, end_dt)
-        else:
-            return self.execute_unlimited_query(ds)
 
-    
     def execute_unlimited_query(self, ds: pydicom.dataset.Dataset):
             """ Executes a DICOM C-FIND using the query dataset
 
@@ -194,95 +191,221 @@ class DicomQueryClient:
                     self.log.error("None resultset")
                 else:
                     if self.level == QueryLevel.patient:
-                        self.log.info("%d (errors: %d): status: %s PatientID: %s",
+                        self.log.debug("%d (errors: %d): status: %s PatientID: %s",
                                 received_cnt, error_cnt,
                                 code_to_category(status.Status),
                                 identifier.PatientID)
                     else:
-                        self.log.info("%d (errors: %d): status: %s StudyInstanceUID: %s",
+                        self.log.debug("%d (errors: %d): status: %s StudyInstanceUID: %s",
                                 received_cnt, error_cnt,
                                 code_to_category(status.Status),
                                 identifier.StudyInstanceUID)
                     yield identifier
             self.log.info("Query Completed: Received %d, errors: %d", received_cnt, error_cnt)
-    
 
-    def execute_limited_query(self, ds: pydicom.dataset.Dataset, limit: int = 1000, start_dt: datetime = None, end_dt: datetime = None):
-        """ Tries to limit the results of a single query to stay under the given limit"""
-        
-        self.log.info("Executing limited query with limit %d", limit)
 
-        def query_func(start,end):
-            query = self.set_time_frame(ds,start,end)
-            return self.execute_unlimited_query(query)
+class WindowedQuery:
+    """ Splits a date range into StudyDate windows and runs them in parallel, every worker thread uses its own association.
 
-        if not end_dt:
-            end_dt = datetime.now()
+    Windows are generated from end_date backwards. Their size follows the observed data per day so that a window
+    is expected to return about fill_factor * limit results. A window returning limit or more results may have been
+    truncated by the PACS and is split in halves, which are queried again. Results are streamed into write_func
+    and de-duplicated by the UID of the query level.
 
-        return self._query_size_limiter(query_func=query_func, limit=limit, start_date=start_dt, end_date=end_dt)
+    Every window which is finished together with all newer windows moves the checkpoint, a later run with resume
+    continues from there.
+    """
 
+    UID_TAGS = {
+        QueryLevel.patient: "PatientID",
+        QueryLevel.study: "StudyInstanceUID",
+        QueryLevel.series: "SeriesInstanceUID",
+    }
 
-    def _query_size_limiter(self,
-                    query_func,
-                    limit: int = 100,
-                    start_date: datetime = None, 
-                    end_date: datetime = datetime.today(),
-                    MAX_ATTEMPTS: int = 10,
-                    WINDOW_INCREMENT_FACTOR: int = 2):
-        
-        assert MAX_ATTEMPTS > 0, "MAX_ATTEMPTS must be a positiv number"
-        assert WINDOW_INCREMENT_FACTOR >= 1, "WINDOW_INCREMENT_FACTOR must be >= 1"
+    earliest_date = date(1900, 1, 1)
+
+    def __init__(self, client_factory, level: QueryLevel, write_func, limit: int, tags: List = None, parallel_queries: int = 4,
+                 initial_window_days: int = 7, max_window_days: int = 3650, max_attempts: int = 10,
+                 fill_factor: float = 0.5, checkpoint_path: str = None):
         assert limit > 0, "Query limit must be bigger than 0"
-        assert start_date == None or start_date < end_date, "Start must be before end"
-        
-        # Initalization
-        new_end_date = end_date
-        # data per day - dpd is set to limit so that at first only one day is retreived
-        # TODO: this is oftentimes a two short window, query a week maybe would be better or make it adjustable
-        dpd = limit
+        assert parallel_queries > 0, "parallel_queries must be a positiv number"
+        self.log = logging.getLogger(__name__)
+        self.client_factory = client_factory
+        self.level = level
+        self.write_func = write_func
+        self.limit = limit
+        self.tags = tags
+        self.parallel_queries = parallel_queries
+        self.initial_window_days = initial_window_days
+        self.max_window_days = max_window_days
+        self.max_attempts = max_attempts
+        self.fill_factor = fill_factor
+        self.checkpoint_path = checkpoint_path
+
+        self.seen_uids = set()
+        self.lock = threading.Lock()
+        self.clients = []
+        self.thread_local = threading.local()
+
+
+    def get_client(self):
+        """ Association and query dataset of the current worker thread"""
+        client = getattr(self.thread_local, "client", None)
+        if client is None:
+            client = self.client_factory()
+            self.thread_local.client = client
+            self.thread_local.ds = client.create_query_dataset(self.tags)
+            with self.lock:
+                self.clients.append(client)
+        return client, self.thread_local.ds
+
+
+    def load_seen_uids(self, path):
+        """ Seeds the de-duplication with the results of a previous (interrupted) run"""
+        keyword_tag = "{:08X}".format(pydicom.datadict.tag_for_keyword(self.UID_TAGS[self.level]))
+        with jsonlines.open(path, mode='r') as reader:
+            for result in reader:
+                if keyword_tag in result and "Value" in result[keyword_tag]:
+                    self.seen_uids.add(str(result[keyword_tag]["Value"][0]))
+        self.log.info("Loaded %d existing results from %s", len(self.seen_uids), path)
+
+
+    def load_checkpoint(self, start_date: date, end_date: date):
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint["level"] != str(self.level) or checkpoint["start_date"] != (start_date.isoformat() if start_date else None) or checkpoint["end_date"] != end_date.isoformat():
+            self.log.warning("Checkpoint %s belongs to a different query -> ignored", self.checkpoint_path)
+            return None
+        return checkpoint
+
+
+    def save_checkpoint(self, start_date: date, end_date: date, completed_until: date, dpd: float):
+        if not self.checkpoint_path:
+            return
+        checkpoint = {
+            "level": str(self.level),
+            "start_date": start_date.isoformat() if start_date else None,
+            "end_date": end_date.isoformat(),
+            "completed_until": completed_until.isoformat(),
+            "dpd": dpd
+        }
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+
+    def query_window(self, window_start: date, window_end: date):
+        """ Runs one window and streams its results -> returns the number of (not de-duplicated) results"""
+        client, ds = self.get_client()
+        query = client.set_time_frame(ds, window_start, window_end)
+        uid_keyword = self.UID_TAGS[self.level]
+        result_count = 0
+        for result in client.execute_unlimited_query(query):
+            result_count += 1
+            uid = str(result.get(uid_keyword, ""))
+            with self.lock:
+                if uid:
+                    if uid in self.seen_uids:
+                        continue
+                    self.seen_uids.add(uid)
+                self.write_func(result)
+        return result_count
+
+
+    def run(self, start_date: date = None, end_date: date = None):
+        end_date = end_date or date.today()
+        assert start_date is None or start_date <= end_date, "Start must be before end"
+
+        next_end = end_date
+        dpd = self.limit / self.initial_window_days
+        checkpoint = self.load_checkpoint(start_date, end_date)
+        if checkpoint is not None:
+            next_end = date.fromisoformat(checkpoint["completed_until"]) - timedelta(days=1)
+            dpd = checkpoint["dpd"]
+            self.log.info("Resuming from checkpoint: all windows after %s are done", checkpoint["completed_until"])
+
+        # windows which are issued but not yet finished, ordered from new to old -> moves the checkpoint
+        pending_windows = []
+        finished_windows = set()
+        completed_until = None
         attempts_without_data = 0
-        
-        # Loop Terminates when query returns no data anymore or when the start date is reached
-        while True :
-            # Step 1 - Calculate new start date
-            window_size = math.ceil(1/dpd * limit)
-            new_start_date = new_end_date - timedelta(days=window_size)
-            self.log.debug(f"Preparing Query end date: %s, new start date: %s, dpd: %d, window_size %d", new_end_date, new_start_date, dpd, window_size)
-
-            if start_date != None and new_start_date <= start_date:
-                new_start_date = start_date
-            
-            if math.ceil((new_end_date - new_start_date).days) == 0:
-                self.log.info("Reached start_date")
-                return
-                
-            if new_start_date >= new_end_date:
-                assert False
-
-            # Step 2 - Query New Data
-            new_results = list(query_func(new_start_date, new_end_date))
-            self.log.debug(f"Query returned %d results",len(new_results))
-            new_dpd = len(new_results) / math.ceil((new_end_date - new_start_date).days)
-            
-            for r in new_results:
-                yield r
-            
-            # Step 3 - Adjust query parameters for next round
-            if new_dpd == 0:
-                self.log.info("No data returned between %s and %s", new_start_date, new_end_date)
-                attempts_without_data += 1
-                new_dpd = dpd / WINDOW_INCREMENT_FACTOR
-                self.log.info("Increasing window (attempt %d/%d) by factor %d (dpd is now: %f, was %f)",
-                        attempts_without_data, MAX_ATTEMPTS, WINDOW_INCREMENT_FACTOR, new_dpd, dpd)
-                if(attempts_without_data >= MAX_ATTEMPTS):
-                    self.log.info("Last %d querys returned no result, aborting...", attempts_without_data)
-                    return
-            else:
-                attempts_without_data = 0
+        # without start_date the windows stop after max_attempts empty windows at the latest at earliest_date
+        lower_bound = start_date or self.earliest_date
+        exhausted = next_end < lower_bound
+        completions = queue.Queue()
+
+        def next_window():
+            nonlocal next_end
+            window_days = max(1, min(self.max_window_days, math.ceil(self.fill_factor * self.limit / max(dpd, 1e-6))))
+            window_end = next_end
+            window_start = window_end - timedelta(days=window_days - 1)
+            if window_start <= lower_bound:
+                window_start = lower_bound
+            next_end = window_start - timedelta(days=1)
+            return window_start, window_end
+
+        def submit(pool, window):
+            def on_done(result_count):
+                completions.put((window, result_count, None))
+            def on_error(e):
+                completions.put((window, None, e))
+            pool.apply_async(self.query_window, (window[0], window[1]), callback=on_done, error_callback=on_error)
+
+        in_flight = 0
+        with ThreadPool(self.parallel_queries) as pool:
+            try:
+                while True:
+                    while not exhausted and in_flight < self.parallel_queries:
+                        window = next_window()
+                        pending_windows.append(window)
+                        submit(pool, window)
+                        in_flight += 1
+                        exhausted = next_end < lower_bound
+                    if in_flight == 0:
+                        break
+
+                    window, result_count, error = completions.get()
+                    in_flight -= 1
+                    if error is not None:
+                        raise error
+                    window_start, window_end = window
+                    window_days = (window_end - window_start).days + 1
+                    self.log.info("Window %s - %s (%d days): %d results", window_start, window_end, window_days, result_count)
+
+                    if result_count >= self.limit and window_days > 1:
+                        # possibly truncated -> split, the halves replace the window
+                        middle = window_start + timedelta(days=window_days // 2 - 1)
+                        halves = [(middle + timedelta(days=1), window_end), (window_start, middle)]
+                        self.log.info("Window %s - %s reached the limit -> split", window_start, window_end)
+                        index = pending_windows.index(window)
+                        pending_windows[index:index + 1] = halves
+                        for half in halves:
+                            submit(pool, half)
+                            in_flight += 1
+                        continue
+                    if result_count >= self.limit:
+                        self.log.warning("Single day %s reached the limit -> results may be incomplete", window_start)
+
+                    dpd = max(result_count / window_days, dpd / 2 if result_count == 0 else 0)
+                    finished_windows.add(window)
+                    while len(pending_windows) > 0 and pending_windows[0] in finished_windows:
+                        finished_windows.discard(pending_windows[0])
+                        completed_until = pending_windows.pop(0)[0]
+                        self.save_checkpoint(start_date, end_date, completed_until, dpd)
 
-            new_end_date = new_start_date
-            dpd = new_dpd
+                    if start_date is None:
+                        attempts_without_data = attempts_without_data + 1 if result_count == 0 else 0
+                        if attempts_without_data >= self.max_attempts and not exhausted:
+                            self.log.info("Last %d querys returned no result, aborting...", attempts_without_data)
+                            exhausted = True
+            finally:
+                for client in self.clients:
+                    client.assoc.release()
 
+        self.log.info("Windowed query completed: %d unique results", len(self.seen_uids))
 
 
 if __name__ == "__main__":
@@ -306,6 +429,9 @@ note: tries to mimic dcmtk tools options
     parser.add_argument("--start-date", help="An ISO 8601 datetime string (eg. 2021-03-11)")
     parser.add_argument("--end-date", help="An ISO 8601 datetime string (eg. 2021-03-11)")
     parser.add_argument("--level", help="What type of objects should be retreived", type=QueryLevel, choices=list(QueryLevel), default=QueryLevel.study)
+    parser.add_argument("--parallel-queries", type=int, help="Number of associations used for parallel date windows (only with --max-query-size)", default=4)
+    parser.add_argument("--initial-window-days", type=int, help="Size of the first date window in days (only with --max-query-size)", default=7)
+    parser.add_argument("--resume", help="Continue an interrupted windowed query from its checkpoint", action="store_true")
     args = parser.parse_args()
 
     if args.v:
@@ -315,32 +441,57 @@ note: tries to mimic dcmtk tools options
     start_dt = datetime.fromisoformat(args.start_date) if args.start_date else None
     end_dt = datetime.fromisoformat(args.end_date) if args.end_date else None
 
+    if args.level == QueryLevel.patient and args.max_query_size:
+        log.warning("Limited Querys are not supported")
+        args.max_query_size = None
+
+    def filter_result(result):
+        if args.filter_uid:
+            filtered = False
+            if args.level == QueryLevel.patient and "PatientID" not in result:
+                filtered = True
+            elif args.level == QueryLevel.study and "StudyInstanceUID" not in result:
+                filtered = True
+            elif args.level == QueryLevel.series and "SeriesInstanceUID" not in result:
+                filtered = True
+
+            if filtered:
+                log.warning("Skipping Object because it does not contain correct identifier for level %s (Object: %s)", args.level, result)
+                return True
+        return False
+
+    path = args.outfile
+    if args.max_query_size:
+        logging.info("Max query size: %d", args.max_query_size)
+        checkpoint_path = f"{path}.checkpoint.json"
+        resume = args.resume and os.path.exists(path) and os.path.exists(checkpoint_path)
+        if not resume and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
 
-    with DicomQueryClient(args.aet, args.aec, args.peer, args.port, args.level) as client:
-        path =  args.outfile
         log.info("Opening result file %s", path)
-        with jsonlines.open(path, mode='w') as writer:
-            if args.max_query_size:
-                logging.info("Max query size: %d", args.max_query_size)
-                resultset = client.execute_query(start_dt=start_dt, end_dt=end_dt, limit=args.max_query_size) 
-            else:
-                resultset = client.execute_query(start_dt=start_dt, end_dt=end_dt)
-
-            for result in resultset:
-
-                if args.filter_uid:
-                    filtered = False
-                    if args.level == QueryLevel.patient and "PatientID" not in result:
-                        filtered = True
-                    elif args.level == QueryLevel.study and "StudyInstanceUID" not in result:
-                        filtered = True
-                    elif args.level == QueryLevel.series and "SeriesInstanceUID" not in result:
-                        filtered = True
-
-                    if filtered:
-                        log.warn("Skipping Object because it does not contain correct identifier for level %s (Object: %s)", args.level, result)
-                        continue
-
-                writer.write(result.to_json_dict())
+        with jsonlines.open(path, mode='a' if resume else 'w', flush=True) as writer:
+            def write_result(result):
+                if not filter_result(result):
+                    writer.write(result.to_json_dict())
+
+            engine = WindowedQuery(
+                client_factory=lambda: DicomQueryClient(args.aet, args.aec, args.peer, args.port, args.level),
+                level=args.level,
+                write_func=write_result,
+                limit=args.max_query_size,
+                parallel_queries=args.parallel_queries,
+                initial_window_days=args.initial_window_days,
+                checkpoint_path=checkpoint_path
+            )
+            if resume:
+                engine.load_seen_uids(path)
+            engine.run(start_date=start_dt.date() if start_dt else None, end_date=end_dt.date() if end_dt else None)
+    else:
+        with DicomQueryClient(args.aet, args.aec, args.peer, args.port, args.level) as client:
+            log.info("Opening result file %s", path)
+            with jsonlines.open(path, mode='w') as writer:
+                for result in client.execute_query(start_dt=start_dt, end_dt=end_dt):
+                    if not filter_result(result):
+                        writer.write(result.to_json_dict())
 
     log.info("All done")
@@ -7,6 +7,10 @@ if [ -n "$MAX_QUERY_SIZE" ]; then
     CMD="$CMD --max-query-size $MAX_QUERY_SIZE"
 fi
 
+if [ -n "$PARALLEL_QUERIES" ]; then
+    CMD="$CMD --parallel-queries $PARALLEL_QUERIES"
+fi
+
 if [ -n "$START_DATE" ]; then
     CMD="$CMD --start-date $START_DATE"
 fi
@@ -16,6 +20,6 @@ if [ -n "$END_DATE" ]; then
 fi
 
 mkdir -p  /$WORKFLOW_DIR/$BATCH_NAME/query/$OPERATOR_OUT_DIR/
-CMD="$CMD --filter-uid --level $LEVEL -aet $LOCAL_AE_TITLE -aec $AE_TITLE $PACS_HOST $PACS_PORT /$WORKFLOW_DIR/$BATCH_NAME/query/$OPERATOR_OUT_DIR/result.jsonl"
+CMD="$CMD --resume --filter-uid --level $LEVEL -aet $LOCAL_AE_TITLE -aec $AE_TITLE $PACS_HOST $PACS_PORT /$WORKFLOW_DIR/$BATCH_NAME/query/$OPERATOR_OUT_DIR/result.jsonl"
 
 python3 -u query.py $CMD
\ No newline at end of file
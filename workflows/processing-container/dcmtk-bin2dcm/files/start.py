@@ -3,83 +3,45 @@ import os
 import json
 import glob
 import pydicom
-import binascii
 import pathlib
+import numpy as np
+from string import ascii_lowercase
 from datetime import datetime
-from xml.dom import minidom
 import xml.etree.ElementTree as et
-from subprocess import PIPE, run
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.encaps import decode_data_sequence
 
 converter_count = 0
+# payload stored as OW in the pixel data -> one DICOM per part
+SIZE_LIMIT_MB = int(os.getenv("SIZE_LIMIT_MB", "100"))
 
 
-def combine_split_files(split_files_dir, delete_parts=True):
-    input_files = sorted(glob.glob(join(split_files_dir, "*.part*")))
-    input_files = [i for i in input_files if "part" in i.split(".")[-1]]
-    suffixes = ''.join(pathlib.Path(input_files[0].split(".part")[0]).suffixes)
-    final_filename = f"{input_files[0].split('---')[0]}{suffixes}"
+def get_part_suffix(part_index):
+    # same suffixes as 'split': aa, ab, ..., zz
+    return ascii_lowercase[part_index // 26] + ascii_lowercase[part_index % 26]
 
-    my_cmd = ['cat'] + input_files
-    with open(final_filename, "w") as outfile:
-        output = run(my_cmd, stdout=outfile)
 
-    if output.returncode != 0:
-        print(f"# Could not combine split files for {final_filename}!")
-        print(output)
-        exit(1)
+def get_payload(ds):
+    """
+    Returns the binary payload of a bin2dcm DICOM as memoryview.
+    The payload is the raw OW value, only big endian datasets have to be byte-swapped back.
+    """
+    pixel_data = ds[0x7fe0, 0x0010]
+    if pixel_data.is_undefined_length:
+        # first item is the basic offset table
+        payload = b"".join(decode_data_sequence(pixel_data.value)[1:])
     else:
-        print(f"# Successfully created {final_filename}!")
-
-        if delete_parts:
-            for part_file in input_files:
-                os.remove(part_file)
-
-    return final_filename
+        payload = pixel_data.value
 
+    if not ds.is_little_endian:
+        payload = np.frombuffer(payload, dtype=np.uint16).byteswap().tobytes()
+    return memoryview(payload)
 
-def split_file(file_path, size_limit):
-    command = ["split", "-b", f"{size_limit}M", file_path, f"{file_path}.part"]
-    output = run(command, stdout=PIPE, stderr=PIPE, universal_newlines=True, timeout=60)
-
-    if output.returncode != 0:
-        print("# Could not convert dicom to xml!")
-        print(output)
-        exit(1)
-
-    part_files = sorted(glob.glob(f"{file_path}.part*"))
-    return part_files
 
-
-def xml_to_dicom(target_dir, delete_xml=True):
+def dicom_to_binary(dicom_dir, target_dir):
     global converter_count
 
-    xml_files = sorted(glob.glob(join(target_dir, "*.xml")))
-
-    dicom_list = []
-
-    for xml_path in xml_files:
-        dcm_path = xml_path.replace("xml", "dcm")
-        print("#")
-        print(f"# convert XML to DICOM: {xml_path} -> {dcm_path}")
-        command = ["xml2dcm", xml_path, dcm_path]
-        output = run(command, stdout=PIPE, stderr=PIPE, universal_newlines=True, timeout=320)
-
-        if output.returncode != 0:
-            print("# Could not convert XML to DICOM!")
-            print(output)
-            exit(1)
-        else:
-            print("# DICOM created!")
-            dicom_list.append(dcm_path)
-            if delete_xml:
-                os.remove(xml_path)
-
-    converter_count += 1
-    return dicom_list
-
-
-def dicom_to_xml(dicom_dir, target_dir):
-
     dcm_files = sorted(glob.glob(join(dicom_dir, "*.dcm")))
     if len(dcm_files) == 0:
         print("#")
@@ -88,99 +50,86 @@ def dicom_to_xml(dicom_dir, target_dir):
         print("#")
         exit(1)
 
-    generated_xml_list = []
-    for dcm_file in dcm_files:
-        xml_path = dcm_file.replace(dirname(dcm_file), target_dir).replace("dcm", "xml")
-
-        print("#")
-        print(f"# convert DICOM to XML: {dcm_file} -> {xml_path}")
-
-        command = ["dcm2xml", "+Eh", "+Wb", "--load-all", dcm_file, xml_path]
-        print("#")
-        print(f"# command: {command}")
-        print("#")
-        output = run(command, stdout=PIPE, stderr=PIPE, universal_newlines=True, timeout=320)
-
-        if output.returncode != 0:
-            print("# Could not convert dicom to xml!")
-            print(output)
-            exit(1)
-        else:
-            print("# XML created!")
-            generated_xml_list.append(xml_path)
-
-    return generated_xml_list
-
-
-def xml_to_binary(target_dir, delete_xml=True):
-    global converter_count
-    xml_files = sorted(glob.glob(join(target_dir, "*.xml")))
-
     print("#")
-    print("# starting xml_to_binary")
-    print(f"# xml-dir:      {target_dir}")
+    print("# starting dicom_to_binary")
+    print(f"# dicom-dir:    {dicom_dir}")
+    print(f"# target-dir:   {target_dir}")
     print("#")
 
-    for xml_file in xml_files:
-        context = et.iterparse(xml_file, events=("start", "end"))
-        context = iter(context)
-        ev, root = next(context)
-
-        filename = None
-        hex_data = None
-        expected_file_count = None
-        for ev, el in context:
-            if ev == 'start' and el.tag == 'element' and el.attrib['name'] == "ImageComments":
-                filename = el.text
-                print(f"# Found filename: {filename}")
-                expected_file_count = int(filename.split(".")[0].split("---")[1])
-                if len(xml_files) != expected_file_count:
-                    print("# ERROR!!")
-                    print("#")
-                    print(f"# Expected {expected_file_count} files -> found {len(xml_files)}")
-                    print("# Abort")
-                    print("#")
-                    exit(1)
-
-                filename = filename.replace("---1", "")
-                root.clear()
-            elif ev == 'end' and el.tag == 'element' and el.attrib['tag'] == "7fe0,0010" and el.attrib['name'] == "PixelData":
-                hex_data = el.text.strip().replace("\\", "")
-                print("# Found Hex-Data!")
-                root.clear()
-            elif ev == 'end' and el.tag == 'pixel-item' and el.attrib['binary'] == "yes":
-                hex_data = el.text.strip().replace("\\", "")
-                print("# Found Hex-Data!")
-                root.clear()
-
-        if filename is None or hex_data is None or expected_file_count is None:
-            print("# Could not extract needed data!")
-            print("#")
-            print(f"# filename: {filename}")
-            print(f"# hex_data: {hex_data}")
-            print("#")
-            exit(1)
-
-        switched_hex = ""
-        for x in range(0, len(hex_data), 4):
-            switched_hex += hex_data[x+2:x+4]+hex_data[x:x+2]
-
-        binary_path = join(dirname(xml_file), filename)
-        binstr = binascii.unhexlify(switched_hex)
-        with open(binary_path, "wb") as f:
-            f.write(binstr)
+    # headers first -> the parts can be written in order without keeping more than one payload in memory
+    parts = []
+    for dcm_file in dcm_files:
+        filename = pydicom.dcmread(dcm_file, stop_before_pixels=True, specific_tags=["ImageComments"]).ImageComments
+        print(f"# Found filename: {filename}")
+        parts.append((filename, dcm_file))
+    parts.sort()
+
+    filename = parts[0][0]
+    expected_file_count = int(filename.split(".")[0].split("---")[1])
+    if len(parts) != expected_file_count:
+        print("# ERROR!!")
+        print("#")
+        print(f"# Expected {expected_file_count} files -> found {len(parts)}")
+        print("# Abort")
+        print("#")
+        exit(1)
 
-        print(f"# Successfully extracted file: {filename} !")
-        if delete_xml:
-            os.remove(xml_file)
+    if expected_file_count == 1:
+        final_filename = filename.replace("---1", "")
+    else:
+        suffixes = ''.join(pathlib.Path(filename.split(".part")[0]).suffixes)
+        final_filename = f"{filename.split('---')[0]}{suffixes}"
+    binary_path = join(target_dir, final_filename)
 
-    if expected_file_count > 1:
-        combine_split_files(split_files_dir=target_dir)
+    with open(binary_path, "wb") as binary_file:
+        for filename, dcm_file in parts:
+            binary_file.write(get_payload(pydicom.dcmread(dcm_file)))
+            print(f"# Successfully extracted part: {filename} !")
 
+    print(f"# Successfully created {binary_path}!")
     converter_count += 1
+    return binary_path
+
+
+def load_template(template_path="/template.xml"):
+    """
+    Returns the file-meta and data-set elements of the template as lists of (tag, vr, name, value).
+    Sequences are returned with a list of items, each a list of elements.
+    """
+    def parse_elements(parent):
+        elements = []
+        for child in parent:
+            tag = int(child.attrib['tag'].replace(",", ""), 16)
+            if tag & 0xffff == 0:
+                # group lengths are calculated by pydicom
+                continue
+            if child.tag == "sequence":
+                elements.append((tag, child.attrib['vr'], child.attrib['name'], [parse_elements(child)]))
+            elif child.tag == "element":
+                elements.append((tag, child.attrib['vr'], child.attrib['name'], child.text or ""))
+        return elements
+
+    root = et.parse(template_path).getroot()
+    return parse_elements(root.find("meta-header")), parse_elements(root.find("data-set"))
+
+
+def fill_dataset(ds, elements, values):
+    for tag, vr, name, value in elements:
+        if vr == "SQ":
+            items = []
+            for item_elements in value:
+                item = Dataset()
+                fill_dataset(item, item_elements, values)
+                items.append(item)
+            ds.add_new(tag, vr, Sequence(items))
+        else:
+            value = values.get(name, value)
+            ds.add_new(tag, vr, "" if value is None else value)
 
 
-def generate_xml(binary_path, target_dir, template_path="/template.xml"):
+def binary_to_dicom(binary_path, target_dir, template_path="/template.xml"):
+    global converter_count
+
     if not exists(target_dir):
         os.makedirs(target_dir)
 
@@ -215,7 +164,6 @@ def generate_xml(binary_path, target_dir, template_path="/template.xml"):
     print(f"# study_time:     {study_time}")
     print(f"# study_datetime: {study_datetime}")
 
-    series_uid = pydicom.uid.generate_uid()
     series_description = os.getenv("SERIES_DESCRIPTION", "None")
     series_description = series_description if series_description.lower() != "none" else f"bin2dcm {pretty_datetime_now}"
 
@@ -231,114 +179,69 @@ def generate_xml(binary_path, target_dir, template_path="/template.xml"):
     if protocol_name == None and dataset_info != None and "name" in dataset_info:
         protocol_name = dataset_info["name"]
 
-    size_limit = int(os.getenv("SIZE_LIMIT_MB", "100"))
-
-    xml_output_list = []
-
-    binary_file_size = os.path.getsize(binary_path) >> 20
-
-    binary_path_list = [binary_path]
-    if size_limit != 0 and binary_file_size > size_limit:
-        binary_path_list = split_file(file_path=binary_path, size_limit=size_limit)
-
-    split_part_count = len(binary_path_list)
-    full_filename = basename(binary_path)
+    binary_size = os.path.getsize(binary_path)
+    part_size = SIZE_LIMIT_MB << 20 if SIZE_LIMIT_MB != 0 and (binary_size >> 20) > SIZE_LIMIT_MB else max(binary_size, 1)
+    split_part_count = -(-binary_size // part_size) if binary_size > 0 else 1
 
+    meta_elements, dataset_elements = load_template(template_path)
+    filename = basename(binary_path)
     series_uid = pydicom.uid.generate_uid()
-    for i in range(0, len(binary_path_list)):
-        binary_path = binary_path_list[i]
-        sopInstanceUID = pydicom.uid.generate_uid()
-        # version_uid = pydicom.uid.generate_uid()
-
-        filename = basename(binary_path)
-        new_filename = filename.split('.')[0]+f"---{split_part_count}{''.join(pathlib.Path(filename).suffixes)}"
-        xml_output_path = join(target_dir, f"{new_filename}.xml")
-
-        xml_template = minidom.parse(template_path)
-
-        # with open(binary_path, 'rb') as f:
-        #     hex_data = f.read().hex("\\")
-        # xml_template.getElementsByTagName('pixel-item')[0].firstChild.data = hex_data
-
-        elements = xml_template.getElementsByTagName('element')
-        for element in elements:
-            el_name = element.attributes['name'].value
-
-            if el_name == "InstanceCreationDate" or el_name == "StudyDate" or el_name == "ContentDate":
-                element.firstChild.data = study_date
-
-            elif el_name == "InstanceCreationTime" or el_name == "StudyTime":
-                element.firstChild.data = study_time
-
-            if el_name == "ContentDate":
-                element.firstChild.data = content_date
-
-            elif el_name == "ContentTime":
-                element.firstChild.data = content_time
-
-            elif el_name == "AcquisitionDateTime":
-                element.firstChild.data = content_datetime
-
-            elif el_name == "StudyInstanceUID":
-                element.firstChild.data = study_uid
-
-            elif el_name == "StudyID":
-                element.firstChild.data = study_id
-
-            elif el_name == "PatientID":
-                element.firstChild.data = patient_id
-
-            elif el_name == "PatientName":
-                element.firstChild.data = patient_name
-
-            elif el_name == "Manufacturer":
-                element.firstChild.data = manufacturer
 
-            elif el_name == "ManufacturerModelName":
-                element.firstChild.data = manufacturer_model_name
-
-            elif el_name == "SeriesNumber":
-                element.firstChild.data = f"{i+1}"
-
-            elif el_name == "ImageComments":
-                element.firstChild.data = new_filename
-
-            elif el_name == "ProtocolName":
-                element.firstChild.data = protocol_name
-
-            elif el_name == "InstanceNumber" or el_name == "ReferencedFrameNumber":
-                element.firstChild.data = str(i+1)
-
-            elif el_name == "CreatorVersionUID":
-                element.firstChild.data = version
-
-            elif el_name == "StudyDescription":
-                element.firstChild.data = str(study_description)
-
-            elif el_name == "SeriesDescription":
-                element.firstChild.data = series_description
-
-            elif el_name == "SeriesInstanceUID":
-                element.firstChild.data = series_uid
-
-            elif el_name == "MediaStorageSOPInstanceUID" or el_name == "SOPInstanceUID":
-                element.firstChild.data = sopInstanceUID
-
-            elif el_name == "file":
-                element.firstChild.data = binary_path
-
-            if el_name != "file" and 'len' in element.attributes and len(element.childNodes) > 0:
-                element.attributes['len'].value = str(len(element.firstChild.data))
-                element.attributes['vm'].value = "1"
-                print(f"# {el_name}: {element.firstChild.data} : {element.attributes['len'].value}")
-
-        print("# Generated XML from template -> export file...")
-        with open(xml_output_path, "w") as xml_file:
-            xml_template.writexml(xml_file)
-
-        xml_output_list.append(xml_output_path)
+    dicom_list = []
+    with open(binary_path, "rb") as binary_file:
+        for i in range(0, split_part_count):
+            sopInstanceUID = pydicom.uid.generate_uid()
+            part_filename = filename if split_part_count == 1 else f"{filename}.part{get_part_suffix(i)}"
+            new_filename = part_filename.split('.')[0]+f"---{split_part_count}{''.join(pathlib.Path(part_filename).suffixes)}"
+            dcm_path = join(target_dir, f"{new_filename}.dcm")
+
+            values = {
+                "InstanceCreationDate": study_date,
+                "StudyDate": study_date,
+                "InstanceCreationTime": study_time,
+                "StudyTime": study_time,
+                "ContentDate": content_date,
+                "ContentTime": content_time,
+                "AcquisitionDateTime": content_datetime,
+                "StudyInstanceUID": study_uid,
+                "StudyID": study_id,
+                "PatientID": patient_id,
+                "PatientName": patient_name,
+                "Manufacturer": manufacturer,
+                "ManufacturerModelName": manufacturer_model_name,
+                "SeriesNumber": f"{i+1}",
+                "ImageComments": new_filename,
+                "ProtocolName": protocol_name,
+                "InstanceNumber": str(i+1),
+                "CreatorVersionUID": version,
+                "StudyDescription": str(study_description),
+                "SeriesDescription": series_description,
+                "SeriesInstanceUID": series_uid,
+                "MediaStorageSOPInstanceUID": sopInstanceUID,
+                "SOPInstanceUID": sopInstanceUID,
+            }
+
+            payload = binary_file.read(part_size)
+            if len(payload) % 2 == 1:
+                # OW values have an even length
+                payload += b"\x00"
+            values["file"] = payload
+
+            file_meta = FileMetaDataset()
+            fill_dataset(file_meta, meta_elements, values)
+            ds = FileDataset(dcm_path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+            ds.is_little_endian = True
+            ds.is_implicit_VR = False
+            fill_dataset(ds, dataset_elements, values)
+
+            print(f"# convert binary part {i+1}/{split_part_count} to DICOM: {binary_path} -> {dcm_path}")
+            ds.save_as(dcm_path, write_like_original=False)
+            dicom_list.append(dcm_path)
+            del ds, payload
 
-    return xml_output_list
+    print("# DICOM created!")
+    converter_count += 1
+    return dicom_list
 
 
 # START
@@ -363,11 +266,8 @@ for batch_element_dir in batch_folders:
     if ".dcm" in binaries_found[0]:
         print("# --> identified DICOM --> execute dcm2binary")
         print("#")
-        print("# --> extract xml")
-        extracted_xml = dicom_to_xml(dicom_dir=element_input_dir, target_dir=element_output_dir)
-        print("#")
-        print("# --> get_binary_from_xml")
-        xml_to_binary(target_dir=element_output_dir)
+        print("# --> dicom_to_binary")
+        dicom_to_binary(dicom_dir=element_input_dir, target_dir=element_output_dir)
         print("#")
     else:
         for binary in binaries_found:
@@ -375,11 +275,8 @@ for batch_element_dir in batch_folders:
             print("#")
             print("# Found file: {}".format(binary))
             print("#")
-            print(f"# --> generate_xml -> {element_output_dir}")
-            generated_xml_list = generate_xml(binary_path=binary, target_dir=element_output_dir)
-            print("#")
-            print("# --> xml_to_dicom")
-            dcm_path_list = xml_to_dicom(target_dir=element_output_dir)
+            print(f"# --> binary_to_dicom -> {element_output_dir}")
+            dcm_path_list = binary_to_dicom(binary_path=binary, target_dir=element_output_dir)
             print("#")
 
 
@@ -413,11 +310,8 @@ if len(binaries_found) == 0:
 elif ".dcm" in binaries_found[0]:
     print("# --> identified DICOM --> execute dcm2binary")
     print("#")
-    print("# --> extract xml")
-    extracted_xml = dicom_to_xml(dicom_dir=batch_input_dir, target_dir=batch_output_dir)
-    print("#")
-    print("# --> get_binary_from_xml")
-    xml_to_binary(target_dir=batch_output_dir)
+    print("# --> dicom_to_binary")
+    dicom_to_binary(dicom_dir=batch_input_dir, target_dir=batch_output_dir)
     print("#")
 else:
     for binary in binaries_found:
@@ -425,11 +319,8 @@ else:
         print("#")
         print("# Found file: {}".format(binary))
         print("#")
-        print(f"# --> generate_xml -> {batch_output_dir}")
-        generated_xml_list = generate_xml(binary_path=binary, target_dir=batch_output_dir)
-        print("#")
-        print("# --> xml_to_dicom")
-        dcm_path_list = xml_to_dicom(target_dir=batch_output_dir)
+        print(f"# --> binary_to_dicom -> {batch_output_dir}")
+        dcm_path_list = binary_to_dicom(binary_path=binary, target_dir=batch_output_dir)
         print("#")
 
 if converter_count == 0:
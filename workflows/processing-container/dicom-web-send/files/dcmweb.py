@@ -1,9 +1,19 @@
+import io
 import requests
 import os
+import time
 import uuid
-from dicomweb_client.api import DICOMwebClient
 import pydicom
 import glob
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from urllib3.filepost import choose_boundary
+
+CHUNK_SIZE = 1024 * 1024
+STOW_MAX_INSTANCES = int(os.getenv("STOW_MAX_INSTANCES", "100"))
+STOW_MAX_MB = int(os.getenv("STOW_MAX_MB", "64"))
+STOW_RETRIES = int(os.getenv("STOW_RETRIES", "3"))
+PARALLEL_REQUESTS = int(os.getenv("PARALLEL_REQUESTS", "4"))
 
 
 def downloadObject(studyUID, seriesUID, objectUID, downloadDir):
@@ -56,23 +66,144 @@ def downloadSeries(studyUID, seriesUID, baseDir):
     return downloadDir
 
 
-def uploadDicomObject(pathToFile):
-    global client
-    ds = pydicom.dcmread(pathToFile)
-    studyInstanceUID = str(ds[0x0020, 0x000D].value)
-
-    client.store_instances([ds], studyInstanceUID)
-    return
+class MultipartDicomStream():
+    # multipart/related STOW-RS body, the files are read chunk by chunk while the request is sent
+    def __init__(self, files, boundary):
+        self.segments = []
+        for file in files:
+            self.segments.append(f"--{boundary}\r\nContent-Type: application/dicom\r\n\r\n".encode())
+            self.segments.append(file)
+            self.segments.append(b"\r\n")
+        self.segments.append(f"--{boundary}--\r\n".encode())
+        self.length = sum(len(segment) if isinstance(segment, bytes) else os.path.getsize(segment) for segment in self.segments)
+        self.segment_index = 0
+        self.current = None
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        size = CHUNK_SIZE if size is None or size < 0 else size
+        while self.segment_index < len(self.segments):
+            if self.current is None:
+                segment = self.segments[self.segment_index]
+                self.current = io.BytesIO(segment) if isinstance(segment, bytes) else open(segment, "rb")
+            data = self.current.read(size)
+            if data:
+                return data
+            self.current.close()
+            self.current = None
+            self.segment_index += 1
+        return b""
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+
+def stowDicomObjects(studyUID, files):
+    url = f"{pacsURL}/rs/studies/{studyUID}"
+    boundary = choose_boundary()
+    headers = {
+        'Content-Type': f'multipart/related; type="application/dicom"; boundary={boundary}',
+        'Accept': 'application/dicom+json'
+    }
+    body = MultipartDicomStream(files, boundary)
+    try:
+        response = session.post(url, data=body, headers=headers)
+    except requests.exceptions.RequestException as e:
+        print(f"STOW-RS request failed: {e}")
+        return False
+    finally:
+        body.close()
+
+    if response.status_code == requests.codes.ok:
+        return True
+    if response.status_code == requests.codes.accepted:
+        # 202: stored with warnings or partially stored -> only a batch with failed instances is retried one by one,
+        # a single instance is accepted with a 202, as the former DICOMwebClient upload did
+        failed_sop_count = getFailedSopCount(response)
+        if failed_sop_count == 0 or len(files) == 1:
+            print(f"STOW-RS of {len(files)} files returned 202 ({failed_sop_count} failed): {response.text[:500]}")
+            return True
+    print(f"STOW-RS of {len(files)} files returned {response.status_code}: {response.text[:500]}")
+    return False
+
+
+def getFailedSopCount(response):
+    # FailedSOPSequence (0008,1198) of the STOW-RS response
+    try:
+        return len(response.json().get("00081198", {}).get("Value", []))
+    except (ValueError, AttributeError):
+        return 0
+
+
+def uploadRequest(request):
+    studyUID, files = request
+    if stowDicomObjects(studyUID, files):
+        print(f"Sent {len(files)} files of study {studyUID}")
+        return []
+
+    print(f"Retrying {len(files)} files of study {studyUID} one by one")
+    failed_files = []
+    for pathToFile in files:
+        for retry in range(STOW_RETRIES):
+            if stowDicomObjects(studyUID, [pathToFile]):
+                break
+            time.sleep(retry + 1)
+        else:
+            print(f"Could not send file: {pathToFile}")
+            failed_files.append(pathToFile)
+    return failed_files
+
+
+def uploadDicomObjects(file_list):
+    """
+    Sends the files without decoding them: grouped by study into STOW-RS requests of at most
+    STOW_MAX_INSTANCES files / STOW_MAX_MB, PARALLEL_REQUESTS requests at a time.
+    """
+    studies = {}
+    for pathToFile in file_list:
+        studyUID = str(pydicom.dcmread(pathToFile, stop_before_pixels=True, specific_tags=["StudyInstanceUID"]).StudyInstanceUID)
+        studies.setdefault(studyUID, []).append(pathToFile)
+
+    upload_requests = []
+    for studyUID, files in studies.items():
+        request_files, request_bytes = [], 0
+        for pathToFile in files:
+            file_size = os.path.getsize(pathToFile)
+            if request_files and (len(request_files) >= STOW_MAX_INSTANCES or request_bytes + file_size > STOW_MAX_MB * 1024 * 1024):
+                upload_requests.append((studyUID, request_files))
+                request_files, request_bytes = [], 0
+            request_files.append(pathToFile)
+            request_bytes += file_size
+        if request_files:
+            upload_requests.append((studyUID, request_files))
+
+    start_time = time.time()
+    total_bytes = sum(os.path.getsize(pathToFile) for pathToFile in file_list)
+    failed_files = []
+    with ThreadPool(max(1, min(PARALLEL_REQUESTS, len(upload_requests)))) as pool:
+        for request_failed_files in pool.imap_unordered(uploadRequest, upload_requests):
+            failed_files.extend(request_failed_files)
+
+    duration = max(time.time() - start_time, 1e-6)
+    print(f"Sent {len(file_list) - len(failed_files)}/{len(file_list)} files of {len(studies)} studies in {len(upload_requests)} requests: "
+          f"{total_bytes / 1024 / 1024:.1f} MB in {duration:.2f}s -> {total_bytes / 1024 / 1024 / duration:.2f} MB/s, {len(file_list) / duration:.1f} files/s")
+    return failed_files
 
 
 def init(pacs_origin, port, aetitle):
-    global client
+    global pacsURL, session
 
     pacsURL = pacs_origin+":"+port+"/dcm4chee-arc/aets/"+aetitle.upper()
 
-    client = DICOMwebClient(
-        url=pacsURL, qido_url_prefix="rs", wado_url_prefix="rs", stow_url_prefix="rs"
-    )
+    # one connection per parallel STOW-RS request, kept alive over all requests
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, PARALLEL_REQUESTS))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
 
 
 if __name__ == "__main__":
@@ -99,16 +230,17 @@ if __name__ == "__main__":
     init(pacs_origin=pacs_origin, port=port, aetitle=aetitle)
     # file_list = glob.glob(input_dir+"/*/*.dcm")
 
-    file_count = 0
-    for dcm_file in file_list:
-        print("Found file: %s" % dcm_file)
-        file_count += 1
-        print("Sending file: %s" % dcm_file)
-        uploadDicomObject(dcm_file)
+    file_count = len(file_list)
+    print("Found %d files" % file_count)
 
     if file_count == 0:
         print("No corresponding dcm file found!")
         exit(1)
+
+    failed_files = uploadDicomObjects(file_list)
+    if len(failed_files) > 0:
+        print("Could not send %d files!" % len(failed_files))
+        exit(1)
     else:
         print("DICOMweb send done.")
         exit(0)
@@ -1,12 +1,31 @@
-#bin/bash
+#!/bin/bash
 shopt -s globstar
 BATCH_COUNT=$(find "$BATCHES_INPUT_DIR" -mindepth 1 -maxdepth 1 -type d | wc -l)
 
+# One conversion job per batch-element (series), the jobs run on a pool of WORKERS processes.
+# Pool size: PARALLEL_PROCESSES or the cpu request of the pod (CPU_MILLICORES), 1 otherwise
+# (the memory request of the pod is only sized for one converter then).
+if [ -n "$PARALLEL_PROCESSES" ]; then
+    WORKERS=$PARALLEL_PROCESSES
+elif [ -n "$CPU_MILLICORES" ]; then
+    WORKERS=$(( (CPU_MILLICORES + 999) / 1000 ))
+else
+    WORKERS=1
+fi
+[ "$WORKERS" -lt 1 ] && WORKERS=1
+[ "$WORKERS" -gt "$BATCH_COUNT" ] && [ "$BATCH_COUNT" -gt 0 ] && WORKERS=$BATCH_COUNT
+
+# every converter runs single threaded when the pod's cpus are shared by the workers
+if [ "$WORKERS" -gt 1 ] && [ -z "$ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS" ]; then
+    export ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=1
+fi
+
 echo ""
 echo "SNAPSHOT VERSION!"
 echo ""
 echo "BATCHES_INPUT_DIR:" $BATCHES_INPUT_DIR
 echo "BATCH_COUNT: " $BATCH_COUNT
+echo "WORKERS:     " $WORKERS
 echo ""
 echo "CONVERTFROM:" $CONVERTFROM
 echo "CONVERTTO:  " $CONVERTTO
@@ -17,28 +36,49 @@ if [ "$CONVERTTO" != "nrrd" ] && [ "$CONVERTTO" != "nii" ] && [ "$CONVERTTO" !=
     exit 1
 fi
 
-echo ""
-echo "Starting batch loop..."
-echo ""
+# converted file count per batch-element
+STATUS_DIR=$(mktemp -d)
+export STATUS_DIR
+
+check_output() {
+    output_filepath=$1
+    [ ! -f "$output_filepath" ] && { echo "Error: Converted file not found!."; return 2; }
+    if [ -s "$output_filepath" ]
+    then
+        echo "Converted file found and has some data."
+    else
+        echo "Converted file found but is empty!"
+        rm -rf "$output_filepath"
+        return 1;
+    fi;
+}
 
-for batch_dir in $BATCHES_INPUT_DIR/*
-do
+# output exists, is not empty and newer than every input file -> nothing to do
+is_up_to_date() {
+    output_filepath=$1
+    input_dir=$2
+    [ -s "$output_filepath" ] || return 1
+    [ -z "$(find "$input_dir" -type f -newer "$output_filepath" -print -quit)" ]
+}
+
+convert_batch() {
+    batch_dir=$1
     batch_input_dir=${batch_dir}/${OPERATOR_IN_DIR}
     batch_output_dir=${batch_dir}/${OPERATOR_OUT_DIR}
     batch_name=$(basename -- "$batch_dir")
-    
+
     echo "batch_dir" $batch_dir
     echo "batch_name" $batch_name
     echo "BATCH INPUT DIR:  " $batch_input_dir
     echo "BATCH OUTPUT DIR: " $batch_output_dir
     echo ""
-    
+
     if [ ! -d "$batch_input_dir" ]; then
         echo "BATCH INPUT DIR does not exists: " $batch_input_dir
         echo "Skipping batch..."
-        continue
+        return 0
     fi
-    
+
     loop_counter=0
     # check if no dcm extension is set
     if [[ $CONVERTFROM = *[!\ ]* ]]; then
@@ -46,49 +86,39 @@ do
     else
         extension_query="**/*"
     fi
-    
-    shopt -s nullglob
+
+    shopt -s globstar nullglob
     for file_found in "$batch_input_dir"/$extension_query; do
         filepath=${file_found%/*};
         filename=${file_found##*/};
-        
+
         mkdir -p "$batch_output_dir"
-        
+
         if [ "$CONVERTFROM" == "dcm" ];then
             output_filepath="$batch_output_dir"/"$batch_name"."$CONVERTTO"
         else
             output_filepath="$batch_output_dir"/"${filename/"$CONVERTFROM"/$CONVERTTO}"
         fi
-        
+
         echo ""
         echo "file_found: " $file_found
         echo "output_filepath: " $output_filepath
         echo ""
-        
+
         ((++loop_counter))
-        install -Dv / $output_filepath
-        $FILECONVERTER -i "$file_found" -o "$output_filepath";
-        
-        [ ! -f "$output_filepath" ] && { echo "Error: Converted file not found!."; exit 2; }
-        if [ -s "$output_filepath" ]
-        then
-            echo "Converted file found and has some data."
+        echo $loop_counter > "$STATUS_DIR/$batch_name"
+
+        if is_up_to_date "$output_filepath" "$batch_input_dir"; then
+            echo "Converted file is already up to date -> skipping conversion."
         else
-            echo "Converted file found but is empty!"
-            rm -rf $output_filepath
-            exit 1;
-        fi;
-        
+            rm -f "$output_filepath"
+            $FILECONVERTER -i "$file_found" -o "$output_filepath";
+            check_output "$output_filepath" || return $?
+        fi
+
         file_count=$(find "$batch_output_dir" -maxdepth 1 -name \*.$CONVERTTO | wc -l)
         if [ "$file_count" -gt 1 ]
         then
-            echo ""
-            echo ""
-            echo ""
-            echo ""
-            echo ""
-            echo ""
-            echo ""
             echo ""
             echo "+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++"
             echo "########################################          ERROR          ########################################"
@@ -99,37 +129,29 @@ do
             echo "                    Like missing volume slides or similar issues.";
             echo ""
             echo "+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++"
+            echo "BATCH: " $batch_name
             echo "FILE_COUNT: " $file_count
             if [ "$FORCE_SINGLE_FILE" = true ] ; then
                 echo "Starting new conversion -> forcing single file output!"
                 rm -rf $batch_output_dir/*
-                $FILECONVERTER -r 'MITK Simple Volume Importer' -i $f -o $output_filepath;
-                
-                [ ! -f "$output_filepath" ] && { echo "Error: Converted file not found!."; exit 2; }
-                if [ -s "$output_filepath" ]
-                then
-                    echo "Converted file found and has some data."
-                    
-                else
-                    echo "Converted file found but is empty!"
-                    rm -rf $output_filepath
-                    exit 1;
-                fi;
-                
-                file_count=$(find $output_dir_path -maxdepth 1 -name \*.$CONVERTTO | wc -l)
+                $FILECONVERTER -r 'MITK Simple Volume Importer' -i "$file_found" -o "$output_filepath";
+
+                check_output "$output_filepath" || return $?
+
+                file_count=$(find "$batch_output_dir" -maxdepth 1 -name \*.$CONVERTTO | wc -l)
                 echo "FILE_COUNT: " $file_count
                 if [ "$file_count" -gt 1 ]
                 then
                     echo "Again more than one files have been found."
                     echo "Exiting!"
-                    exit 1
+                    return 1
                 fi;
             else
                 echo "NOT FORCING TO SINGLE FILE! (CAN BE ENABLED BY FORCE_SINGLE_FILE=true -> not recommended)"
                 echo "This is considered as an error and the program is terminated!";
-                exit 1
+                return 1
             fi;
-            
+
         fi
 
         if [ "$CONVERTFROM" == "dcm" ];then
@@ -137,8 +159,25 @@ do
             break
         fi
     done
-    
-done
+}
+export -f check_output is_up_to_date convert_batch
+
+echo ""
+echo "Starting batch pool..."
+echo ""
+
+# xargs stops scheduling new jobs as soon as a job exits with 255
+find "$BATCHES_INPUT_DIR" -mindepth 1 -maxdepth 1 -type d -print0 | sort -z | \
+    xargs -0 -r -n 1 -P "$WORKERS" bash -c 'convert_batch "$1" || { echo "Conversion failed: $1"; exit 255; }' _
+pool_status=$?
+
+loop_counter=$(cat "$STATUS_DIR"/* 2>/dev/null | awk '{ sum += $1 } END { print sum + 0 }')
+rm -rf "$STATUS_DIR"
+
+if [ "$pool_status" -ne 0 ]; then
+    echo "Fileconverter failed!"
+    exit 1
+fi
 
 echo "#"
 echo "# Converted $loop_counter files!"
@@ -149,4 +188,4 @@ if [[ "$loop_counter" -gt 0 ]] ; then
 else
     echo "No input file found!";
     exit 1;
-fi;
\ No newline at end of file
+fi;
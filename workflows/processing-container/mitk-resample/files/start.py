@@ -4,7 +4,7 @@ from os.path import join, exists, dirname, basename
 from glob import glob
 from shutil import copy2, move, rmtree
 from pathlib import Path
-import nibabel as nib
+import SimpleITK as sitk
 
 # For multiprocessing
 from multiprocessing.pool import ThreadPool
@@ -13,69 +13,168 @@ from multiprocessing.pool import ThreadPool
 from subprocess import PIPE, run
 execution_timeout = 10
 
-# Counter to check if smth has been processed
-processed_count = 0
-
-def process_input_file(input_path, original_path, original_shape, target_dir):
-    global processed_count, execution_timeout, executable, interpolator, copy_target_data
-    print("#")
-    print("##################################################")
-    print("#")
-    print(f"# Resampling:")
-    print("#")
-    print(f"# input-file: {input_path}")
-    print(f"# org-file:   {original_path}")
-    result = True
-    target_path = join(target_dir, basename(input_path))
-    input_shape = nib.load(input_path).shape
-
-    if input_shape != original_shape:
+# Interpolators which can be done in process -> same as MitkCLResampleImageToReference without registration
+sitk_interpolators = {
+    0: sitk.sitkLinear,
+    1: sitk.sitkNearestNeighbor
+}
+
+# Reference geometry per original image -> read once per batch-element
+reference_geometries = {}
+
+
+def get_worker_count():
+    """
+    Number of parallel resamplings: PARALLEL_PROCESSES or the CPU request of the pod (cgroup cpu.shares = millicores * 1024 / 1000).
+    """
+    parallel_processes = getenv("PARALLEL_PROCESSES", "None")
+    if parallel_processes.lower() != "none":
+        return max(1, int(parallel_processes))
+
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.shares") as f:
+            cpu_shares = int(f.read())
+        if cpu_shares > 2:
+            return max(1, min(os.cpu_count(), round(cpu_shares / 1024)))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, int(int(quota) / int(period)))
+    except (OSError, ValueError):
+        pass
+    return max(1, min(os.cpu_count(), 4))
+
+
+def read_geometry(image_path):
+    # header only
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(image_path)
+    reader.ReadImageInformation()
+    return {
+        "size": reader.GetSize(),
+        "origin": reader.GetOrigin(),
+        "spacing": reader.GetSpacing(),
+        "direction": reader.GetDirection()
+    }
+
+
+def get_reference_geometry(original_path):
+    if original_path not in reference_geometries:
+        reference_geometries[original_path] = read_geometry(original_path)
+    return reference_geometries[original_path]
+
+
+def resample_in_process(input_path, reference_geometry, target_path):
+    image = sitk.ReadImage(input_path)
+    if image.GetDimension() != len(reference_geometry["size"]) or image.GetNumberOfComponentsPerPixel() != 1:
+        return False
+
+    resampled = sitk.Resample(
+        image,
+        reference_geometry["size"],
+        sitk.Transform(),
+        sitk_interpolators[interpolator],
+        reference_geometry["origin"],
+        reference_geometry["spacing"],
+        reference_geometry["direction"],
+        0,
+        image.GetPixelID()
+    )
+    sitk.WriteImage(resampled, target_path, True)
+    return True
+
+
+def resample_with_mitk(input_path, original_path, target_path):
+    command = [str(executable), "-f", str(original_path), "-m", str(input_path), "-o", str(target_path), "--interpolator", str(interpolator)]
+    output = run(command, stdout=PIPE, stderr=PIPE, universal_newlines=True, timeout=execution_timeout)
+    # command stdout output -> output.stdout
+    # command stderr output -> output.stderr
+    if output.returncode != 0:
         print("#")
-        print("# -> shapes are different!")
+        print("##################################################")
         print("#")
-        print(f"# input_shape:    {input_shape}")
-        print(f"# original_shape: {original_shape}")
+        print("##################  ERROR  #######################")
         print("#")
-        print("# -> starting resampling ...")
+        print("# ----> Something went wrong with the shell-execution!")
+        print(f"# Command:  {command}")
         print("#")
-
-        command = [str(executable), "-f", str(original_path), "-m", str(input_path), "-o", str(target_path), "--interpolator", str(interpolator)]
-        output = run(command, stdout=PIPE, stderr=PIPE, universal_newlines=True, timeout=execution_timeout)
-        # command stdout output -> output.stdout
-        # command stderr output -> output.stderr
-        if output.returncode != 0:
-            print("#")
-            print("##################################################")
-            print("#")
-            print("##################  ERROR  #######################")
-            print("#")
-            print("# ----> Something went wrong with the shell-execution!")
-            print(f"# Command:  {command}")
-            print("#")
-            print(f"# STDERR: {output.stderr}")
-            print("#")
-            print("##################################################")
-            print("#")
-            result = False
-    else:
+        print(f"# STDERR: {output.stderr}")
         print("#")
-        print("# -> shapes are already fine!")
-        print("# -> skipping...")
+        print("##################################################")
         print("#")
+        return False
+    return True
+
+
+def process_input_file(job):
+    input_path, original_path, target_dir = job
+    result = True
+    target_path = join(target_dir, basename(input_path))
+    reference_geometry = get_reference_geometry(original_path)
+    input_shape = read_geometry(input_path)["size"]
+    original_shape = reference_geometry["size"]
+
+    if input_shape != original_shape:
+        print(f"# {basename(input_path)}: shapes are different {input_shape} vs {original_shape} -> resampling to {original_path}")
+        resampled = False
+        if interpolator in sitk_interpolators:
+            try:
+                resampled = resample_in_process(input_path, reference_geometry, target_path)
+            except Exception as e:
+                print(f"# {basename(input_path)}: in-process resampling failed: {e} -> using MITK")
+        if not resampled:
+            result = resample_with_mitk(input_path, original_path, target_path)
+    else:
+        print(f"# {basename(input_path)}: shapes are already fine -> skipping...")
         if input_path != target_path:
             print("# -> copy input to target")
             copy2(input_path, target_path)
 
     if not copy_target_data and result and input_path != target_path:
-        print("#")
-        print("# -> deleting input file ...")
-        print("#")
-        remove(input_file)
+        print(f"# {basename(input_path)}: deleting input file ...")
+        remove(input_path)
 
     print(f"# {basename(input_path)} done.")
-    print("#")
-    processed_count += 1
-    return result, input_file
+    return result, input_path
+
+
+def collect_jobs(input_dir, org_input_dir, output_dir):
+    input_files = glob(join(input_dir, input_file_extension), recursive=False)
+    original_files = glob(join(org_input_dir, input_file_extension), recursive=False)
+    assert len(original_files) == 1
+    original_path = original_files[0]
+    print(f"# Found {len(input_files)} input-files!")
+    return [(input_file, original_path, output_dir) for input_file in input_files]
+
+
+def run_jobs(jobs):
+    """
+    Resamples all jobs on a thread pool, the images of all batch-elements are processed concurrently.
+    :returns: number of processed files
+    """
+    if len(jobs) == 0:
+        return 0
+
+    workers = min(get_worker_count(), len(jobs))
+    # every worker resamples single threaded -> no oversubscription of the pod's CPUs
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(1 if workers > 1 else max(1, get_worker_count()))
+    print(f"# Resampling {len(jobs)} files with {workers} workers")
+
+    processed = 0
+    failed = []
+    with ThreadPool(workers) as threadpool:
+        for result, input_file in threadpool.imap_unordered(process_input_file, jobs):
+            processed += 1
+            if not result:
+                failed.append(input_file)
+    if len(failed) > 0:
+        print("#")
+        print(f"# Resampling failed for: {failed}")
+        print("#")
+    return processed
 
 
 workflow_dir = getenv("WORKFLOW_DIR", "None")
@@ -112,9 +211,6 @@ interpolator = int(interpolator) if interpolator.lower() != "none" else 1
 # File-extension to search for in the input-dir
 input_file_extension = "*.nii.gz"
 
-# How many processes should be started?
-parallel_processes = 3
-
 print("##################################################")
 print("#")
 print("# Starting resampling:")
@@ -132,17 +228,11 @@ print("#")
 print("##################################################")
 print("#")
 
-# Loop for every batch-element (usually series)
+# Collect the files of every batch-element (usually series), they are resampled together on one pool
+jobs = []
 batch_folders = [f for f in glob(join('/', workflow_dir, batch_name, '*'))]
 for batch_element_dir in batch_folders:
-    print("####################################################################################################")
-    print("#")
-    print("#")
-    print(f"# Processing batch-element {batch_element_dir}")
-    print("#")
-    print("#")
-    print("####################################################################################################")
-    print("#")
+    print(f"# Collecting batch-element {batch_element_dir}")
     element_input_dir = join(batch_element_dir, operator_in_dir)
     element_output_dir = join(batch_element_dir, operator_out_dir)
     element_org_input_dir = join(batch_element_dir, org_input_dir)
@@ -157,28 +247,9 @@ for batch_element_dir in batch_folders:
 
     # creating output dir
     Path(element_output_dir).mkdir(parents=True, exist_ok=True)
+    jobs.extend(collect_jobs(element_input_dir, element_org_input_dir, element_output_dir))
 
-    # creating output dir
-    input_files = glob(join(element_input_dir, input_file_extension), recursive=False)
-    original_files = glob(join(element_org_input_dir, input_file_extension), recursive=False)
-    assert len(original_files) == 1
-    original_path = original_files[0]
-    original_shape = nib.load(original_path).shape
-
-    print(f"# Found {len(input_files)} input-files!")
-    for input_file in input_files:
-        result, input_file = process_input_file(
-            input_path=input_file,
-            original_path=original_path,
-            original_shape=original_shape,
-            target_dir=element_output_dir
-        )
-
-    # Alternative with multi-processing
-    # results = ThreadPool(parallel_processes).imap_unordered(process_input_file, input_files)
-    # for result, input_file in results:
-    #     print(f"#  Done: {input_file}")
-    print(f"# Batch-element {batch_element_dir} done.")
+processed_count = run_jobs(jobs)
 
 print("#")
 print("##################################################")
@@ -199,7 +270,7 @@ if processed_count == 0:
     print("#")
 
     batch_input_dir = join('/', workflow_dir, operator_in_dir)
-    batch_output_dir = join('/', workflow_dir, operator_in_dir)
+    batch_output_dir = join('/', workflow_dir, operator_out_dir)
     batch_org_input_dir = join('/', workflow_dir, org_input_dir)
 
     # check if input dir present
@@ -211,22 +282,7 @@ if processed_count == 0:
     else:
         # creating output dir
         Path(batch_output_dir).mkdir(parents=True, exist_ok=True)
-
-        input_files = glob(join(batch_input_dir, input_file_extension), recursive=False)
-        original_files = glob(join(batch_org_input_dir, input_file_extension), recursive=False)
-        assert len(original_files) == 1
-
-        original_path = original_files[0]
-        original_shape = nib.load(original_path).shape
-
-        print(f"# Found {len(input_files)} input-files!")
-        for input_file in input_files:
-            result, input_file = process_input_file(
-                input_path=input_file,
-                original_path=original_path,
-                original_shape=original_shape,
-                target_dir=element_output_dir
-            )
+        processed_count = run_jobs(collect_jobs(batch_input_dir, batch_org_input_dir, batch_output_dir))
 
     print("#")
     print("##################################################")
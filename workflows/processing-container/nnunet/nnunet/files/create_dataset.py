@@ -7,7 +7,7 @@ import random
 import time
 import nibabel as nib
 import numpy as np
-from multiprocessing.pool import ThreadPool
+from multiprocessing import Pool
 from os.path import join, exists, dirname, basename
 
 
@@ -48,10 +48,9 @@ def check_if_encoding_in_use(label_encoding):
     return label_encoding
 
 
-def process_seg_nifti(seg_nifti):
-    global label_names_found, label_names_found, label_int, tracking_ids
+def get_label_tag(seg_nifti):
+    global tracking_ids
 
-    print(f"# Processing NIFTI: {seg_nifti}")
     if "--" in seg_nifti:
         seg_info = seg_nifti.split("--")
         label_tag = seg_info[-1].split(".")[0].replace("_", " ").replace("++", "/")
@@ -69,12 +68,60 @@ def process_seg_nifti(seg_nifti):
 
                         if "TrackingIdentifier" in entry:
                             tracking_ids[str(seg_id)] = entry["TrackingIdentifier"]
-
     else:
         label_tag = str(label_int)
-    # your code here
-    nii_array = nib.load(seg_nifti).get_data().astype(int)
-    nifti_labels = list(np.unique(nii_array))
+    return label_tag
+
+
+def load_label_nifti(seg_nifti):
+    # keep_file_open: the chunks are read through one open (gzip) file handle with increasing offsets,
+    # otherwise every chunk reopens the .nii.gz and decompresses it from the beginning again
+    return nib.load(seg_nifti, keep_file_open=True)
+
+
+def iter_label_chunks(nifti):
+    """
+    Reads the label map chunk_slices slices (last axis) at a time in the smallest unsigned dtype of its values.
+    The NIFTI should be loaded with load_label_nifti.
+    """
+    depth = nifti.shape[-1] if len(nifti.shape) > 2 else 1
+    for start in range(0, depth, chunk_slices):
+        chunk = np.asanyarray(nifti.dataobj[..., start:start + chunk_slices] if len(nifti.shape) > 2 else nifti.dataobj)
+        if chunk.dtype.kind == 'f':
+            chunk = np.rint(chunk)
+        if chunk.dtype.kind not in 'ub':
+            if chunk.size > 0 and chunk.min() < 0:
+                raise ValueError("negative label value")
+            chunk = chunk.astype(np.min_scalar_type(int(chunk.max()) if chunk.size > 0 else 0), copy=False)
+        yield start, chunk
+
+
+def scan_seg_nifti(seg_nifti):
+    """
+    Collects the label values of a seg NIFTI -> runs in the worker processes.
+    :returns: seg_nifti, sorted label values (incl. 0) or None on error
+    """
+    print(f"# Scanning NIFTI: {seg_nifti}")
+    try:
+        nifti_values = set()
+        for _, chunk in iter_label_chunks(load_label_nifti(seg_nifti)):
+            nifti_values.update(np.unique(chunk).tolist())
+        return seg_nifti, sorted(nifti_values)
+    except Exception as e:
+        print(f"# Could not read NIFTI: {seg_nifti}: {e}")
+        return seg_nifti, None
+
+
+def get_label_encoding(seg_nifti, nifti_values):
+    """
+    Assigns the label int of a seg NIFTI. Called in the main process in the (sorted) order of the series and seg files,
+    so the encoding does not depend on the order in which the workers finish.
+    :returns: (NIFTI encoding, target encoding)
+    """
+    global label_names_found, label_int
+
+    label_tag = get_label_tag(seg_nifti)
+    nifti_labels = list(nifti_values)
     if 0 in nifti_labels:
         nifti_labels.remove(0)
     else:
@@ -90,7 +137,7 @@ def process_seg_nifti(seg_nifti):
         print("# ")
         exit(1)
 
-    nifti_bin_encoding = nifti_labels[0]
+    nifti_bin_encoding = int(nifti_labels[0])
     if label_tag not in label_names_found:
         print(f"# Adding label: {label_tag} ...")
         if use_nifti_labels:
@@ -104,8 +151,6 @@ def process_seg_nifti(seg_nifti):
 
         if label_int != nifti_bin_encoding:
             print(f"# replacing labels: {label_tag} -> from {nifti_bin_encoding} -> to {label_int}")
-            nii_array = np.where(nii_array == nifti_bin_encoding, label_int, nii_array)
-            nifti_bin_encoding = label_int
 
         label_names_found[label_tag] = label_int
     else:
@@ -125,17 +170,53 @@ def process_seg_nifti(seg_nifti):
                 print("#")
             else:
                 print(f"# replacing labels: {label_tag} -> from {nifti_bin_encoding} -> to {label_names_found[label_tag]}")
-            nii_array = np.where(nii_array == nifti_bin_encoding, label_names_found[label_tag], nii_array)
-            nifti_bin_encoding = label_names_found[label_tag]
         else:
             print("# NIFTI encoding -> ok")
 
-    return nii_array, seg_nifti
+    return nifti_bin_encoding, label_names_found[label_tag]
+
+
+def merge_seg_niftis(target_seg_path, seg_jobs):
+    """
+    Merges the seg NIFTIs of a series into one label map -> runs in the worker processes.
+    Every NIFTI is remapped with a lookup table and merged (maximum) into the preallocated label map in place,
+    chunk_slices slices at a time.
+    :param seg_jobs: [(seg_nifti, nifti encoding, target encoding)]
+    :returns: target_seg_path or None on error
+    """
+    try:
+        example_img = nib.load(seg_jobs[0][0])
+        max_label = max(target_encoding for _, _, target_encoding in seg_jobs)
+        combined = np.zeros(example_img.shape, dtype=np.uint8 if max_label <= np.iinfo(np.uint8).max else np.uint16)
+
+        for seg_nifti, nifti_encoding, target_encoding in seg_jobs:
+            print(f"# Merging NIFTI: {seg_nifti}: {nifti_encoding} -> {target_encoding}")
+            seg_img = load_label_nifti(seg_nifti)
+            if seg_img.shape != combined.shape:
+                print(f"# Shape mismatch: {seg_img.shape} vs {combined.shape}")
+                return None
+            lut = np.zeros(max(nifti_encoding, 255) + 1, dtype=combined.dtype)
+            lut[nifti_encoding] = target_encoding
+            for start, chunk in iter_label_chunks(seg_img):
+                combined_chunk = combined[..., start:start + chunk_slices] if combined.ndim > 2 else combined
+                np.maximum(combined_chunk, lut[chunk], out=combined_chunk)
+
+        print(f"# Writing Ground Truth into {target_seg_path} ...")
+        header = example_img.header.copy()
+        header.set_data_dtype(combined.dtype)
+        header.set_slope_inter(1, 0)
+        Path(dirname(target_seg_path)).mkdir(parents=True, exist_ok=True)
+        nib.Nifti1Image(combined, example_img.affine, header).to_filename(target_seg_path)
+        return target_seg_path
+    except Exception as e:
+        print(f"# Merging failed for {target_seg_path}: {e}")
+        return None
 
 
 def prepare_dataset(datset_list, dataset_id):
-    global template_dataset_json, label_names_found, label_int, thread_count
-    print(f"# Preparing all {dataset_id} series: {len(train_series)}")
+    global template_dataset_json, label_names_found, label_int
+    print(f"# Preparing all {dataset_id} series: {len(datset_list)}")
+    series_seg_niftis = []
     for series in datset_list:
         print("######################################################################")
         print("#")
@@ -170,40 +251,47 @@ def prepare_dataset(datset_list, dataset_id):
             else:
                 shutil.move(modality_nifti, target_modality_path)
 
-        target_seg_path = join(task_dir, "labelsTr", base_file_path)
-
         seg_nifti_list = []
         for label_dir in input_label_dirs:
             seg_niftis = glob.glob(join(series, label_dir, "*.nii.gz"), recursive=True)
-            seg_nifti_list.extend(seg_niftis)
-
-        print(f"# Found {len(seg_nifti_list)} seg NIFTIs -> start merging")
-
-        example_img = nib.load(seg_nifti_list[0])
-        combined = np.zeros_like(example_img.get_fdata().astype(int))
-
-        print(f"# Starting {thread_count} threads for NIFTI processing ...")
-        results = ThreadPool(thread_count).imap_unordered(process_seg_nifti, seg_nifti_list)
-        for result_array, seg_nifti in results:
-            print(f"Finished: {seg_nifti}")
-            if result_array is None:
+            seg_nifti_list.extend(sorted(seg_niftis))
+
+        print(f"# Found {len(seg_nifti_list)} seg NIFTIs")
+        if len(seg_nifti_list) == 0:
+            print(f"# No seg NIFTIs found for series {series} -> abort.")
+            exit(1)
+        series_seg_niftis.append((series, seg_nifti_list))
+
+    all_seg_niftis = [seg_nifti for _, seg_nifti_list in series_seg_niftis for seg_nifti in seg_nifti_list]
+    print(f"# Starting {parallel_processes} processes for NIFTI processing ...")
+    with Pool(parallel_processes) as pool:
+        print(f"# Scanning labels of {len(all_seg_niftis)} seg NIFTIs ...")
+        nifti_values = {}
+        for seg_nifti, values in pool.imap_unordered(scan_seg_nifti, all_seg_niftis):
+            if values is None:
                 print("Something went wrong.")
                 exit(1)
-            else:
-                print("# Merging NIFTI to Ground Truth ...")
-                combined = np.maximum(combined, result_array)
-                print("# Merging OK")
-                if not copy_target_data:
-                    print("# Deleting SEG NIFTI ...")
-                    os.remove(seg_nifti)
-        # your code here
-        print(f"# All threads done!")
-        print(f"# Writing Ground Truth into {target_seg_path} ...")
-        combined = nib.Nifti1Image(combined, example_img.affine, example_img.header)
-        Path(dirname(target_seg_path)).mkdir(parents=True, exist_ok=True)
-        combined.to_filename(target_seg_path)
-        print("# GT file OK")
+            nifti_values[seg_nifti] = values
+
+        merge_jobs = []
+        for series, seg_nifti_list in series_seg_niftis:
+            target_seg_path = join(task_dir, "labelsTr", f"{basename(series)}.nii.gz")
+            seg_jobs = []
+            for seg_nifti in seg_nifti_list:
+                nifti_encoding, target_encoding = get_label_encoding(seg_nifti, nifti_values[seg_nifti])
+                seg_jobs.append((seg_nifti, nifti_encoding, target_encoding))
+            merge_jobs.append((target_seg_path, seg_jobs))
+
+        print(f"# Merging {len(merge_jobs)} Ground Truth label maps ...")
+        for target_seg_path in pool.starmap(merge_seg_niftis, merge_jobs, chunksize=1):
+            if target_seg_path is None:
+                print("Something went wrong.")
+                exit(1)
+            print(f"# GT file OK: {target_seg_path}")
+    print(f"# All processes done!")
 
+    for series, seg_nifti_list in series_seg_niftis:
+        base_file_path = f"{basename(series)}.nii.gz"
         if not copy_target_data:
             print("# Deleting input NIFTIs ...")
             for file_path in seg_nifti_list:
@@ -251,7 +339,9 @@ task_dir = join(operator_out_dir, "nnUNet_raw_data", os.environ["TASK"])
 
 use_nifti_labels = True if os.getenv("PREP_USE_NIFITI_LABELS", "False").lower() == "true" else False
 
-thread_count = 5
+parallel_processes = int(os.getenv("PREP_PROCESSES", "5"))
+# slices per chunk when reading / merging the seg NIFTIs
+chunk_slices = int(os.getenv("PREP_CHUNK_SLICES", "64"))
 
 tracking_ids = {}
 
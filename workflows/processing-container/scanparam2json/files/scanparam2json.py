@@ -3,8 +3,10 @@
 import pydicom
 import json
 import os
+import csv
 import glob
 from datetime import datetime
+from multiprocessing import Pool
 
 keywords_basic = ["StudyInstanceUID", "SeriesInstanceUID", "StudyDescription", "SeriesDescription",
                 "Modality", "AcquisitionDateTime", "ProcedureCodeSequence", "Manufacturer", "ManufacturerModelName",
@@ -23,8 +25,8 @@ keywords_ct = ["StudyInstanceUID", "SeriesInstanceUID","StudyDescription", "Seri
             "FilterType", "GeneratorPower", "FocalSpots",
             "DateOfLastCalibration", #"TimeOfLastCalibration",
             "ConvolutionKernel",
-            "WaterEquivalentDiameter", "WaterEquivalentDiameterCalculationMethodCodeSequence"
-            "RevolutionTime"
+            "WaterEquivalentDiameter", "WaterEquivalentDiameterCalculationMethodCodeSequence",
+            "RevolutionTime",
             "SingleCollimationWidth", "TotalCollimationWidth",
             "TableSpeed", "TableFeedPerRotation",
             "SpiralPitchFactor",
@@ -63,72 +65,86 @@ keywords_mr = ["StudyInstanceUID", "SeriesInstanceUID", "StudyDescription", "Ser
 ]
 
 
-# From the template
-batch_folders = [f for f in glob.glob(os.path.join('/', os.environ['WORKFLOW_DIR'], os.environ['BATCH_NAME'], '*'))]
+# every keyword of all modalities -> columns of the csv table, tags read from the DICOM header
+keywords_all = list(dict.fromkeys(keywords_basic + keywords_ct + keywords_mr))
+specific_tags = [keyword for keyword in keywords_all if pydicom.datadict.tag_for_keyword(keyword) is not None]
 
-json_list = []
+parallel_processes = int(os.getenv("PARALLEL_PROCESSES", "4"))
 
-for batch_element_dir in batch_folders:
 
-    element_input_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_DIR'])
-    element_output_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_OUT_DIR'])
-    if not os.path.exists(element_output_dir):
-        os.makedirs(element_output_dir)
+def get_value(dcm, key):
+    if key not in dcm:
+        return ''
+    element = dcm[key]
+    if element.VR == "SQ" and len(element.value) == 1:   # need to deal with sequence
+        return [str(seq_element.value) for seq_element in element.value[0]]
+    return str(element.value)
 
-    # The processing algorithm
-    print(f'Checking {element_input_dir} for dcm files and writing results to {element_output_dir}')
-    dcm_files = sorted(glob.glob(os.path.join(element_input_dir, "*.dcm*"), recursive=True))
 
+def extract_scan_parameters(batch_element_dir):
+    """
+    Reads only the needed tags of the first DICOM of the batch element (no pixel data) -> runs in the worker processes.
+    :returns: batch_element_dir, extracted parameters or None if no DICOM has been found
+    """
+    element_input_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_DIR'])
+    print(f'Checking {element_input_dir} for dcm files')
+    dcm_files = sorted(glob.glob(os.path.join(element_input_dir, "*.dcm*"), recursive=True))
     if len(dcm_files) == 0:
-        print("No dicom file found!")
-        exit(1)
+        return batch_element_dir, None
+
+    print(f"Extracting scan parameters from: {dcm_files[0]}")
+    dcm = pydicom.dcmread(dcm_files[0], force=True, stop_before_pixels=True, specific_tags=specific_tags)
+
+    # check modality of the scan
+    modality = str(dcm.get('Modality', ''))
+    if modality == "CT":
+        keywords = keywords_ct
+    elif modality == "MR":
+        keywords = keywords_mr
     else:
-        scan_mappings = []
-        print(f"Extracting study_id from: {dcm_files[0]}")
-        dcm = pydicom.dcmread(dcm_files[0], force=True)
-
-        json_dict = {}
-
-        # check modality of the scan
-        modality = str(dcm['Modality'].value)
-        if modality == "CT":
-            keywords = keywords_ct
-        elif modality == "MR":
-            keywords = keywords_mr
-        else :
-            print(f"unknown modality: {modality}")
-            keywords = keywords_basic
-
-        for key in keywords:
-            try:
-                if dcm[key].repval == "<Sequence, length 1>":   # need to deal with sequence
-                    print(f'{key} is a sequence')
-                    #print(dcm[key].value)
-                    ds = dcm[key].value[0]
-                    i = 0
-                    seq_list = []
-                    while i < len(ds):
-                        seq_key = dir(ds)[i]
-                        seq_value = str(ds[seq_key].value)
-                        seq_list.append(seq_value)
-                        i += 1
-                    json_dict[key] = seq_list
-                else:
-                    json_dict[key] = str(dcm[key].value)
-            except:
-                json_dict[key] = ''
-
-        print(json_dict)
-        json_list.append(json_dict)
+        print(f"unknown modality: {modality}")
+        keywords = keywords_basic
+
+    json_dict = {}
+    for key in keywords:
+        try:
+            json_dict[key] = get_value(dcm, key)
+        except Exception:
+            json_dict[key] = ''
+    return batch_element_dir, json_dict
+
 
+# From the template
+batch_folders = sorted([f for f in glob.glob(os.path.join('/', os.environ['WORKFLOW_DIR'], os.environ['BATCH_NAME'], '*'))])
 
 batch_output_dir = os.path.join('/', os.environ['WORKFLOW_DIR'], os.environ['OPERATOR_OUT_DIR'])
 if not os.path.exists(batch_output_dir):
     os.makedirs(batch_output_dir)
 
-json_file_path = os.path.join(batch_output_dir, "scan_parameters_{}.json".format(datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')))
-
-print (json_file_path)
-
-with open(json_file_path, "w", encoding='utf-8') as jsonData:
-    json.dump(json_list, jsonData, indent=4, sort_keys=False, ensure_ascii=True)
\ No newline at end of file
+result_name = "scan_parameters_{}".format(datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'))
+jsonl_file_path = os.path.join(batch_output_dir, f"{result_name}.jsonl")
+csv_file_path = os.path.join(batch_output_dir, f"{result_name}.csv")
+print(jsonl_file_path)
+print(csv_file_path)
+
+# records are written as soon as a worker is done -> memory does not grow with the cohort
+record_count = 0
+with open(jsonl_file_path, "w", encoding='utf-8') as jsonl_file, open(csv_file_path, "w", encoding='utf-8', newline='') as csv_file:
+    csv_writer = csv.DictWriter(csv_file, fieldnames=keywords_all, restval='')
+    csv_writer.writeheader()
+    with Pool(parallel_processes) as pool:
+        for batch_element_dir, json_dict in pool.imap_unordered(extract_scan_parameters, batch_folders):
+            if json_dict is None:
+                print(f"No dicom file found in {batch_element_dir}!")
+                exit(1)
+
+            element_output_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_OUT_DIR'])
+            if not os.path.exists(element_output_dir):
+                os.makedirs(element_output_dir)
+
+            print(json_dict)
+            jsonl_file.write(json.dumps(json_dict, sort_keys=False, ensure_ascii=True) + "\n")
+            csv_writer.writerow({key: json.dumps(value) if isinstance(value, list) else value for key, value in json_dict.items()})
+            record_count += 1
+
+print(f"Extracted scan parameters of {record_count} series")